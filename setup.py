@@ -25,6 +25,7 @@ setuptools.setup(
     license='MIT',
     packages=setuptools.find_packages(),
     install_requires=['zabbix-api>=0.5.4', 'pyyaml'],
+    extras_require={'generators': ['numpy'], 'json': ['orjson']},
     classifiers=[
         "Development Status :: 4 - Beta",
         "Environment :: Console",
@@ -41,6 +42,7 @@ setuptools.setup(
     ],
     entry_points={
         'console_scripts': [
+            'zabbixbench = zabbixsim.benchmark:main',
             'zabbixrec = zabbixsim.zabbixrec:main',
             'zabbixsim = zabbixsim.zabbixsim:main'
         ]
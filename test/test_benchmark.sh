@@ -0,0 +1 @@
+zabbixbench --json benchmark.jsonl suite
@@ -0,0 +1,131 @@
+python3 - <<'PYTHON'
+import asyncio
+import os
+import tempfile
+from zabbixsim.buffer import BUFFER_BLOCK, BufferSender, SendBuffer
+from zabbixsim.headless import AsyncZabbixActive
+from zabbixsim.mockserver import MockZabbixServer
+from zabbixsim.pool import AsyncConnectionPool
+from zabbixsim.store import ItemStore
+
+def fragments(*numbers):
+    return [b'%d' % number for number in numbers]
+
+def drain(buffer, count=3):
+    sent = []
+    while True:
+        taken = buffer.take(count)
+        if not taken:
+            return sent
+        buffer.ack(taken)
+        sent += taken
+
+# The drop policy drops the oldest values, the block policy refuses new ones
+buffer = SendBuffer(max_values=4)
+for number in range(6):
+    assert buffer.add(fragments(number))
+assert drain(buffer) == fragments(2, 3, 4, 5) and buffer.dropped == 2 and len(buffer) == 0
+buffer = SendBuffer(max_values=4, policy=BUFFER_BLOCK)
+assert buffer.add(fragments(0, 1, 2, 3)) and not buffer.add(fragments(4))
+assert drain(buffer) == fragments(0, 1, 2, 3) and buffer.dropped == 0
+
+# Values put back after a failed send are sent first
+buffer = SendBuffer(max_values=10)
+buffer.add(fragments(0, 1, 2, 3))
+buffer.put_back(buffer.take(2))
+assert drain(buffer) == fragments(0, 1, 2, 3)
+
+# Closing without a spill directory counts the values it drops
+buffer.add(fragments(4, 5))
+buffer.close()
+assert buffer.dropped == 2 and len(buffer) == 0
+
+with tempfile.TemporaryDirectory() as directory:
+    # Values over max_values are spilled to segments, and sent oldest first
+    buffer = SendBuffer(max_values=4, spill_dir=directory)
+    for number in range(10):
+        buffer.add(fragments(number))
+    assert buffer.segments and len(buffer) == 10 and buffer.dropped == 0
+    assert drain(buffer) == fragments(*range(10))
+    assert not os.listdir(directory) and len(buffer) == 0
+
+    # Values put back after newer values were spilled still go first
+    buffer.add(fragments(0, 1, 2))
+    taken = buffer.take(2)
+    buffer.add(fragments(3, 4, 5, 6))
+    assert buffer.segments
+    buffer.put_back(taken)
+    assert len(buffer) == 7 and drain(buffer) == fragments(*range(7))
+
+    # And when a segment being sent is put back
+    for number in range(8):
+        buffer.add(fragments(number))
+    buffer.put_back(buffer.take(1))
+    assert drain(buffer, 1) == fragments(*range(8))
+
+    # Buffered values are kept on disk by close, and sent first by the next run
+    for number in range(6):
+        buffer.add(fragments(number))
+    buffer.ack(buffer.take(1))
+    buffer.put_back(buffer.take(1))
+    buffer.close()
+    buffer = SendBuffer(max_values=4, spill_dir=directory)
+    assert len(buffer) == 5
+    buffer.add(fragments(6))
+    assert drain(buffer) == fragments(*range(1, 7))
+
+    # A full spill directory drops the oldest segment, or refuses new values with block
+    buffer = SendBuffer(max_values=2, spill_dir=directory, max_spill_bytes=8)
+    for number in range(10):
+        buffer.add(fragments(number))
+    assert buffer.dropped and buffer.spill_bytes <= 8
+    sent = drain(buffer)
+    assert sent == sorted(sent, key=int) and sent[-1] == b'9'
+    assert len(sent) + buffer.dropped == 10
+    buffer = SendBuffer(max_values=2, spill_dir=directory, max_spill_bytes=8,
+                        policy=BUFFER_BLOCK)
+    added = [number for number in range(10) if buffer.add(fragments(number))]
+    assert buffer.dropped == 0 and drain(buffer) == fragments(*added)
+
+class RecordingServer(MockZabbixServer):
+    """Keep the keys of the values received, in order"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.keys = []
+
+    def response(self, request: dict):
+        self.keys += [value['key'] for value in request.get('data', [])]
+        return super().response(request)
+
+async def main():
+    # Values buffered while the server was down are sent in order once it is up
+    mock_server = RecordingServer()
+    port = await mock_server.start()
+    await mock_server.stop()
+    store = ItemStore()
+    store.add_host('host', [dict(name=f'i{n}', key_=f'i{n}', value_type=3, lastvalue=n,
+                                 delay=60) for n in range(20)])
+    zabbix_active = AsyncZabbixActive('127.0.0.1', store, port=port, timeout=1,
+                                      pool=AsyncConnectionPool(timeout=1))
+    sender = BufferSender(zabbix_active, SendBuffer(max_values=100), packet_values=5,
+                          send_interval=0.05, retry_min=0.05, retry_max=0.1)
+    sender.start()
+    for item in store['host']:
+        await sender.put('host', [item])
+    await asyncio.sleep(0.2)
+    assert sender.errors and len(sender.buffer) == 20
+
+    mock_server = RecordingServer(port=port)
+    await mock_server.start()
+    for _ in range(50):
+        if not len(sender.buffer):
+            break
+        await asyncio.sleep(0.05)
+    await sender.close()
+    assert mock_server.keys == [f'i{n}' for n in range(20)], mock_server.keys
+    assert sender.values_sent == 20 and sender.packets_sent == 4
+    await mock_server.stop()
+
+asyncio.run(main())
+PYTHON
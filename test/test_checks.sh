@@ -0,0 +1,49 @@
+python3 - <<'PYTHON'
+from zabbixsim.checks import ActiveChecks, apply_checks, first_refresh_slot, parse_delay
+from zabbixsim.scheduler import Scheduler
+from zabbixsim.store import ItemStore
+
+# Delays in seconds, with time suffixes and flexible intervals, macros are not known
+assert [parse_delay(delay) for delay in (30, '30', '5m', '1h;50s/1-7,00:00-24:00', '{$DELAY}',
+                                         '')] == [30, 30, 300, 3600, None, None]
+
+# The first update of a host has no delta, later ones only what changed
+checks = ActiveChecks()
+assert checks.update('web', [dict(key='a', delay='1m', itemid=1), dict(key='b', delay=30),
+                             dict(key='c', delay='{$DELAY}'), dict(delay=10)]) is None
+assert checks.get('web') == dict(a=60, b=30) and 'web' in checks
+assert checks.update('web', [dict(key='a', delay=60, itemid=2), dict(key='b', delay=30)]) == \
+    ({}, [])
+assert checks.update('web', [dict(key='a', delay=120), dict(key='d', delay=10)]) == \
+    (dict(a=120, d=10), ['b'])
+checks.remove('web')
+assert checks.get('web') is None and 'web' not in checks
+
+# Items are scheduled on the delays of their checks, items not asked for are not sent
+store = ItemStore()
+store.add_host('web', [dict(name=key, key_=key, value_type=3, lastvalue=1, delay=60)
+                       for key in ('a', 'b', 'c')])
+rows = store.key_rows('web')
+scheduler = Scheduler()
+for row in rows.values():
+    scheduler.schedule(row, 60, 100)
+checks.update('web', [dict(key='a', delay=60), dict(key='b', delay=10),
+                      dict(key='x', delay=10)])
+apply_checks(scheduler, store, 'web', checks, None, 0)
+assert scheduler.due(rows['a']) == 100 and scheduler.delay(rows['a']) == 60
+assert scheduler.due(rows['b']) == 10 and scheduler.delay(rows['b']) == 10
+assert rows['c'] not in scheduler
+
+# Only the delta is applied, new items are spread over their first delay
+delta = checks.update('web', [dict(key='a', delay=300), dict(key='c', delay=20)])
+assert delta == (dict(a=300, c=20), ['b', 'x'])
+apply_checks(scheduler, store, 'web', checks, delta, 50)
+assert scheduler.due(rows['a']) == 100 and scheduler.delay(rows['a']) == 300
+assert rows['b'] not in scheduler
+assert 50 <= scheduler.due(rows['c']) <= 70 and scheduler.delay(rows['c']) == 20
+
+# Refresh slots are spread by hostname, the same in every run
+slot = first_refresh_slot('web', 1000, 120)
+assert 1000 < slot <= 1120 and slot == first_refresh_slot('web', 1000, 120)
+assert first_refresh_slot('web', slot, 120) == slot + 120
+PYTHON
@@ -0,0 +1,78 @@
+python3 - <<'PYTHON'
+import asyncio
+import json
+from zabbixsim.control import ControlServer, ItemControl
+from zabbixsim.store import ItemStore
+
+async def call(port: int, method: str, target: str, body=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = b'' if body is None else json.dumps(body).encode("utf-8")
+    writer.write(f'{method} {target} HTTP/1.1\r\nHost: localhost\r\n'
+                 f'Content-Length: {len(data)}\r\n\r\n'.encode("latin-1") + data)
+    response = await reader.read()
+    writer.close()
+    head, _, result = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ')[1]), json.loads(result)
+
+def items():
+    return [dict(name='Load', key_='system.cpu.load', value_type=0, lastvalue='1.5', delay=60),
+            dict(name='Uptime', key_='system.uptime', value_type=3, lastvalue='100', delay=60),
+            dict(name='Uname', key_='system.uname', value_type=4, lastvalue='Linux', delay=60)]
+
+async def main():
+    active_data, passive_data = ItemStore(), ItemStore()
+    active_data.add_host('web', items())
+    active_data.add_clone('web-00001', 'web')
+    passive_data.add_host('web', items())
+    sent = []
+    server = ControlServer(ItemControl(active_data, passive_data,
+                                       lambda hostname, items: sent.append((hostname, items))))
+    await server.start(port=0)
+    port = server.server.sockets[0].getsockname()[1]
+
+    # Get the hosts and items
+    assert await call(port, 'GET', '/hosts') == (200, dict(hosts=['web', 'web-00001']))
+    status, result = await call(port, 'GET', '/items?host=web&section=passive')
+    assert status == 200 and [item['key_'] for item in result['items']] == \
+        ['system.cpu.load', 'system.uptime', 'system.uname']
+    assert await call(port, 'GET', '/item?host=web&name=Uptime') == (200, dict(
+        name='Uptime', key_='system.uptime', value_type=3, lastvalue=100, delay=60))
+    assert (await call(port, 'GET', '/items?host=db'))[0] == 404
+    assert (await call(port, 'GET', '/item?host=web&key=vm.memory.size'))[0] == 404
+
+    # Set values by key or name, changed active items are sent once per host
+    status, result = await call(port, 'POST', '/values', [
+        dict(host='web', key='system.cpu.load', value=4.2),
+        dict(host='web', name='Load', value='4.5'),
+        dict(host='web-00001', key='system.uptime', value='200'),
+        dict(host='web', key='system.uptime', value=300, section='passive'),
+        dict(host='db', key='system.uptime', value=1)])
+    assert (status, result) == (200, dict(updated=4, missing=[4]))
+    assert active_data.item_by_key('web', 'system.cpu.load')['lastvalue'] == 4.5
+    assert active_data.item_by_key('web-00001', 'system.uptime')['lastvalue'] == 200
+    assert active_data.item_by_key('web', 'system.uptime')['lastvalue'] == 100
+    assert passive_data.item_by_key('web', 'system.uptime')['lastvalue'] == 300
+    assert sorted((hostname, len(items)) for hostname, items in sent) == \
+        [('web', 1), ('web-00001', 1)]
+    status, result = await call(port, 'GET', '/item?host=web-00001&key=system.uptime')
+    assert result['lastvalue'] == 200
+
+    # A value that does not parse as the item's type is refused, and nothing is set
+    for value, key in (('high', 'system.cpu.load'), (-1, 'system.uptime'),
+                       ('1.5', 'system.uptime'), ([1], 'system.uname')):
+        status, result = await call(port, 'POST', '/values', [
+            dict(host='web', key='system.cpu.load', value=1),
+            dict(host='web', key=key, value=value)])
+        assert status == 400 and result['error'].startswith('edit 1: '), result
+    assert active_data.item_by_key('web', 'system.cpu.load')['lastvalue'] == 4.5
+
+    # Bad requests
+    assert (await call(port, 'POST', '/values', [dict(host='web', value=1)]))[0] == 400
+    assert (await call(port, 'POST', '/values', 'edit'))[0] == 400
+    assert (await call(port, 'GET', '/items?host=web&section=other'))[0] == 400
+    assert (await call(port, 'GET', '/values'))[0] == 405
+    assert (await call(port, 'GET', '/metrics'))[0] == 404
+    await server.stop()
+
+asyncio.run(main())
+PYTHON
@@ -0,0 +1,76 @@
+python3 - <<'PYTHON'
+import asyncio
+import zlib
+from zabbixsim.protocol import (PacketDecoder, PacketEncoder, ProtocolError, read_payload,
+                                ZBXD_COMPRESSED, ZBXD_HEADER_LARGE, ZBXD_LARGE, ZBXD_MAGIC,
+                                ZBXD_PROTOCOL)
+
+payload = b'{"request":"agent data","data":[' + b','.join(
+    b'{"key":"item%d","value":"%d"}' % (n, n) for n in range(200)) + b']}'
+
+def large_packet(payload, compress=False):
+    data = zlib.compress(payload) if compress else payload
+    flags = ZBXD_PROTOCOL | ZBXD_LARGE | (ZBXD_COMPRESSED if compress else 0)
+    return ZBXD_HEADER_LARGE.pack(ZBXD_MAGIC, flags, len(data),
+                                  len(payload) if compress else 0) + data
+
+packets = [bytes(PacketEncoder().encode(payload)),
+           bytes(PacketEncoder(compress=True).encode(payload)),
+           large_packet(payload), large_packet(payload, compress=True),
+           bytes(PacketEncoder().encode(b''))]
+assert packets[1][4] == ZBXD_PROTOCOL | ZBXD_COMPRESSED and len(packets[1]) < len(packets[0])
+
+# Packets split anywhere, including inside the prefix and the header, decode the same
+for packet in packets:
+    expected = payload if len(packet) > 13 else b''
+    for size in (1, 2, 3, 4, 5, 7, 12, 13, 20, 21, 100, len(packet)):
+        decoder = PacketDecoder()
+        rest = None
+        for start in range(0, len(packet), size):
+            assert rest is None
+            rest = decoder.feed(packet[start:start + size])
+        assert rest is not None and not rest, (packet[:5], size)
+        assert bytes(decoder.payload()) == expected, (packet[:5], size)
+
+# Packets sent back to back leave the start of the next one unused
+decoder = PacketDecoder()
+stream = packets[2] + packets[1]
+rest = decoder.feed(stream[:len(packets[2]) + 3])
+assert bytes(rest) == packets[1][:3] and bytes(decoder.payload()) == payload
+decoder.reset()
+assert decoder.feed(bytes(rest)) is None and decoder.received == 3
+assert decoder.feed(stream[len(packets[2]) + 3:]) is not None
+assert decoder.message()['request'] == 'agent data'
+
+# Bad magic and packets over the size limit are refused
+for packet, decoder in ((b'HTTP/1.1 200 OK\r\n', PacketDecoder()),
+                        (packets[0], PacketDecoder(max_size=100)),
+                        (packets[3], PacketDecoder(max_size=len(payload) - 1))):
+    try:
+        decoder.feed(packet)
+        raise AssertionError(f'{packet[:5]} was not refused')
+    except ProtocolError:
+        pass
+
+# The same packets from an asyncio stream, arriving in pieces
+async def main():
+    for packet in packets:
+        reader = asyncio.StreamReader()
+        reading = asyncio.ensure_future(read_payload(reader))
+        for start in range(0, len(packet), 3):
+            reader.feed_data(packet[start:start + 3])
+            await asyncio.sleep(0)
+        assert bytes(await reading) == (payload if len(packet) > 13 else b'')
+
+    # The stream closing inside the header is an incomplete read
+    reader = asyncio.StreamReader()
+    reader.feed_data(packets[2][:9])
+    reader.feed_eof()
+    try:
+        await read_payload(reader)
+        raise AssertionError('a partial header was read')
+    except asyncio.IncompleteReadError:
+        pass
+
+asyncio.run(main())
+PYTHON
@@ -0,0 +1,25 @@
+python3 - <<'PYTHON'
+import json
+import math
+from zabbixsim.encoding import AgentDataEncoder, encode_value_json, orjson
+from zabbixsim.store import ItemStore
+
+# Both encoders give valid JSON of the same value, the standard library one is always
+# tested, non-finite floats are null
+encoders = [encode_value_json] + ([orjson.dumps] if orjson is not None else [])
+values = ['up', 'café', '', 0, 18446744073709551615, 0.1, -2.5e-07, 1e+300,
+          float('nan'), float('inf'), float('-inf'), None, True]
+for value in values:
+    decoded = [json.loads(encode(value)) for encode in encoders]
+    expected = value if not isinstance(value, float) or math.isfinite(value) else None
+    assert decoded == [expected] * len(encoders), (value, decoded)
+
+# Recorded non-finite floats are kept as text, and sent as recorded
+store = ItemStore()
+store.add_host('host', [dict(name=value, key_=value, value_type=0, lastvalue=value, delay=60)
+                        for value in ('nan', 'inf', '-inf', '1e400', '0.5')])
+for encode in encoders:
+    fragments = AgentDataEncoder(encode).values('host', store['host'], 0)
+    data = json.loads(b'[%b]' % b','.join(fragments))
+    assert [value['value'] for value in data] == ['nan', 'inf', '-inf', '1e400', 0.5]
+PYTHON
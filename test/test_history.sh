@@ -0,0 +1,83 @@
+python3 - <<'PYTHON'
+import asyncio
+import os
+import tempfile
+from zabbixsim.headless import AsyncZabbixActive
+from zabbixsim.history import HistoryFile, HistoryReplay, HistoryWriter
+from zabbixsim.mockserver import MockZabbixServer
+from zabbixsim.pool import AsyncConnectionPool
+from zabbixsim.store import ItemStore
+
+NS = 1000000000
+START = 1700000000 * NS
+
+class RecordingServer(MockZabbixServer):
+    """Keep the values received, in order"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.received = []
+
+    def response(self, request: dict):
+        self.received += request.get('data', [])
+        return super().response(request)
+
+items = [('web', 'system.cpu.load', 0, 'active'), ('web', 'system.uptime', 3, 'active'),
+         ('db', 'system.uname', 4, 'active'), ('web', 'agent.ping', 3, 'passive')]
+values = [(START + n * NS // 10, n % 4, (n * 0.5, n, f'text {n} é', 1 << 63)[n % 4])
+          for n in range(40)]
+
+async def replay(path: str, passive_data: ItemStore):
+    mock_server = RecordingServer()
+    port = await mock_server.start()
+    history = HistoryFile(path)
+    zabbix_active = AsyncZabbixActive('127.0.0.1', ItemStore(), port=port,
+                                      pool=AsyncConnectionPool())
+    history_replay = HistoryReplay(history, zabbix_active, passive_data, speed=10,
+                                   original_clock=True, max_values=7)
+    await history_replay.run()
+    history.close()
+    await mock_server.stop()
+    return history_replay, mock_server.received
+
+with tempfile.TemporaryDirectory() as directory:
+    # Values are read back as they were written, in time order across chunks
+    path = os.path.join(directory, 'zabbixsim.history')
+    writer = HistoryWriter(path, items)
+    writer.write_chunk(values[:25])
+    writer.write_chunk([])
+    writer.write_chunk(values[25:])
+    writer.close(START // NS, START // NS + 4)
+    assert not os.path.exists(path + '.tmp') and writer.values_written == 40
+    history = HistoryFile(path)
+    assert (history.source, history.time_from, history.time_till) == \
+        ('history', START // NS, START // NS + 4)
+    assert [tuple(item) for item in history.items] == items and len(history.chunks) == 2
+    assert list(history.values()) == values
+    history.close()
+
+    # The replay sends the active values with their recorded clock, in order and in
+    # packets of max_values, and sets the passive values in the passive store
+    passive_data = ItemStore()
+    passive_data.add_host('web', [dict(name='Ping', key_='agent.ping', value_type=3,
+                                       lastvalue=0, delay=60)])
+    history_replay, received = asyncio.run(replay(path, passive_data))
+    active = [(stamp, item, value) for stamp, item, value in values if items[item][3] == 'active']
+    assert [(value['clock'] * NS + value['ns'], value['host'], value['key'], value['value'])
+            for value in received] == [(stamp, items[item][0], items[item][1], str(value))
+                                       for stamp, item, value in active]
+    packets_sent, values_sent, errors = history_replay.totals()
+    assert packets_sent >= 5 and values_sent == 30 and errors == 0
+    assert history_replay.passive_values == 10
+    assert passive_data.item_by_key('web', 'agent.ping')['lastvalue'] == 1 << 63
+    assert not history_replay.sending
+
+    # A file that is not a history file is refused
+    with open(path, 'wb') as file:
+        file.write(b'not a history file')
+    try:
+        HistoryFile(path)
+        raise AssertionError('the file was read as history')
+    except ValueError:
+        pass
+PYTHON
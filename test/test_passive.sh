@@ -0,0 +1,57 @@
+python3 - <<'PYTHON'
+import asyncio
+import socket
+from zabbixsim.passive import ZABBIX_NOTSUPPORTED, ZabbixPassive, passive_addresses
+from zabbixsim.protocol import encode_parts, read_payload
+from zabbixsim.store import ItemStore
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+async def poll(address, key: str, framed: bool = True):
+    reader, writer = await asyncio.open_connection(*address)
+    request = key.encode("utf-8")
+    writer.writelines(encode_parts(request) if framed else [request + b'\n'])
+    await writer.drain()
+    payload = await read_payload(reader)
+    writer.close()
+    return bytes(payload)
+
+async def main():
+    store = ItemStore()
+    store.add_host('web', [dict(name='Load', key_='system.cpu.load', value_type=0, lastvalue='1.5',
+                                delay=60),
+                           dict(name='Name', key_='system.hostname', value_type=1,
+                                lastvalue='web', delay=60)])
+    store.add_clone('web-00001', 'web', 0.5)
+    port = free_port()
+    listen, address_map = passive_addresses(list(store), listen='0.0.0.0', port=port,
+                                            mode='ip')
+    assert listen == [('0.0.0.0', port)]
+    assert address_map == {('127.0.1.1', port): 'web', ('127.0.1.2', port): 'web-00001'}
+    zabbix_passive = ZabbixPassive(store, listen, address_map)
+    await zabbix_passive.start()
+    web, clone = list(address_map)
+
+    # Each host answers its own values, over ZBXD and from older servers a plain line
+    assert await poll(web, 'system.cpu.load') == b'1.5'
+    assert await poll(web, 'system.cpu.load', framed=False) == b'1.5'
+    assert await poll(clone, 'system.cpu.load') == b'2.25'
+    assert await poll(clone, 'system.hostname') == b'web'
+    assert await poll(clone, 'agent.hostname') == b'web-00001'
+    assert await poll(web, 'agent.ping') == b'1'
+
+    # Values set while the agent runs are answered straight away
+    store.item_by_key('web', 'system.cpu.load')['lastvalue'] = 3
+    assert await poll(web, 'system.cpu.load') == b'3.0'
+
+    # Keys that are not simulated are not supported
+    assert await poll(web, 'vfs.fs.size[/,free]') == ZABBIX_NOTSUPPORTED + \
+        b'Unsupported item key.'
+    assert zabbix_passive.requests == 8 and zabbix_passive.unsupported == 1
+    await zabbix_passive.stop()
+
+asyncio.run(main())
+PYTHON
@@ -0,0 +1,55 @@
+python3 - <<'PYTHON'
+import configparser
+import os
+import tempfile
+import yaml
+from zabbixsim.loader import build_stores, clone_hostnames, clones_from_config, load_index
+from zabbixsim.reload import SimWatcher, reload_store
+
+def write_host(directory, hostname, name):
+    items = [dict(key_='sim.item', name=name, value_type='3', lastvalue='1', delay=60)]
+    with open(os.path.join(directory, hostname + '.yaml'), 'w', encoding="utf8") as writer:
+        yaml.dump({hostname: dict(active=items, passive=items)}, writer)
+
+config = configparser.ConfigParser()
+config.read_dict(dict(SETTINGS=dict(clones='2')))
+with tempfile.TemporaryDirectory() as directory:
+    write_host(directory, 'web', 'Item')
+    write_host(directory, 'db', 'Item')
+    index = load_index(directory)
+    active_data, passive_data, hostnames = build_stores(index)
+    hostnames = clones_from_config(config, active_data, passive_data, hostnames)
+    assert sorted(hostnames) == ['db', 'db-00001', 'db-00002', 'web', 'web-00001', 'web-00002']
+
+    # A changed host keeps its clones, with the new items
+    watcher = SimWatcher(index, directory)
+    write_host(directory, 'web', 'Changed item')
+    os.utime(os.path.join(directory, 'web.yaml'), (0, 0))
+    changed, removed = watcher.poll()
+    for store, section in ((active_data, 'active'), (passive_data, 'passive')):
+        reload_store(store, section, changed, removed)
+    assert clone_hostnames(watcher.hostnames(), active_data, passive_data) == hostnames
+    assert active_data.item_by_key('web-00001', 'sim.item')['name'] == 'Changed item'
+
+    # Reloads reuse the rows of the old items, and keep the values set for clones
+    active_data.item_by_key('web-00001', 'sim.item')['lastvalue'] = 42
+    item_count = active_data.item_count
+    for reload in range(10):
+        write_host(directory, 'web', f'Reload {reload}')
+        os.utime(os.path.join(directory, 'web.yaml'), (reload + 1, reload + 1))
+        changed, removed = watcher.poll()
+        for store, section in ((active_data, 'active'), (passive_data, 'passive')):
+            reload_store(store, section, changed, removed)
+        assert active_data.item_by_key('web', 'sim.item')['name'] == f'Reload {reload}'
+        assert active_data.item_by_key('web-00001', 'sim.item')['lastvalue'] == 42
+        assert active_data.item_by_key('web-00002', 'sim.item')['lastvalue'] == 1
+    assert len(active_data.item_keys) <= item_count + 1
+
+    # A removed host takes its clones with it
+    os.remove(os.path.join(directory, 'db.yaml'))
+    changed, removed = watcher.poll()
+    for store, section in ((active_data, 'active'), (passive_data, 'passive')):
+        reload_store(store, section, changed, removed)
+    assert sorted(clone_hostnames(watcher.hostnames(), active_data, passive_data)) == \
+        ['web', 'web-00001', 'web-00002']
+PYTHON
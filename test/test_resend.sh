@@ -0,0 +1,63 @@
+python3 - <<'PYTHON'
+import asyncio
+from zabbixsim.active import ZabbixActive
+from zabbixsim.headless import AsyncZabbixActive
+from zabbixsim.mockserver import MockZabbixServer
+from zabbixsim.pool import AsyncConnectionPool, ConnectionPool
+from zabbixsim.store import ItemStore
+
+def message(value):
+    return dict(request='agent data', data=[dict(host='host', key='key', value=value)])
+
+async def main():
+    # The server closes the connection after each response, the messages it did not
+    # read are sent again on new connections, each value is stored once
+    mock_server = MockZabbixServer(keep_alive=False)
+    port = await mock_server.start()
+    zabbix_active = AsyncZabbixActive('127.0.0.1', ItemStore(), port=port,
+                                      pool=AsyncConnectionPool())
+    responses = await zabbix_active.send_messages([message(n) for n in range(5)])
+    assert len(responses) == 5 and mock_server.values == 5, mock_server.values
+    await zabbix_active.send_messages([message(5)])
+    assert mock_server.values == 6
+    await mock_server.stop()
+
+    # The server stores the values and fails during the response on a reused
+    # connection, they are not sent again
+    mock_server = MockZabbixServer()
+    port = await mock_server.start()
+    zabbix_active = AsyncZabbixActive('127.0.0.1', ItemStore(), port=port,
+                                      pool=AsyncConnectionPool())
+    await zabbix_active.send_messages([message(0)])
+    mock_server.truncate = 10
+    try:
+        await zabbix_active.send_messages([message(1), message(2)])
+        raise AssertionError('a failed response was not raised')
+    except ConnectionError:
+        pass
+    assert mock_server.values == 2 and mock_server.packets == 2, mock_server.values
+    await mock_server.stop()
+
+asyncio.run(main())
+
+# The same with the blocking ZabbixActive, from another thread
+def blocking(mock_server, sends):
+    loop = asyncio.new_event_loop()
+    port = loop.run_until_complete(mock_server.start())
+    zabbix_active = ZabbixActive('127.0.0.1', ItemStore(), port=port, pool=ConnectionPool())
+    errors = 0
+    for value in range(sends):
+        future = loop.run_in_executor(None, zabbix_active.send_message, message(value))
+        try:
+            loop.run_until_complete(future)
+        except ConnectionError:
+            errors += 1
+    loop.run_until_complete(mock_server.stop())
+    loop.close()
+    return errors
+
+mock_server = MockZabbixServer(keep_alive=False)
+assert blocking(mock_server, 3) == 0 and mock_server.values == 3
+mock_server = MockZabbixServer(truncate=10)
+assert blocking(mock_server, 2) == 2 and mock_server.values == 2
+PYTHON
@@ -0,0 +1,77 @@
+python3 - <<'PYTHON'
+import asyncio
+import configparser
+import socket
+from zabbixsim.headless import AsyncZabbixActive
+from zabbixsim.mockserver import MockZabbixServer
+from zabbixsim.pool import AsyncConnectionPool
+from zabbixsim.routing import parse_server_active, routes_from_config, target_directory
+from zabbixsim.store import ItemStore
+
+# ServerActive lists targets separated by ',' and the nodes of a cluster by ';'
+assert parse_server_active('zabbix, proxy:10052 ; backup , [::1]:10053,::1') == [
+    [('zabbix', 10051)], [('proxy', 10052), ('backup', 10051)], [('::1', 10053)],
+    [('::1', 10051)]]
+assert parse_server_active('zabbix', 10061) == [[('zabbix', 10061)]]
+for value in ('zabbix:port', '[::1]10051', ':10051'):
+    try:
+        parse_server_active(value)
+        raise AssertionError(f'{value} was parsed')
+    except ValueError:
+        pass
+assert target_directory([('::1', 10051), ('backup', 10051)]) == '_1_10051_backup_10051'
+
+# Routes match hostname patterns in order, without case, other hosts are split
+# across the default targets, or sent to all of them
+config = configparser.ConfigParser()
+config.read_dict(dict(SETTINGS=dict(server_active='a,b'),
+                      ROUTES={'db-*': 'c;d', 'DB-Main': 'e', 'web-?': 'a'}))
+routes = routes_from_config(config)
+assert routes.targets == [[('a', 10051)], [('b', 10051)], [('c', 10051), ('d', 10051)],
+                          [('e', 10051)]]
+assert routes.targets_of('DB-main') == [2] and routes.targets_of('web-1') == [0]
+hostnames = [f'host{number}' for number in range(100)]
+split = [routes.targets_of(hostname) for hostname in hostnames]
+assert all(targets in ([0], [1]) for targets in split) and [0] in split and [1] in split
+assert routes.hosts_of(2, ['db-1', 'web-1', 'DB-2']) == ['db-1', 'DB-2']
+config.set('SETTINGS', 'server_routing', 'all')
+assert routes_from_config(config).targets_of('host1') == [0, 1]
+config = configparser.ConfigParser()
+config.read_dict(dict(SETTINGS=dict(server='zabbix', port='10061')))
+assert routes_from_config(config).targets == [[('zabbix', 10061)]]
+
+def message(value):
+    return dict(request='agent data', data=[dict(host='host', key='key', value=value)])
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+async def main():
+    backup = MockZabbixServer()
+    backup_port = await backup.start()
+
+    # A node that cannot be reached fails over to the next
+    nodes = [('127.0.0.1', closed_port()), ('127.0.0.1', backup_port)]
+    zabbix_active = AsyncZabbixActive(nodes[0][0], ItemStore(), port=nodes[0][1], nodes=nodes,
+                                      pool=AsyncConnectionPool(timeout=1))
+    await zabbix_active.send_messages([message(0)])
+    assert (zabbix_active.server, zabbix_active.port) == nodes[1] and backup.values == 1
+
+    # A node that takes the values but does not answer in time does not fail over
+    silent = await asyncio.start_server(lambda reader, writer: None, '127.0.0.1', 0)
+    nodes = [('127.0.0.1', silent.sockets[0].getsockname()[1]), ('127.0.0.1', backup_port)]
+    zabbix_active = AsyncZabbixActive(nodes[0][0], ItemStore(), port=nodes[0][1], nodes=nodes,
+                                      timeout=0.2, pool=AsyncConnectionPool(timeout=0.2))
+    try:
+        await zabbix_active.send_messages([message(1)])
+        raise AssertionError('the timeout was not raised')
+    except asyncio.TimeoutError:
+        pass
+    assert (zabbix_active.server, zabbix_active.port) == nodes[0] and backup.values == 1
+    silent.close()
+    await backup.stop()
+
+asyncio.run(main())
+PYTHON
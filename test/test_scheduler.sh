@@ -0,0 +1,36 @@
+python3 - <<'PYTHON'
+from zabbixsim.scheduler import Scheduler
+
+# Keys come out in due time order, each on its own delay
+scheduler = Scheduler()
+scheduler.schedule('a', 10, 5)
+scheduler.schedule('b', 3, 1)
+scheduler.schedule('c', 4, 1)
+assert len(scheduler) == 3 and scheduler.next_due() == 1
+assert scheduler.pop_due(0.5) == []
+assert scheduler.pop_due(1) == [('b', 1), ('c', 1)]
+assert scheduler.pop_due(4) == [('b', 4)]
+# Keys due at the same time come out in the order they were scheduled
+assert scheduler.pop_due(5) == [('a', 5), ('c', 5)]
+assert scheduler.due('a') == 15 and scheduler.delay('b') == 3
+assert scheduler.next_due() == 7 and scheduler.skipped == 0
+
+# Rescheduled and unscheduled keys leave their old entries behind, which are skipped
+scheduler.schedule('b', 2, 20)
+scheduler.unschedule('c')
+scheduler.schedule('d', 0, 6)
+assert 'c' not in scheduler and 'd' not in scheduler and len(scheduler) == 2
+assert scheduler.next_due() == 15
+assert scheduler.pop_due(19) == [('a', 15)]
+assert scheduler.pop_due(20) == [('b', 20)]
+
+# After a stall the missed checks are skipped and counted, the schedule does not drift
+scheduler = Scheduler()
+scheduler.schedule('x', 10, 0)
+scheduler.schedule('y', 1, 0.5)
+assert scheduler.pop_due(0) == [('x', 0)]
+assert scheduler.pop_due(35.2) == [('y', 35.5 - 1), ('x', 30)]
+assert scheduler.skipped == 34 + 2
+assert scheduler.due('x') == 40 and scheduler.due('y') == 35.5
+assert scheduler.pop_due(35.5) == [('y', 35.5)] and scheduler.skipped == 36
+PYTHON
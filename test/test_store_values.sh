@@ -0,0 +1,66 @@
+python3 - <<'PYTHON'
+import json
+from zabbixsim.encoding import encode_value, encode_value_json
+from zabbixsim.passive import format_value
+from zabbixsim.store import ItemStore
+
+# Numeric values are kept as numbers, sent and answered in their shortest form,
+# which the server reads back as the number that was recorded
+floats = ['0.10000000000000001', '1.50', '0', '-2.5e-7', '1e+06', '123456789.123456789']
+unsigned = ['0', '007', '18446744073709551615']
+text = ['0.10000000000000001', ' 1.50', 'up', '']
+store = ItemStore()
+store.add_host('host', [dict(name=f'f{n}', key_=f'f{n}', value_type=0, lastvalue=value,
+                             delay=60) for n, value in enumerate(floats)] +
+               [dict(name=f'u{n}', key_=f'u{n}', value_type=3, lastvalue=value,
+                     delay=60) for n, value in enumerate(unsigned)] +
+               [dict(name=f't{n}', key_=f't{n}', value_type=4, lastvalue=value,
+                     delay=60) for n, value in enumerate(text)])
+items = store['host']
+for item, value in zip(items[:len(floats)], floats):
+    for encode in (encode_value, encode_value_json):
+        assert json.loads(encode(item['lastvalue'])) == float(value), (value, encode)
+    assert float(format_value(item['lastvalue'])) == float(value)
+for item, value in zip(items[len(floats):len(floats) + len(unsigned)], unsigned):
+    for encode in (encode_value, encode_value_json):
+        assert json.loads(encode(item['lastvalue'])) == int(value), (value, encode)
+    assert int(format_value(item['lastvalue'])) == int(value)
+
+# Text values, and values that do not parse as their type, are kept exactly
+for item, value in zip(items[len(floats) + len(unsigned):], text):
+    assert item['lastvalue'] == value
+    assert json.loads(encode_value(item['lastvalue'])) == value
+store.add_host('bad', [dict(name='f', key_='f', value_type=0, lastvalue='n/a', delay=60),
+                       dict(name='u', key_='u', value_type=3, lastvalue='-1', delay=60)])
+assert [item['lastvalue'] for item in store['bad']] == ['n/a', '-1']
+
+# A float alternating between finite and non-finite values reuses its slots
+item = store.item_by_key('bad', 'f')
+for value in ['1.5', 'nan', '2.5', 'inf'] * 100:
+    item['lastvalue'] = value
+assert item['lastvalue'] == 'inf' and store['bad'][0]['lastvalue'] == 'inf'
+item['lastvalue'] = 3.5
+assert item['lastvalue'] == 3.5
+assert len(store.float_values) <= len(floats) + 1
+assert len(store.text_values) <= len(text) + 2
+
+# Hosts are listed in the order they were added, whether or not they have loaded
+store = ItemStore()
+store.add_lazy_host('lazy', lambda: [('n', 'k', 3, '1', 60, None)])
+store.add_host('loaded', [dict(name='n', key_='k', value_type=3, lastvalue='1', delay=60)])
+store.add_clone('clone', 'lazy')
+assert list(store) == ['lazy', 'loaded', 'clone']
+assert store['clone'][0]['lastvalue'] == 1
+assert list(store) == ['lazy', 'loaded', 'clone'] and len(store) == 3
+
+# Values set for a clone are held like the values of the template
+store.add_host('template', [dict(name='f', key_='f', value_type=0, lastvalue='1', delay=60),
+                            dict(name='u', key_='u', value_type=3, lastvalue='1', delay=60)])
+store.add_clone('copy', 'template')
+store.item_by_key('copy', 'f')['lastvalue'] = '2.50'
+store.item_by_key('copy', 'u')['lastvalue'] = '007'
+assert [item['lastvalue'] for item in store['copy']] == [2.5, 7]
+store.item_by_key('copy', 'f')['lastvalue'] = 'nan'
+assert store.item_by_key('copy', 'f')['lastvalue'] == 'nan'
+assert [item['lastvalue'] for item in store['template']] == [1.0, 1]
+PYTHON
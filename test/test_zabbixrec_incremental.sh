@@ -0,0 +1,37 @@
+python3 - <<'PYTHON'
+import tempfile
+import yaml
+import zabbix_api
+from zabbixsim.mockserver import MockZabbixAPI
+from zabbixsim.zabbixrec import record
+
+mock_api = MockZabbixAPI(4, 6, latency=0)
+url = mock_api.start()
+def connect():
+    zapi = zabbix_api.ZabbixAPI(server=url)
+    zapi.login('Admin', 'zabbix')
+    return zapi
+
+def names(directory, hostid):
+    with open(f'{directory}/simhost{hostid:06}.yaml', encoding="utf8") as reader:
+        return [item['name'] for section in yaml.safe_load(reader).values()
+                for items in section.values() for item in items]
+
+try:
+    with tempfile.TemporaryDirectory() as directory:
+        record(connect, directory, page_size=2)
+        assert record(connect, directory, page_size=2, incremental=True).hosts_done == 0
+
+        # A template edit is audited under the template itemid, a discovered item not at all
+        mock_api.update_template_item(2, 'Template item')
+        mock_api.discover_item(1, 'Discovered item')
+        assert record(connect, directory, page_size=2, incremental=True).hosts_done == 4
+        assert all('Template item' in names(directory, hostid) for hostid in range(4))
+        assert 'Discovered item' in names(directory, 1)
+
+        mock_api.update_item(3, 4, 'Host item')
+        assert record(connect, directory, page_size=2, incremental=True).hosts_done == 1
+        assert 'Host item' in names(directory, 3)
+finally:
+    mock_api.stop()
+PYTHON
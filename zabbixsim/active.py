@@ -0,0 +1,220 @@
+#
+# Zabbix active agent protocol
+#
+
+"""Zabbix active agent"""
+import logging
+import random
+import socket
+import time
+from zabbixsim.encoding import AGENT_DATA, dumps
+from zabbixsim.metrics import METRICS
+from zabbixsim.pool import ConnectionPool
+from zabbixsim.protocol import NotAnsweredError, PacketDecoder, PacketEncoder
+from zabbixsim.scheduler import NS_PER_SECOND
+
+ZABBIX_ACTIVE_PORT = 10051
+#ZABBIX_ACTIVE_PORT = 10050
+ZABBIX_REFRESH_ACTIVE_CHECKS = 120
+ZABBIX_SEND_ACTIVE = 5
+
+class ZabbixActive():
+    """ZabbixActive"""
+    # Generate a random 32 character number for the session id
+    session_num= random.randrange(1, 10**32)
+
+    server = ""
+    active_data = {}
+
+    def __init__(self, server: str, active_data: dict, port: int = ZABBIX_ACTIVE_PORT,
+                 pool: ConnectionPool = None, compress: bool = False, nodes: list = None):
+        # pylint: disable=too-many-arguments
+        logging.debug("ZabbixActive")
+        self.server = server
+        self.active_data = active_data
+        self.port = port
+
+        # The (host, port) nodes of a cluster to fail over between, like ServerActive
+        self.nodes = nodes or [(server, port)]
+        self.node = self.nodes.index((server, port)) if (server, port) in self.nodes else 0
+        self.pool = pool or ConnectionPool()
+        self.compress = compress
+        self.encoder = PacketEncoder(compress=compress)
+        self.decoder = PacketDecoder()
+
+    def exchange(self, active_socket: socket.socket, packet_send):
+        '''Send a packet and receive the response on a connected socket'''
+        started = time.perf_counter()
+        self.decoder.reset()
+        active_socket.sendall(packet_send)
+        sent = time.perf_counter()
+        parsed = self.decoder.receive(active_socket)
+        histograms = METRICS.histograms
+        histograms['send_seconds'].observe(sent - started)
+        histograms['receive_seconds'].observe(time.perf_counter() - sent)
+        counters = METRICS.counters
+        counters['packets_sent_total'] += 1
+        counters['bytes_sent_total'] += len(packet_send)
+        counters['bytes_received_total'] += self.decoder.needed
+        return parsed
+
+    def send_message(self, data: dict):
+        '''Send the message to the Zabbix server'''
+        logging.debug('packet %s', data)
+
+        # Generate the zabbix formatted message, from a dict or an encoded payload
+        if isinstance(data, (bytes, bytearray)):
+            payload = data
+        else:
+            payload = dumps(data)
+        logging.debug("data %s", payload)
+        packet_send = self.encoder.encode(payload)
+
+        # Each node is tried once, starting with the current one, moving on only
+        # when the node did not start to answer so the values are not stored twice
+        for attempt in range(len(self.nodes)):
+            address = (self.server, self.port)
+            try:
+                parsed = self.send_packet(address, packet_send)
+                break
+            except NotAnsweredError as err:
+                if attempt + 1 == len(self.nodes):
+                    raise
+                self.failover(address, err)
+
+        # Print the received message
+        logging.debug(parsed["response"])
+        return parsed
+
+    def send_packet(self, address: tuple, packet_send):
+        '''Send the packet to an address and receive the response
+
+        A reused connection the server has closed fails with a connection
+        error before any of the response is read, the packet is then sent
+        again on a new connection. A failed connect, or a new connection
+        failing the same way, raises NotAnsweredError. Any other failure,
+        such as a timeout waiting for the response, is raised as it is as
+        the server may have stored the values and sending them again would
+        store them twice.
+        '''
+        while True:
+            try:
+                active_socket, reused = self.pool.acquire(address)
+            except OSError as err:
+                raise NotAnsweredError(f'connect failed: {err}') from err
+            try:
+                parsed = self.exchange(active_socket, packet_send)
+            except OSError as err:
+                self.pool.release(address, active_socket, reusable=False)
+                if isinstance(err, ConnectionError) and not self.decoder.received:
+                    if not reused:
+                        raise NotAnsweredError(f'connection failed: {err}') from err
+                    logging.debug('%s closed a reused connection: %s', address, err)
+                    self.pool.persistent[address] = False
+                    continue
+                raise
+            self.pool.release(address, active_socket)
+            return parsed
+
+    def failover(self, address: tuple, err: Exception):
+        '''Move to the next node after a send to address failed
+
+        Sends in flight to the same node all fail, only the first moves on.
+        '''
+        if address != (self.server, self.port):
+            return
+        self.node = (self.node + 1) % len(self.nodes)
+        self.server, self.port = self.nodes[self.node]
+        METRICS.counters['failovers_total'] += 1
+        logging.warning('%s:%s failed, failing over to %s:%s: %s',
+                        address[0], address[1], self.server, self.port, err)
+
+    @classmethod
+    def active_checks_message(cls, host_check: str):
+        '''Build the active checks request for a host'''
+        return dict(request="active checks", host=host_check)
+
+    @classmethod
+    def active_checks(cls, host_check: str, received_data: dict):
+        '''Get the checks from an active checks response, or None if the server refused them'''
+        if received_data.get("response") != "success":
+            logging.debug('%s: active checks failed: %s', host_check, received_data.get("info"))
+            return None
+        checks = received_data.get("data", [])
+        for value in checks:
+            logging.debug( "%s %s", str(value.get("key")), str(value.get("delay")))
+        return checks
+
+    def refresh_checks(self, host_check: str):
+        '''Query the Zabbix server for an active check, returns the checks or None'''
+        received_data = self.send_message(self.active_checks_message(host_check))
+        return self.active_checks(host_check, received_data)
+
+    def agent_data_message(self, hostname :str, due_items :list):
+        '''Build the agent data message for the items that are due, or None'''
+        epoch_time, epoch_ns = divmod(time.time_ns(), NS_PER_SECOND)
+
+        item_id = 1
+        item_data_list = []
+        for item in due_items or []:
+            item_data = dict(host=hostname,
+                        key=item['key_'],
+                        value=item['lastvalue'],
+                        id=item_id,
+                        clock=epoch_time,
+                        ns=epoch_ns)
+            item_data_list.append(item_data)
+            item_id += 1
+
+        # Check if any data to send
+        if not item_data_list:
+            return None
+
+        agent_data_msg = dict(request="agent data",
+                    session=f'{self.session_num:032}',
+                    clock=epoch_time,
+                    ns=epoch_ns,
+                    data=item_data_list)
+        self.session_num += 1
+        return agent_data_msg
+
+    def encode_agent_data(self, hostname: str, due_items: list, stamps: list = None):
+        '''Encode the agent data payload for the items that are due, or None
+
+        Like agent_data_message, but encoded straight to bytes from the
+        pre-encoded host and key of each item. Each value is stamped with
+        its time in stamps, in ns since the epoch, or with the time now.
+        '''
+        if not due_items:
+            return None
+        now = time.time_ns()
+        payload = AGENT_DATA.host_payload(f'{self.session_num:032}', now, hostname, due_items,
+                                          now if stamps is None else stamps)
+        self.session_num += 1
+        return payload
+
+    def history_data_message(self, values: list):
+        '''Build the agent data message for values with their own host, clock and ns'''
+        epoch_time, epoch_ns = divmod(time.time_ns(), NS_PER_SECOND)
+        for item_id, value in enumerate(values, 1):
+            value['id'] = item_id
+
+        agent_data_msg = dict(request="agent data",
+                    session=f'{self.session_num:032}',
+                    clock=epoch_time,
+                    ns=epoch_ns,
+                    data=values)
+        self.session_num += 1
+        return agent_data_msg
+
+    def agent_data(self, hostname :str, due_items :list, stamps: list = None):
+        '''Process the active agent data, each value stamped with its time in stamps'''
+        logging.debug("agent_data")
+
+        # Send active data for each host
+        payload = self.encode_agent_data(hostname, due_items, stamps)
+        if payload:
+            received_data = self.send_message(payload)
+            METRICS.counters['values_sent_total'] += len(due_items)
+
+            logging.debug(received_data["info"])
@@ -0,0 +1,158 @@
+#
+# Combine agent data from many hosts into fewer packets
+#
+
+"""Agent data batching"""
+import asyncio
+import collections
+import logging
+import time
+from zabbixsim.encoding import AGENT_DATA
+from zabbixsim.metrics import METRICS
+
+ZABBIX_BATCH_VALUES = 1000
+ZABBIX_BATCH_BYTES = 1 << 20
+ZABBIX_BATCH_DELAY = 1.0
+ZABBIX_BATCH_INFLIGHT = 4
+
+# Room for the "id" added to each value and the packet envelope
+ZABBIX_BATCH_ID_SIZE = 16
+ZABBIX_BATCH_ENVELOPE_SIZE = 128
+
+def value_fragments(hostname: str, items, stamps=None):
+    '''Encode the values of items of one host, without their ids
+
+    Each value is stamped with its time in stamps, in ns since the epoch,
+    or with the time now.
+    '''
+    return AGENT_DATA.values(hostname, items, time.time_ns() if stamps is None else stamps)
+
+def agent_data_payload(zabbix_active, fragments: list):
+    '''Build an agent data payload from encoded values, numbering each value'''
+    payload = AGENT_DATA.payload(f'{zabbix_active.session_num:032}', time.time_ns(), fragments)
+    zabbix_active.session_num += 1
+    return payload
+
+class SendTasks():
+    """Packets sent in the background, at most limit at a time
+
+    A packet started while limit sends are running waits for one of them
+    to finish. Producers await wait() to hold back while the sends are
+    behind, so a slow server does not pile up tasks and packets.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.running = set()
+        self.waiting = collections.deque()
+
+    def __len__(self):
+        return len(self.running) + len(self.waiting)
+
+    def start(self, send, *args):
+        '''Run send(*args) as a task, or once a running send finishes'''
+        if len(self.running) >= self.limit:
+            self.waiting.append((send, args))
+            return
+        task = asyncio.ensure_future(send(*args))
+        self.running.add(task)
+        task.add_done_callback(self.finished)
+
+    def finished(self, task):
+        '''Start the next waiting send when a send finishes'''
+        self.running.discard(task)
+        if self.waiting:
+            send, args = self.waiting.popleft()
+            self.start(send, *args)
+
+    async def wait(self):
+        '''Wait until a send can start without waiting'''
+        while len(self.running) >= self.limit:
+            await asyncio.wait(list(self.running), return_when=asyncio.FIRST_COMPLETED)
+
+    async def join(self):
+        '''Wait for all the sends to finish, including the waiting ones'''
+        while self.running:
+            await asyncio.gather(*self.running, return_exceptions=True)
+
+class AgentDataBatcher():
+    """Buffer due values from many hosts, like a proxy or agent2 buffer
+
+    A packet is sent when it would go over max_values or max_bytes, or
+    max_delay seconds after its first value was added. At most
+    max_inflight packets are sent at a time.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, zabbix_active, max_values: int = ZABBIX_BATCH_VALUES,
+                 max_bytes: int = ZABBIX_BATCH_BYTES, max_delay: float = ZABBIX_BATCH_DELAY,
+                 max_inflight: int = ZABBIX_BATCH_INFLIGHT):
+        # pylint: disable=too-many-arguments
+        self.zabbix_active = zabbix_active
+        self.max_values = max_values
+        self.max_bytes = max_bytes - ZABBIX_BATCH_ENVELOPE_SIZE
+        self.max_delay = max_delay
+
+        self.fragments = []
+        self.size = 0
+        self.timer = None
+        self.sending = SendTasks(max_inflight)
+
+        # Throughput counters
+        self.packets_sent = 0
+        self.values_sent = 0
+        self.errors = 0
+
+    def add(self, hostname: str, due_items: list, stamps: list = None):
+        '''Add the due values of a host, flushing full packets'''
+        for fragment in value_fragments(hostname, due_items, stamps):
+            size = len(fragment) + ZABBIX_BATCH_ID_SIZE
+            if self.fragments and self.size + size > self.max_bytes:
+                self.flush()
+            self.fragments.append(fragment)
+            self.size += size
+            if len(self.fragments) >= self.max_values:
+                self.flush()
+
+        if self.fragments and self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.max_delay, self.flush)
+
+    def packet(self, fragments: list):
+        '''Build the agent data payload, numbering each value'''
+        return agent_data_payload(self.zabbix_active, fragments)
+
+    def flush(self):
+        '''Send the buffered values as one packet'''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.fragments:
+            return
+
+        fragments = self.fragments
+        self.fragments = []
+        self.size = 0
+        self.sending.start(self.send, fragments)
+
+    async def wait(self):
+        '''Wait while the packets sent are behind'''
+        await self.sending.wait()
+
+    async def send(self, fragments: list):
+        '''Send one packet of values'''
+        try:
+            received_data = await self.zabbix_active.send_message(self.packet(fragments))
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as err:
+            self.errors += 1
+            METRICS.counters['batch_errors_total'] += 1
+            logging.warning('agent data batch of %d values failed: %s', len(fragments), err)
+            return
+        logging.debug(received_data.get("info"))
+        self.packets_sent += 1
+        self.values_sent += len(fragments)
+        METRICS.counters['values_sent_total'] += len(fragments)
+
+    async def close(self):
+        '''Send the buffered values and wait for all sends to finish'''
+        self.flush()
+        await self.sending.join()
@@ -0,0 +1,791 @@
+#
+# Benchmark the simulator against a local mock Zabbix server
+#
+
+"""Simulator benchmarks"""
+import argparse
+import asyncio
+import configparser
+import contextlib
+import datetime
+import functools
+import gc
+import glob
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import time
+import yaml
+import zabbix_api
+from zabbixsim.active import ZabbixActive
+from zabbixsim.batch import AgentDataBatcher
+from zabbixsim.batch import ZABBIX_BATCH_BYTES, ZABBIX_BATCH_DELAY, ZABBIX_BATCH_VALUES
+from zabbixsim.encoding import AgentDataEncoder, dumps_json, encode_value_json, orjson
+from zabbixsim.generators import ValueGenerators
+from zabbixsim.headless import AsyncZabbixActive, HeadlessSim
+from zabbixsim.history import HistoryFile, HistoryReplay, HISTORY_FILE
+from zabbixsim.loader import load_sim_data
+from zabbixsim.metrics import DEVIATION_BUCKETS, METRICS, Histogram
+from zabbixsim.mockserver import MockZabbixAPI, MockZabbixServer
+from zabbixsim.passive import ZabbixPassive, passive_addresses
+from zabbixsim.protocol import PacketDecoder, PacketEncoder, encode_parts, read_payload
+from zabbixsim.scheduler import Scheduler
+from zabbixsim.shard import run_sharded
+from zabbixsim.store import ItemStore
+from zabbixsim.zabbixrec import convert_to_seconds, record, record_history
+from zabbixsim.zabbixrec import ZABBIX_RECORD_PAGE_SIZE, ZABBIX_RECORD_WORKERS
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+def synthetic_host(items: int, delay: int = 5):
+    '''Generate the items of a host, a mix of float, unsigned and character items'''
+    host_data = []
+    for item_num in range(items):
+        value_type = ('0', '3', '1')[item_num % 3]
+        host_data.append(dict(name=f'Item {item_num}',
+                              key_=f'sim.item[{item_num}]',
+                              value_type=value_type,
+                              lastvalue=f'{item_num}.5' if value_type == '0' else str(item_num),
+                              delay=delay))
+    return host_data
+
+def synthetic_data(hosts: int, items: int, delay: int = 5):
+    '''Generate active data for hosts with items each'''
+    active_data = {}
+    for host_num in range(hosts):
+        active_data[f'simhost{host_num:06}'] = synthetic_host(items, delay)
+    return active_data
+
+def synthetic_store(hosts: int, items: int, delay: int = 5):
+    '''Generate an item store for hosts with items each'''
+    store = ItemStore()
+    for host_num in range(hosts):
+        store.add_host(f'simhost{host_num:06}', synthetic_host(items, delay))
+    return store
+
+def rss_bytes():
+    '''Get the resident set size of this process'''
+    with open('/proc/self/statm', encoding="utf8") as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def rss_increase(build, *args):
+    '''Measure the RSS increase of building something'''
+    gc.collect()
+    before = rss_bytes()
+    built = build(*args)
+    gc.collect()
+    used = rss_bytes() - before
+    del built
+    return used
+
+def measure_rss(build, *args):
+    '''Measure the RSS increase of building something, in a new process'''
+    with multiprocessing.get_context('fork').Pool(1) as pool:
+        return pool.apply(rss_increase, (build,) + args)
+
+async def bench_headless(hosts: int, items: int, duration: float, keep_alive: bool = True,
+                         batch: dict = None):
+    '''Run the headless simulator against the mock server, batch has the batcher limits'''
+    mock_server = MockZabbixServer(keep_alive=keep_alive)
+    port = await mock_server.start()
+
+    active_data = synthetic_store(hosts, items)
+    zabbix_active = AsyncZabbixActive('127.0.0.1', active_data, port=port)
+    batcher = AgentDataBatcher(zabbix_active, **batch) if batch is not None else None
+    headless_sim = HeadlessSim(zabbix_active, active_data, batcher)
+    deviation = METRICS.histograms['send_deviation_seconds'] = Histogram(DEVIATION_BUCKETS)
+    skipped = METRICS.counters['checks_skipped_total']
+    started = time.process_time()
+    await headless_sim.run(duration)
+    cpu_seconds = time.process_time() - started
+    await mock_server.stop()
+
+    packets_sent, values_sent, errors = headless_sim.totals()
+    return dict(hosts=hosts,
+                items=items,
+                duration=duration,
+                batch=batch,
+                packets_per_second=packets_sent / duration,
+                values_per_second=values_sent / duration,
+                server_packets=mock_server.packets,
+                connections=mock_server.connections,
+                cpu_seconds=cpu_seconds,
+                deviation_p50_ms=quantile_ms(deviation, 0.5),
+                deviation_p99_ms=quantile_ms(deviation, 0.99),
+                deviation_p999_ms=quantile_ms(deviation, 0.999),
+                checks_skipped=METRICS.counters['checks_skipped_total'] - skipped,
+                errors=errors)
+
+def quantile_ms(histogram: Histogram, fraction: float):
+    '''Get a quantile of a histogram in ms, or None if it is empty'''
+    quantile = histogram.quantile(fraction)
+    return None if quantile is None else quantile * 1000
+
+def percentile(values: list, fraction: float):
+    '''Get a percentile of sorted values, in ms'''
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else None
+
+def free_port():
+    '''Get a free local TCP port'''
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def run_passive_server(hosts: int, items: int, port: int, ready):
+    '''Serve passive checks for synthetic hosts, one 127.x address per host'''
+    passive_data = synthetic_store(hosts, items)
+    listen, address_map = passive_addresses(list(passive_data), listen='0.0.0.0', port=port,
+                                            mode='ip')
+    zabbix_passive = ZabbixPassive(passive_data, listen, address_map)
+
+    async def serve():
+        await zabbix_passive.start()
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+async def poll_passive(addresses: list, items: int, deadline: float, latencies: list):
+    '''Poll random items of random hosts until the deadline, like a poller does'''
+    replies = []
+    while time.monotonic() < deadline:
+        address = random.choice(addresses)
+        key = f'sim.item[{random.randrange(items)}]'
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(*address)
+            writer.writelines(encode_parts(key.encode("utf-8")))
+            replies.append(await read_payload(reader))
+            writer.close()
+        except (OSError, asyncio.IncompleteReadError, ValueError) as err:
+            logging.debug('passive check failed: %s', err)
+            replies.append(None)
+            continue
+        latencies.append(time.perf_counter() - started)
+    return replies
+
+async def bench_passive(hosts: int, items: int, concurrency: int, duration: float):
+    '''Measure the passive agent request rate and latency with concurrent pollers'''
+    port = free_port()
+    context = multiprocessing.get_context('fork')
+    ready = context.Event()
+    server = context.Process(target=run_passive_server, args=(hosts, items, port, ready),
+                             daemon=True)
+    server.start()
+    try:
+        if not ready.wait(60):
+            raise RuntimeError('passive agent did not start')
+        _, address_map = passive_addresses([None] * hosts, port=port, mode='ip')
+        addresses = list(address_map)
+
+        latencies = []
+        deadline = time.monotonic() + duration
+        results = await asyncio.gather(*[poll_passive(addresses, items, deadline, latencies)
+                                         for _ in range(concurrency)])
+    finally:
+        server.terminate()
+        server.join()
+
+    replies = [reply for replies in results for reply in replies]
+    latencies.sort()
+    return dict(hosts=hosts,
+                items=items,
+                concurrency=concurrency,
+                requests_per_second=len(latencies) / duration,
+                p50_ms=percentile(latencies, 0.5),
+                p99_ms=percentile(latencies, 0.99),
+                unsupported=sum(1 for reply in replies
+                                if reply and reply.startswith(b'ZBX_NOTSUPPORTED')),
+                errors=replies.count(None))
+
+def run_mock_server(port: int, ready):
+    '''Run the mock server until terminated'''
+    async def serve():
+        await MockZabbixServer(port=port).start()
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+@contextlib.contextmanager
+def mock_server_process():
+    '''Run the mock server in its own process, yields its port'''
+    port = free_port()
+    context = multiprocessing.get_context('fork')
+    ready = context.Event()
+    server = context.Process(target=run_mock_server, args=(port, ready), daemon=True)
+    server.start()
+    try:
+        if not ready.wait(60):
+            raise RuntimeError('mock server did not start')
+        yield port
+    finally:
+        server.terminate()
+        server.join()
+
+def bench_send(items: int, duration: float):
+    '''Measure the rate and latency of ZabbixActive agent data sends, one at a time'''
+    host_data = synthetic_host(items)
+    latencies = []
+    with mock_server_process() as port:
+        zabbix_active = ZabbixActive('127.0.0.1', {}, port=port)
+        started = time.perf_counter()
+        deadline = started + duration
+        while time.perf_counter() < deadline:
+            sent = time.perf_counter()
+            zabbix_active.agent_data('simhost000000', host_data)
+            latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - started
+        zabbix_active.pool.close()
+
+    latencies.sort()
+    return dict(items=items,
+                duration=duration,
+                packets_per_second=len(latencies) / elapsed,
+                values_per_second=len(latencies) * items / elapsed,
+                p50_ms=percentile(latencies, 0.5),
+                p95_ms=percentile(latencies, 0.95),
+                p99_ms=percentile(latencies, 0.99))
+
+def bench_sharded(hosts: int, items: int, duration: float, shards: int, batch: dict = None):
+    '''Run the headless simulator in shards worker processes against the mock server'''
+    with mock_server_process() as port:
+        config = configparser.ConfigParser()
+        config['SETTINGS'] = dict(server='127.0.0.1', port=str(port))
+        if batch is not None:
+            config['SETTINGS'].update(batch='yes', batch_max_values=str(batch['max_values']),
+                                      batch_max_bytes=str(batch['max_bytes']),
+                                      batch_max_delay=str(batch['max_delay']))
+        started = time.process_time()
+        supervisor = run_sharded(config, synthetic_store(hosts, items), ItemStore(), shards,
+                                 duration)
+        cpu_seconds = time.process_time() - started
+
+    packets_sent, values_sent, errors, _ = supervisor.totals()
+    return dict(hosts=hosts,
+                items=items,
+                duration=duration,
+                shards=shards,
+                batch=batch,
+                packets_per_second=packets_sent / duration,
+                values_per_second=values_sent / duration,
+                supervisor_cpu_seconds=cpu_seconds,
+                restarts=supervisor.restarts,
+                errors=errors)
+
+def record_serial(zapi, directory: str):
+    '''Record the way zabbixrec used to, two item.get requests per host, one at a time'''
+    for host in zapi.host.get({"output": "extend"}):
+        host_items = {}
+        for section, item_type, output in (
+                ('active', '7', ["key_", "name", "type", "value_type", "lastvalue", "delay"]),
+                ('passive', '0', ["key_", "name", "value_type", "lastvalue", "delay"])):
+            items = zapi.item.get({"hostids": host['hostid'], "sortfield": "name",
+                                   "filter": {"type": item_type}, "output": output})
+            for item in items:
+                item['delay'] = convert_to_seconds(item['delay'])
+                item.pop('itemid')
+            if items:
+                host_items[section] = items
+        if host_items:
+            with open(os.path.join(directory, host['host'] + '.yaml'), 'w',
+                      encoding="utf8") as writer:
+                writer.write(yaml.dump({host['host']: host_items}, Dumper=yaml.Dumper))
+
+def bench_record(hosts: int, items: int, workers: int = ZABBIX_RECORD_WORKERS,
+                 page_size: int = ZABBIX_RECORD_PAGE_SIZE, baseline: bool = False):
+    '''Record synthetic hosts from the mock JSON-RPC server'''
+    mock_api = MockZabbixAPI(hosts, items)
+    url = mock_api.start()
+    def connect():
+        zapi = zabbix_api.ZabbixAPI(server=url)
+        zapi.login('Admin', 'zabbix')
+        return zapi
+
+    result = dict(hosts=hosts, items=items, workers=workers, page_size=page_size)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            started = time.perf_counter()
+            progress = record(connect, directory, workers, page_size)
+            elapsed = time.perf_counter() - started
+            result.update(seconds=elapsed,
+                          hosts_per_second=progress.hosts_done / elapsed,
+                          items_per_second=progress.items_done / elapsed,
+                          requests=progress.requests)
+
+        if baseline:
+            with tempfile.TemporaryDirectory() as directory:
+                mock_api.requests = 0
+                started = time.perf_counter()
+                record_serial(connect(), directory)
+                result.update(serial_seconds=time.perf_counter() - started,
+                              serial_requests=mock_api.requests)
+    finally:
+        mock_api.stop()
+    return result
+
+async def replay_history(path: str, speed: float):
+    '''Replay a history file against the mock server, returns the replay and server'''
+    mock_server = MockZabbixServer()
+    port = await mock_server.start()
+    history = HistoryFile(path)
+    zabbix_active = AsyncZabbixActive('127.0.0.1', ItemStore(), port=port)
+    replay = HistoryReplay(history, zabbix_active, ItemStore(), speed=speed)
+    try:
+        await replay.run()
+    finally:
+        history.close()
+        await mock_server.stop()
+    return replay, mock_server
+
+def bench_replay(hosts: int, items: int, period: int, speed: float,
+                 workers: int = ZABBIX_RECORD_WORKERS):
+    '''Record the history of synthetic hosts from the mock JSON-RPC server and replay it'''
+    mock_api = MockZabbixAPI(hosts, items, item_latency=0)
+    url = mock_api.start()
+    def connect():
+        zapi = zabbix_api.ZabbixAPI(server=url)
+        zapi.login('Admin', 'zabbix')
+        return zapi
+
+    result = dict(hosts=hosts, items=items, period=period, speed=speed)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            started = time.perf_counter()
+            values = record_history(connect, period, directory, workers=workers)
+            record_seconds = time.perf_counter() - started
+            path = os.path.join(directory, HISTORY_FILE)
+            result.update(values=values,
+                          record_seconds=record_seconds,
+                          record_values_per_second=values / record_seconds,
+                          file_bytes_per_value=os.path.getsize(path) / values)
+
+            gc.collect()
+            rss_before = rss_bytes()
+            started = time.perf_counter()
+            replay, mock_server = asyncio.run(replay_history(path, speed))
+            replay_seconds = time.perf_counter() - started
+            result.update(replay_seconds=replay_seconds,
+                          replay_values_per_second=replay.values_sent / replay_seconds,
+                          server_values=mock_server.values,
+                          max_lag=replay.max_lag,
+                          replay_rss_increase=rss_bytes() - rss_before,
+                          errors=replay.errors)
+    finally:
+        mock_api.stop()
+    return result
+
+GENERATOR_SPECS = (
+    dict(type='sine', amplitude=10, offset=50, period=600, noise=0.5),
+    dict(type='random_walk', step=0.5, min=0, max=100),
+    dict(type='counter', rate=1000, wrap=1 << 32),
+    dict(type='gaussian', mean=20, stddev=2),
+    dict(type='step', values=[0, 1, 1, 0], interval=30),
+    dict(type='replay', values=[3, 5, 8, 13, 21], interval=10),
+)
+
+def bench_generators(items: int, iterations: int):
+    '''Measure updating the values of items with generators, against one callback per item'''
+    store = ItemStore()
+    host_items = []
+    for item_num in range(items):
+        host_items.append(dict(name=f'Item {item_num}',
+                               key_=f'sim.item[{item_num}]',
+                               value_type=3 if item_num % 3 == 2 else 0,
+                               lastvalue='0',
+                               delay=60,
+                               generator=GENERATOR_SPECS[item_num % len(GENERATOR_SPECS)]))
+    store.add_host('simhost000000', host_items)
+
+    value_generators = ValueGenerators(store, seed=1)
+    started = time.perf_counter()
+    value_generators.update()
+    sync_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        value_generators.update()
+    update_seconds = (time.perf_counter() - started) / iterations
+
+    # One Python callback per item, for the sine items only
+    sine_rows = [row for row, spec in store.generators.items() if spec['type'] == 'sine']
+    started = time.perf_counter()
+    now = time.time()
+    for row in sine_rows:
+        spec = store.generators[row]
+        store.set_value(row, spec['offset'] + spec['amplitude'] *
+                        math.sin(2 * math.pi * now / spec['period']) +
+                        random.gauss(0, spec['noise']))
+    callback_seconds = (time.perf_counter() - started) * items / len(sine_rows)
+
+    return dict(items=items,
+                sync_ms=sync_seconds * 1000,
+                update_ms=update_seconds * 1000,
+                items_per_second=items / update_seconds,
+                callback_update_ms=callback_seconds * 1000)
+
+def bench_serialize(items: int, iterations: int):
+    '''Measure the agent data encoding rate, from message dicts and from pre-encoded fragments
+
+    Both are encoded with the standard library, and with orjson too when
+    it is installed. The speedup is of the fastest fragments over the
+    message dicts with json.dumps, as the values were encoded before.
+    '''
+    zabbix_active = ZabbixActive('127.0.0.1', {})
+    due_items = list(synthetic_store(1, items)['simhost000000'])
+    clock = time.time_ns()
+    encoders = dict(dict_json=lambda: dumps_json(
+        zabbix_active.agent_data_message('simhost000000', due_items)))
+    fragments = dict(fragments_json=AgentDataEncoder(encode_value_json))
+    if orjson is not None:
+        encoders['dict_orjson'] = lambda: orjson.dumps(
+            zabbix_active.agent_data_message('simhost000000', due_items))
+        fragments['fragments_orjson'] = AgentDataEncoder(orjson.dumps)
+    for name, encoder in fragments.items():
+        encoders[name] = functools.partial(encoder.host_payload, '0' * 32, clock,
+                                           'simhost000000', due_items, clock)
+
+    result = dict(items=items, orjson=orjson is not None)
+    for name, encode in encoders.items():
+        payload = encode()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            encode()
+        seconds = time.perf_counter() - started
+        result[f'{name}_values_per_second'] = items * iterations / seconds
+        result[f'{name}_payload_bytes'] = len(payload)
+    result['speedup'] = max(result[f'{name}_values_per_second'] for name in fragments) / \
+        result['dict_json_values_per_second']
+    return result
+
+def bench_codec(items: int, iterations: int, compress: bool = False, segment: int = 1460):
+    '''Measure the ZBXD encode and decode throughput for an agent data packet'''
+    zabbix_active = ZabbixActive('127.0.0.1', {})
+    host_data = synthetic_host(items)
+    payload = json.dumps(zabbix_active.agent_data_message('simhost000000', host_data),
+                         sort_keys=False).encode("utf-8")
+
+    encoder = PacketEncoder(compress=compress)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        packet = encoder.encode(payload)
+    encode_seconds = time.perf_counter() - started
+    packet = bytes(packet)
+
+    # Decode the packet as it would arrive, in TCP sized segments
+    segments = [packet[offset:offset + segment] for offset in range(0, len(packet), segment)]
+    decoder = PacketDecoder()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        decoder.reset()
+        for data in segments:
+            decoder.feed(data)
+        decoder.payload()
+    decode_seconds = time.perf_counter() - started
+
+    megabytes = len(payload) * iterations / 1e6
+    return dict(items=items,
+                payload_bytes=len(payload),
+                packet_bytes=len(packet),
+                compress=compress,
+                encode_packets_per_second=iterations / encode_seconds,
+                encode_mb_per_second=megabytes / encode_seconds,
+                decode_packets_per_second=iterations / decode_seconds,
+                decode_mb_per_second=megabytes / decode_seconds)
+
+def bench_memory(hosts: int, items: int):
+    '''Measure the memory per item, as YAML dictionaries and in the item store'''
+    dict_bytes = measure_rss(synthetic_data, hosts, items)
+    store_bytes = measure_rss(synthetic_store, hosts, items)
+    total = hosts * items
+    return dict(hosts=hosts,
+                items=total,
+                dict_rss_mb=dict_bytes / 1e6,
+                store_rss_mb=store_bytes / 1e6,
+                dict_bytes_per_item=dict_bytes / total,
+                store_bytes_per_item=store_bytes / total)
+
+def write_sim_files(directory: str, hosts: int, items: int):
+    '''Write a simulation file per host, as zabbixrec does'''
+    for host_num in range(hosts):
+        hostname = f'simhost{host_num:06}'
+        with open(os.path.join(directory, hostname + '.yaml'), 'w', encoding="utf8") as writer:
+            writer.write(yaml.dump({hostname: {'active': synthetic_host(items)}},
+                                   Dumper=getattr(yaml, 'CDumper', yaml.Dumper)))
+
+def bench_load(hosts: int, items: int, workers: int = None):
+    '''Measure the time to load the simulation files'''
+    with tempfile.TemporaryDirectory() as directory:
+        write_sim_files(directory, hosts, items)
+
+        # The previous approach, each file fully parsed with the pure Python loader
+        started = time.perf_counter()
+        for filename in glob.glob(os.path.join(directory, "*.yaml")):
+            with open(filename, encoding="utf8") as file:
+                yaml.load(file, Loader=yaml.Loader)
+        python_loader_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        load_sim_data(directory, workers=workers)
+        parse_seconds = time.perf_counter() - started
+
+        load_sim_data(directory, snapshot=True, workers=workers)
+        started = time.perf_counter()
+        active_data, _, _ = load_sim_data(directory, snapshot=True, workers=workers)
+        snapshot_seconds = time.perf_counter() - started
+
+        # Unpack every host, as the simulator does when they are first scheduled
+        started = time.perf_counter()
+        for host_data in active_data.values():
+            len(host_data)
+        unpack_seconds = time.perf_counter() - started
+
+    return dict(hosts=hosts,
+                items=hosts * items,
+                python_loader_seconds=python_loader_seconds,
+                parse_seconds=parse_seconds,
+                snapshot_seconds=snapshot_seconds,
+                unpack_all_seconds=unpack_seconds)
+
+def bench_scheduler(items: int, seconds: int, tick: float = 1):
+    '''Measure the scheduler tick cost, against counting down every item each tick'''
+    delays = [7, 10, 30, 60, 300, 600, 3600]
+    scheduler = Scheduler()
+    for key in range(items):
+        scheduler.schedule(key, delays[key % len(delays)], random.uniform(0, 60))
+
+    due_count = 0
+    now = 60.0
+    started = time.perf_counter()
+    for _ in range(int(seconds / tick)):
+        now += tick
+        due_count += len(scheduler.pop_due(now))
+    scheduler_seconds = time.perf_counter() - started
+
+    # The previous approach, every item is visited on every tick
+    host_data = [dict(delay=delays[key % len(delays)], current_delay=0) for key in range(items)]
+    started = time.perf_counter()
+    for item in host_data:
+        if item['current_delay'] <= 0:
+            item['current_delay'] = item['delay']
+        else:
+            item['current_delay'] = item['current_delay'] - int(tick)
+    countdown_tick_seconds = time.perf_counter() - started
+
+    ticks = int(seconds / tick)
+    return dict(items=items,
+                ticks=ticks,
+                due=due_count,
+                tick_ms=scheduler_seconds / ticks * 1000,
+                due_item_us=scheduler_seconds / max(due_count, 1) * 1e6,
+                countdown_tick_ms=countdown_tick_seconds * 1000)
+
+# The benchmarks run by the suite command, a quick check of every area. Memory
+# is measured first, before the other benchmarks have grown the heap.
+BENCHMARK_SUITE = (
+    ['memory', '--hosts', '1000', '--items', '50'],
+    ['send', '--items', '20', '--duration', '5'],
+    ['headless', '--hosts', '2000', '--items', '20', '--duration', '10'],
+    ['codec', '--items', '1000', '--iterations', '500'],
+    ['serialize', '--items', '1000', '--iterations', '200'],
+    ['scheduler', '--items', '200000', '--seconds', '60'],
+    ['load', '--hosts', '500', '--items', '50'],
+)
+
+# Change in a metric that counts as a regression
+BENCHMARK_TOLERANCE = 0.1
+
+def build_parser():
+    '''Build the command line parser, with a subcommand for each benchmark'''
+    parser = argparse.ArgumentParser(description='Zabbix Agent simulator benchmarks')
+    parser.add_argument('--json', metavar='FILE',
+                        help='append each result to FILE as a line of JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with the last matching results in FILE, '
+                             'exit with 1 on a regression')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    subparsers.add_parser('suite', help='run a quick benchmark of every area')
+
+    send_parser = subparsers.add_parser('send', help='ZabbixActive send rate and latency')
+    send_parser.add_argument('--items', type=int, default=20)
+    send_parser.add_argument('--duration', type=float, default=10)
+
+    headless_parser = subparsers.add_parser('headless', help='headless simulator throughput')
+    headless_parser.add_argument('--hosts', type=int, default=5000)
+    headless_parser.add_argument('--items', type=int, default=20)
+    headless_parser.add_argument('--duration', type=float, default=30)
+    headless_parser.add_argument('--close', action='store_true',
+                                 help='mock server closes the connection after each response')
+    headless_parser.add_argument('--batch', action='store_true',
+                                 help='combine the values of many hosts into each packet')
+    headless_parser.add_argument('--batch-max-values', type=int, default=ZABBIX_BATCH_VALUES)
+    headless_parser.add_argument('--batch-max-bytes', type=int, default=ZABBIX_BATCH_BYTES)
+    headless_parser.add_argument('--batch-max-delay', type=float, default=ZABBIX_BATCH_DELAY)
+    headless_parser.add_argument('--shards', type=int, default=1,
+                                 help='worker processes, the mock server runs in its own process')
+
+    codec_parser = subparsers.add_parser('codec', help='ZBXD encode and decode throughput')
+    codec_parser.add_argument('--items', type=int, default=1000)
+    codec_parser.add_argument('--iterations', type=int, default=2000)
+    codec_parser.add_argument('--compress', action='store_true')
+
+    serialize_parser = subparsers.add_parser('serialize', help='agent data encoding rate')
+    serialize_parser.add_argument('--items', type=int, default=1000)
+    serialize_parser.add_argument('--iterations', type=int, default=1000)
+
+    scheduler_parser = subparsers.add_parser('scheduler', help='scheduler tick cost')
+    scheduler_parser.add_argument('--items', type=int, default=1000000)
+    scheduler_parser.add_argument('--seconds', type=int, default=300)
+
+    memory_parser = subparsers.add_parser('memory', help='memory per simulated item')
+    memory_parser.add_argument('--hosts', type=int, default=5000)
+    memory_parser.add_argument('--items', type=int, default=100)
+
+    passive_parser = subparsers.add_parser('passive', help='passive agent request rate')
+    passive_parser.add_argument('--hosts', type=int, default=1000)
+    passive_parser.add_argument('--items', type=int, default=100)
+    passive_parser.add_argument('--concurrency', type=int, default=200)
+    passive_parser.add_argument('--duration', type=float, default=10)
+
+    record_parser = subparsers.add_parser('record', help='zabbixrec recording rate')
+    record_parser.add_argument('--hosts', type=int, default=2000)
+    record_parser.add_argument('--items', type=int, default=100)
+    record_parser.add_argument('--workers', type=int, default=ZABBIX_RECORD_WORKERS)
+    record_parser.add_argument('--page-size', type=int, default=ZABBIX_RECORD_PAGE_SIZE)
+    record_parser.add_argument('--baseline', action='store_true',
+                               help='also record serially, one host at a time')
+
+    replay_parser = subparsers.add_parser('replay', help='history record and replay rate')
+    replay_parser.add_argument('--hosts', type=int, default=100)
+    replay_parser.add_argument('--items', type=int, default=20)
+    replay_parser.add_argument('--period', default='1d', help='history to record, such as 1d')
+    replay_parser.add_argument('--speed', type=float, default=3600)
+    replay_parser.add_argument('--workers', type=int, default=ZABBIX_RECORD_WORKERS)
+
+    generators_parser = subparsers.add_parser('generators', help='value generator update cost')
+    generators_parser.add_argument('--items', type=int, default=1000000)
+    generators_parser.add_argument('--iterations', type=int, default=20)
+
+    load_parser = subparsers.add_parser('load', help='simulation file load time')
+    load_parser.add_argument('--hosts', type=int, default=2000)
+    load_parser.add_argument('--items', type=int, default=100)
+    load_parser.add_argument('--workers', type=int, default=None)
+    return parser
+
+def run_benchmark(args):
+    '''Run the benchmark selected by the parsed arguments, returns its result'''
+    # pylint: disable=too-many-branches
+    if args.benchmark == 'headless':
+        batch = None
+        if args.batch:
+            batch = dict(max_values=args.batch_max_values, max_bytes=args.batch_max_bytes,
+                         max_delay=args.batch_max_delay)
+        if args.shards > 1:
+            result = bench_sharded(args.hosts, args.items, args.duration, args.shards, batch)
+        else:
+            result = asyncio.run(bench_headless(args.hosts, args.items, args.duration,
+                                                keep_alive=not args.close, batch=batch))
+    elif args.benchmark == 'send':
+        result = bench_send(args.items, args.duration)
+    elif args.benchmark == 'passive':
+        result = asyncio.run(bench_passive(args.hosts, args.items, args.concurrency,
+                                           args.duration))
+    elif args.benchmark == 'record':
+        result = bench_record(args.hosts, args.items, args.workers, args.page_size,
+                              args.baseline)
+    elif args.benchmark == 'replay':
+        result = bench_replay(args.hosts, args.items, convert_to_seconds(args.period),
+                              args.speed, args.workers)
+    elif args.benchmark == 'generators':
+        result = bench_generators(args.items, args.iterations)
+    elif args.benchmark == 'codec':
+        result = bench_codec(args.items, args.iterations, args.compress)
+    elif args.benchmark == 'serialize':
+        result = bench_serialize(args.items, args.iterations)
+    elif args.benchmark == 'scheduler':
+        result = bench_scheduler(args.items, args.seconds)
+    elif args.benchmark == 'memory':
+        result = bench_memory(args.hosts, args.items)
+    elif args.benchmark == 'load':
+        result = bench_load(args.hosts, args.items, args.workers)
+    return result
+
+def benchmark_record(args, result: dict):
+    '''Build the machine readable record of a result, with its parameters and platform'''
+    parameters = {name: value for name, value in vars(args).items()
+                  if name not in ('benchmark', 'json', 'compare')}
+    return dict(benchmark=args.benchmark,
+                time=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                cpus=os.cpu_count(),
+                parameters=parameters,
+                result=result)
+
+def read_records(path: str):
+    '''Read the records of a JSON lines results file'''
+    with open(path, encoding="utf8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def compare_record(record: dict, baseline: list, tolerance: float = BENCHMARK_TOLERANCE):
+    '''Log the change in each metric from the last baseline run, returns the regressions
+
+    Rates are better higher, and times, latencies and sizes better lower.
+    '''
+    previous = [old for old in baseline if old['benchmark'] == record['benchmark'] and
+                old['parameters'] == record['parameters']]
+    if not previous:
+        logging.info('%s: no baseline', record['benchmark'])
+        return []
+
+    regressions = []
+    for metric, value in record['result'].items():
+        old_value = previous[-1]['result'].get(metric)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+                not isinstance(old_value, (int, float)) or not old_value:
+            continue
+        if metric.endswith('_per_second'):
+            worse = value < old_value * (1 - tolerance)
+        elif metric.endswith(('_ms', '_us', '_seconds', '_bytes', '_mb', '_per_item', '_per_value')):
+            worse = value > old_value * (1 + tolerance)
+        else:
+            continue
+        change = (value - old_value) / old_value * 100
+        logging.info('%s %s: %.6g -> %.6g (%+.1f%%)%s', record['benchmark'], metric,
+                     old_value, value, change, ' REGRESSION' if worse else '')
+        if worse:
+            regressions.append((record['benchmark'], metric))
+    return regressions
+
+def main():
+    """Main for Zabbix Simulator benchmarks"""
+    parser = build_parser()
+    args = parser.parse_args()
+    baseline = read_records(args.compare) if args.compare else None
+
+    runs = [args]
+    if args.benchmark == 'suite':
+        runs = [parser.parse_args(argv) for argv in BENCHMARK_SUITE]
+
+    regressions = []
+    for run_args in runs:
+        record = benchmark_record(run_args, run_benchmark(run_args))
+        logging.info('%s', json.dumps(record))
+        if args.json:
+            with open(args.json, 'a', encoding="utf8") as file:
+                file.write(json.dumps(record) + '\n')
+        if baseline is not None:
+            regressions += compare_record(record, baseline)
+
+    if regressions:
+        logging.warning('%d regressions: %s', len(regressions), regressions)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+#
+# Buffer values while the Zabbix server is slow or down
+#
+
+"""Durable send buffer"""
+import asyncio
+import collections
+import glob
+import itertools
+import logging
+import os
+import random
+import time
+from zabbixsim.batch import agent_data_payload, value_fragments, ZABBIX_BATCH_VALUES
+from zabbixsim.metrics import METRICS
+
+ZABBIX_BUFFER_SIZE = 100000
+ZABBIX_BUFFER_SEND = 5
+ZABBIX_BUFFER_SPILL_SIZE = 1 << 30
+ZABBIX_BUFFER_PIPELINE = 8
+ZABBIX_RETRY_MIN = 1.0
+ZABBIX_RETRY_MAX = 60.0
+
+# At most one warning about values a full buffer refused every interval, in seconds
+ZABBIX_BUFFER_WARN_INTERVAL = 10.0
+
+# What to do with new values when the buffer is full
+BUFFER_DROP = 'drop'
+BUFFER_BLOCK = 'block'
+
+SPILL_SUFFIX = '.spill'
+
+class SendBuffer():
+    """Bounded first in, first out buffer of encoded values
+
+    Values are kept in memory up to max_values. With a spill directory the
+    oldest half is then written to a spill segment file, and segments are
+    sent oldest first before the values in memory. A segment file is only
+    removed once all its values are sent, and segments left by an earlier
+    run are sent first, so values survive a restart. When the buffer is
+    full the oldest values are dropped with the drop policy, or new values
+    are refused with the block policy so the caller can slow down.
+
+    Values being sent are taken out of the buffer, and put back in front
+    if the send fails, so dropping and spilling never touch them. Values
+    put back after newer values were spilled are written in front of the
+    oldest segment, so values are always sent oldest first.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, max_values: int = ZABBIX_BUFFER_SIZE, spill_dir: str = None,
+                 max_spill_bytes: int = ZABBIX_BUFFER_SPILL_SIZE, policy: str = BUFFER_DROP):
+        if policy not in (BUFFER_DROP, BUFFER_BLOCK):
+            raise ValueError(f'unknown buffer policy {policy}')
+        self.max_values = max_values
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.policy = policy
+
+        # Newest values in memory, the values of the segment being sent and
+        # the segments on disk as [path, values, bytes], oldest first
+        self.values = collections.deque()
+        self.loaded = collections.deque()
+        self.loaded_path = None
+        self.segments = collections.deque()
+        self.spill_values = 0
+        self.spill_bytes = 0
+        self.segment_number = 0
+        self.taken = 0
+        self.dropped = 0
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            for path in sorted(glob.glob(os.path.join(spill_dir, '*' + SPILL_SUFFIX))):
+                with open(path, 'rb') as file:
+                    count = sum(1 for line in file if line.strip())
+                self.add_segment(path, count, os.path.getsize(path))
+                self.segment_number = int(os.path.basename(path)[:-len(SPILL_SUFFIX)]) + 1
+            if self.segments:
+                logging.info('buffer: %d values left in %s', self.spill_values, spill_dir)
+
+    def __len__(self):
+        return self.spill_values + len(self.loaded) + len(self.values) + self.taken
+
+    def add_segment(self, path: str, count: int, size: int):
+        '''Account for a spill segment'''
+        self.segments.append([path, count, size])
+        self.spill_values += count
+        self.spill_bytes += size
+
+    def drop_segment(self):
+        '''Remove the oldest segment not being sent, returns the values it held'''
+        index = 1 if self.loaded_path else 0
+        path, count, size = self.segments[index]
+        del self.segments[index]
+        self.spill_values -= count
+        self.spill_bytes -= size
+        os.remove(path)
+        return count
+
+    def count_dropped(self, count: int):
+        '''Count values dropped because the buffer was full'''
+        self.dropped += count
+        METRICS.counters['buffer_dropped_total'] += count
+
+    def spill(self, count: int):
+        '''Write the oldest count values in memory to a new segment, False if there is no room'''
+        data = b'\n'.join(itertools.islice(self.values, count)) + b'\n'
+        while self.spill_bytes + len(data) > self.max_spill_bytes:
+            if self.policy == BUFFER_BLOCK or len(self.segments) <= bool(self.loaded_path):
+                return False
+            self.count_dropped(self.drop_segment())
+
+        path = os.path.join(self.spill_dir, f'{self.segment_number:012}{SPILL_SUFFIX}')
+        self.segment_number += 1
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(path + '.tmp', path)
+        self.add_segment(path, count, len(data))
+        for _ in range(count):
+            self.values.popleft()
+        return True
+
+    def add(self, fragments: list):
+        '''Add encoded values, returns False if they were refused because the buffer is full'''
+        if self.values and len(self.values) + len(fragments) > self.max_values:
+            room = bool(self.spill_dir) and self.spill(max(len(self.values) // 2, 1))
+            if not room:
+                if self.policy == BUFFER_BLOCK:
+                    return False
+                overflow = len(self.values) + len(fragments) - self.max_values
+                overflow = min(overflow, len(self.values))
+                for _ in range(overflow):
+                    self.values.popleft()
+                self.count_dropped(overflow)
+        self.values.extend(fragments)
+        return True
+
+    def take(self, count: int):
+        '''Take up to count of the oldest values to send, to be acked or put back'''
+        if not self.loaded and not self.loaded_path and self.segments:
+            path, segment_values, _ = self.segments[0]
+            with open(path, 'rb') as file:
+                self.loaded.extend(line for line in file.read().split(b'\n') if line)
+            self.loaded_path = path
+            self.spill_values -= segment_values
+
+        source = self.loaded if self.loaded_path else self.values
+        fragments = [source.popleft() for _ in range(min(count, len(source)))]
+        self.taken += len(fragments)
+        return fragments
+
+    def ack(self, fragments: list):
+        '''The taken values were sent, removing the segment they came from once it is sent'''
+        self.taken -= len(fragments)
+        if self.loaded_path and not self.loaded and not self.taken:
+            path, _, size = self.segments.popleft()
+            self.spill_bytes -= size
+            os.remove(path)
+            self.loaded_path = None
+
+    def put_back(self, fragments: list):
+        '''The taken values were not sent, put them back to be sent first'''
+        self.taken -= len(fragments)
+        if self.loaded_path:
+            self.loaded.extendleft(reversed(fragments))
+        elif self.segments:
+            # Values were spilled while these were sent from memory, and are newer
+            self.prepend_segment(fragments)
+        else:
+            self.values.extendleft(reversed(fragments))
+
+    def prepend_segment(self, fragments: list):
+        '''Write values in front of the oldest segment, which is not being sent'''
+        segment = self.segments[0]
+        path = segment[0]
+        data = b''.join(fragment + b'\n' for fragment in fragments)
+        with open(path, 'rb') as file:
+            old_data = file.read()
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data + old_data)
+        os.replace(path + '.tmp', path)
+        segment[1] += len(fragments)
+        segment[2] += len(data)
+        self.spill_values += len(fragments)
+        self.spill_bytes += len(data)
+
+    def close(self):
+        '''Write the values still buffered to disk, to be sent by the next run
+
+        Without a spill directory the values still buffered are dropped.
+        '''
+        if not self.spill_dir:
+            if self.values:
+                logging.warning('buffer: %d values dropped, there is no spill directory',
+                                len(self.values))
+                self.count_dropped(len(self.values))
+                self.values.clear()
+            return
+        if self.loaded_path:
+            # The segment being sent is rewritten with only its unsent values
+            path = self.loaded_path
+            with open(path + '.tmp', 'wb') as file:
+                file.write(b''.join(fragment + b'\n' for fragment in self.loaded))
+            os.replace(path + '.tmp', path)
+            self.loaded.clear()
+        if self.values and not self.spill(len(self.values)):
+            logging.warning('buffer: no room to keep %d values', len(self.values))
+            self.count_dropped(len(self.values))
+            self.values.clear()
+
+class BufferSender():
+    """Send the values of a SendBuffer, retrying with exponential backoff
+
+    A packet is sent when packet_values values are buffered, or every
+    send_interval seconds, like the agent BufferSize and BufferSend.
+    While the buffer holds more than a packet, up to pipeline packets
+    are sent back to back on one connection to catch up. When a send
+    fails its values stay buffered and are sent again after a backoff
+    that doubles up to retry_max, so values may be delivered more than
+    once but are not lost.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, zabbix_active, buffer: SendBuffer,
+                 packet_values: int = ZABBIX_BATCH_VALUES,
+                 send_interval: float = ZABBIX_BUFFER_SEND,
+                 retry_min: float = ZABBIX_RETRY_MIN, retry_max: float = ZABBIX_RETRY_MAX,
+                 pipeline: int = ZABBIX_BUFFER_PIPELINE):
+        # pylint: disable=too-many-arguments
+        self.zabbix_active = zabbix_active
+        self.buffer = buffer
+        self.packet_values = packet_values
+        self.send_interval = send_interval
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.pipeline = pipeline
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.task = None
+
+        # Throughput counters
+        self.packets_sent = 0
+        self.values_sent = 0
+        self.errors = 0
+
+    async def put(self, hostname: str, due_items: list, stamps: list = None):
+        '''Buffer the due values of a host, waiting for room with the block policy'''
+        fragments = value_fragments(hostname, due_items, stamps)
+        while not self.buffer.add(fragments):
+            self.space.clear()
+            await self.space.wait()
+        if len(self.buffer) >= self.packet_values:
+            self.ready.set()
+
+    async def send(self):
+        '''Send the oldest buffered values, returns the number sent'''
+        fragments = self.buffer.take(self.packet_values * self.pipeline)
+        if not fragments:
+            return 0
+        packet_values = self.packet_values
+        messages = [agent_data_payload(self.zabbix_active, fragments[start:start + packet_values])
+                    for start in range(0, len(fragments), packet_values)]
+        try:
+            await self.zabbix_active.send_messages(messages)
+        except BaseException:
+            self.buffer.put_back(fragments)
+            raise
+        self.buffer.ack(fragments)
+        self.space.set()
+        self.packets_sent += len(messages)
+        self.values_sent += len(fragments)
+        METRICS.counters['values_sent_total'] += len(fragments)
+        return len(fragments)
+
+    async def run(self):
+        '''Send the buffered values until cancelled'''
+        retry_delay = self.retry_min
+        while True:
+            if len(self.buffer) < self.packet_values:
+                try:
+                    await asyncio.wait_for(self.ready.wait(), self.send_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.ready.clear()
+
+            try:
+                while await self.send() >= self.packet_values:
+                    pass
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    ValueError) as err:
+                self.errors += 1
+                METRICS.counters['buffer_errors_total'] += 1
+                logging.warning('buffer: send failed, %d values buffered, retry in %.1fs: %s',
+                                len(self.buffer), retry_delay, err)
+                await asyncio.sleep(retry_delay * random.uniform(0.5, 1))
+                retry_delay = min(retry_delay * 2, self.retry_max)
+                continue
+            retry_delay = self.retry_min
+
+    def start(self):
+        '''Start sending in the background'''
+        self.task = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        '''Stop sending, trying once to send what is buffered and spilling the rest'''
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        try:
+            while await self.send():
+                pass
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as err:
+            logging.warning('buffer: %d values not sent: %s', len(self.buffer), err)
+        self.buffer.close()
+        if self.buffer.dropped:
+            logging.warning('buffer: %d values dropped', self.buffer.dropped)
+
+def send_buffered(zabbix_active, buffer: SendBuffer, packet_values: int = ZABBIX_BATCH_VALUES):
+    '''Send the buffered values with a blocking ZabbixActive, returns the number sent
+
+    Raises the send error with the unsent values still buffered.
+    '''
+    sent = 0
+    while True:
+        fragments = buffer.take(packet_values)
+        if not fragments:
+            return sent
+        try:
+            zabbix_active.send_message(agent_data_payload(zabbix_active, fragments))
+        except BaseException:
+            buffer.put_back(fragments)
+            raise
+        buffer.ack(fragments)
+        METRICS.counters['values_sent_total'] += len(fragments)
+        sent += len(fragments)
+
+class BlockingBufferSender():
+    """Send the values of a SendBuffer with a blocking ZabbixActive
+
+    Like BufferSender for a caller without an event loop, such as the Tk
+    interface. flush sends what is buffered, and after a failed send
+    waits a backoff that doubles up to retry_max before sending again.
+    The caller cannot wait for room, so with the block policy the values
+    a full buffer refuses are dropped, counted and warned about.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, zabbix_active, buffer: SendBuffer,
+                 packet_values: int = ZABBIX_BATCH_VALUES,
+                 retry_min: float = ZABBIX_RETRY_MIN, retry_max: float = ZABBIX_RETRY_MAX):
+        # pylint: disable=too-many-arguments
+        self.zabbix_active = zabbix_active
+        self.buffer = buffer
+        self.packet_values = packet_values
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.retry_delay = retry_min
+        self.retry_at = 0.0
+
+        # Values refused since the last warning
+        self.refused = 0
+        self.warn_at = 0.0
+
+    def put(self, hostname: str, due_items: list, stamps: list = None):
+        '''Buffer the due values of a host'''
+        fragments = value_fragments(hostname, due_items, stamps)
+        if self.buffer.add(fragments):
+            return
+        self.buffer.count_dropped(len(fragments))
+        self.refused += len(fragments)
+        now = time.monotonic()
+        if now >= self.warn_at:
+            logging.warning('buffer: full, %d values dropped', self.refused)
+            self.refused = 0
+            self.warn_at = now + ZABBIX_BUFFER_WARN_INTERVAL
+
+    def flush(self, now: float):
+        '''Send the buffered values, unless waiting to retry after a failed send'''
+        if now < self.retry_at:
+            return
+        try:
+            send_buffered(self.zabbix_active, self.buffer, self.packet_values)
+        except (OSError, ValueError) as err:
+            METRICS.counters['buffer_errors_total'] += 1
+            logging.warning('buffer: send failed, %d values buffered, retry in %.1fs: %s',
+                            len(self.buffer), self.retry_delay, err)
+            self.retry_at = now + self.retry_delay * random.uniform(0.5, 1)
+            self.retry_delay = min(self.retry_delay * 2, self.retry_max)
+            return
+        self.retry_delay = self.retry_min
+
+def buffer_from_config(config, name: str = None):
+    '''Create the send buffer from the config, or None if it is not enabled
+
+    With name the values are spilled to that subdirectory of the spill directory.
+    '''
+    if not config.getboolean('SETTINGS', 'buffer', fallback=False):
+        return None
+    spill_size = config.getint('SETTINGS', 'buffer_spill_mb', fallback=0)
+    spill_dir = config.get('SETTINGS', 'buffer_spill_dir', fallback=None)
+    if spill_dir and name:
+        spill_dir = os.path.join(spill_dir, name)
+    return SendBuffer(
+        max_values=config.getint('SETTINGS', 'buffer_size', fallback=ZABBIX_BUFFER_SIZE),
+        spill_dir=spill_dir,
+        max_spill_bytes=spill_size << 20 if spill_size else ZABBIX_BUFFER_SPILL_SIZE,
+        policy=config.get('SETTINGS', 'buffer_policy', fallback=BUFFER_DROP))
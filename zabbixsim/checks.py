@@ -0,0 +1,135 @@
+#
+# Cache the active checks returned by the server
+#
+
+"""Active checks cache"""
+import logging
+import random
+import zlib
+
+# Refreshes are spread over the refresh interval, each moved by up to this
+# fraction of the interval either way
+ZABBIX_REFRESH_JITTER = 0.05
+
+DELAY_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_delay(delay):
+    '''Convert the delay of an active check to seconds, or None if it is not known
+
+    The delay is a number of seconds in older servers and a time suffixed
+    string in newer ones, where flexible intervals follow the default
+    delay after a ';'. User macros that the server did not resolve are
+    not known.
+    '''
+    if isinstance(delay, (int, float)):
+        return int(delay)
+    delay = str(delay).split(';', 1)[0].strip()
+    try:
+        if delay and delay[-1] in DELAY_UNITS:
+            return int(delay[:-1]) * DELAY_UNITS[delay[-1]]
+        return int(delay)
+    except ValueError:
+        return None
+
+def refresh_offset(hostname: str, interval: float):
+    '''Get where in the refresh interval a host refreshes its checks
+
+    The offset comes from a hash of the hostname, so hosts are spread
+    evenly over the interval, and each host keeps its offset across
+    restarts and in whichever shard runs it.
+    '''
+    return zlib.crc32(hostname.encode("utf-8")) / 0x100000000 * interval
+
+def first_refresh_slot(hostname: str, now: float, interval: float):
+    '''Get the first refresh slot of a host after now'''
+    offset = refresh_offset(hostname, interval)
+    return offset + ((now - offset) // interval + 1) * interval
+
+def jittered(slot: float, interval: float, jitter: float = ZABBIX_REFRESH_JITTER):
+    '''Move a refresh slot by a random jitter'''
+    return slot + random.uniform(-jitter, jitter) * interval
+
+class ActiveChecks():
+    """The active checks the server returned for each host
+
+    Each host's checks are kept as key to delay, and updating a host
+    returns what changed since the last refresh, so only the changed items
+    are rescheduled.
+    """
+
+    def __init__(self):
+        self.hosts = {}
+
+    def __contains__(self, hostname):
+        return hostname in self.hosts
+
+    def get(self, hostname: str):
+        '''Get the cached checks of a host, or None if it was not refreshed'''
+        return self.hosts.get(hostname)
+
+    def remove(self, hostname: str):
+        '''Forget the checks of a host'''
+        self.hosts.pop(hostname, None)
+
+    def update(self, hostname: str, data: list):
+        '''Cache the checks from an active checks response
+
+        Returns the (changed, removed) keys, where changed maps each added
+        or changed key to its delay, or None on the first update
+        of a host. Checks with a delay that is not known are left out.
+        '''
+        checks = {}
+        for check in data:
+            delay = parse_delay(check.get('delay', 0))
+            if 'key' in check and delay is not None:
+                checks[check['key']] = delay
+
+        old_checks = self.hosts.get(hostname)
+        self.hosts[hostname] = checks
+        if old_checks is None:
+            return None
+        changed = {key: check for key, check in checks.items() if old_checks.get(key) != check}
+        removed = [key for key in old_checks if key not in checks]
+        return changed, removed
+
+def apply_checks(scheduler, store, hostname: str, checks: ActiveChecks, delta, now: float):
+    '''Schedule the items of a host on the delays of its active checks
+
+    delta is what ActiveChecks.update returned, with None every item of
+    the host is scheduled from its checks. Only items in the simulation
+    file can be sent, and only those the server asked for are. New items
+    are spread over their first delay, an item with a shorter delay is
+    due after it if that is sooner, like reschedule_host.
+    '''
+    # pylint: disable=too-many-arguments
+    host_checks = checks.get(hostname)
+    if host_checks is None or hostname not in store or delta == ({}, []):
+        return
+    rows = store.key_rows(hostname)
+    if delta is None:
+        changed = host_checks
+        removed = [key for key in rows if key not in host_checks]
+    else:
+        changed, removed = delta
+
+    for key in removed:
+        row = rows.get(key)
+        if row is not None:
+            scheduler.unschedule(row)
+
+    unknown = 0
+    for key, delay in changed.items():
+        row = rows.get(key)
+        if row is None:
+            unknown += 1
+            continue
+        if scheduler.delay(row) == delay:
+            continue
+        due = scheduler.due(row)
+        if due is None:
+            due = now + random.uniform(0, delay)
+        else:
+            due = min(due, now + delay)
+        scheduler.schedule(row, delay, due)
+    if unknown:
+        logging.debug('%s: %d active checks are not in the simulation file', hostname, unknown)
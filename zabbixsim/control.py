@@ -0,0 +1,231 @@
+#
+# Local control API to read and set the simulated items
+#
+
+"""Control API"""
+import asyncio
+import logging
+import urllib.parse
+from zabbixsim.encoding import dumps, loads
+from zabbixsim.metrics import start_loop_thread
+from zabbixsim.store import VALUE_TYPE_FLOAT, VALUE_TYPE_UNSIGNED
+
+ZABBIX_CONTROL_LISTEN = '127.0.0.1'
+ZABBIX_CONTROL_TIMEOUT = 5
+ZABBIX_CONTROL_MAX_BODY = 64 << 20
+
+# How often the Tk interface runs the waiting control requests, in seconds
+ZABBIX_CONTROL_POLL = 0.1
+
+def check_value(value_type: int, value):
+    '''Raise ValueError if a value does not parse as a value of value_type'''
+    if isinstance(value, (bool, dict, list)) or value is None:
+        raise ValueError(f'{value!r} is not an item value')
+    try:
+        if value_type == VALUE_TYPE_FLOAT:
+            float(value)
+        elif value_type == VALUE_TYPE_UNSIGNED:
+            if isinstance(value, float) and not value.is_integer():
+                raise ValueError
+            if not 0 <= int(value) < 1 << 64:
+                raise ValueError
+    except (TypeError, ValueError, OverflowError) as err:
+        kind = 'a float' if value_type == VALUE_TYPE_FLOAT else 'an unsigned integer'
+        raise ValueError(f'{value!r} is not {kind}') from err
+
+class ItemControl():
+    """Find, read and set the items of the simulated hosts
+
+    Items are found through the key and name indexes of each host, so
+    an edit costs the same however many items a host has. send(hostname,
+    items) is called with the changed active items of each host, to send
+    them now rather than when they are next due.
+    """
+
+    def __init__(self, active_data, passive_data, send=None):
+        self.stores = dict(active=active_data, passive=passive_data)
+        self.send = send
+
+    def store(self, section: str):
+        '''Get the item store of a section'''
+        if section not in self.stores:
+            raise ValueError(f'unknown section {section}')
+        return self.stores[section]
+
+    def find(self, section: str, hostname: str, key: str = None, name: str = None):
+        '''Find an item of a host by its key, or else by its name, returns None if not found'''
+        store = self.store(section)
+        if hostname not in store:
+            return None
+        if key is not None:
+            return store.item_by_key(hostname, key)
+        return store.item_by_name(hostname, name)
+
+    def hosts(self, section: str = 'active'):
+        '''Get the hostnames of a section'''
+        return list(self.store(section))
+
+    def items(self, hostname: str, section: str = 'active'):
+        '''Get the items of a host, or None if it is not simulated'''
+        store = self.store(section)
+        if hostname not in store:
+            return None
+        return [dict(item) for item in store[hostname]]
+
+    def set_values(self, edits: list):
+        '''Set the values of items, returns the number updated and the indexes of those not found
+
+        Each edit has the host, the key or name of the item, the value and
+        optionally the section, active by default. Every edit is checked
+        before any is applied, values must parse as the value type of
+        their item.
+        '''
+        found = []
+        missing = []
+        for index, edit in enumerate(edits):
+            if not isinstance(edit, dict) or 'host' not in edit or 'value' not in edit or \
+                    ('key' not in edit and 'name' not in edit):
+                raise ValueError(f'edit {index} needs a host, a key or name and a value')
+            section = edit.get('section', 'active')
+            item = self.find(section, edit['host'], edit.get('key'), edit.get('name'))
+            if item is None:
+                missing.append(index)
+                continue
+            try:
+                check_value(item['value_type'], edit['value'])
+            except ValueError as err:
+                raise ValueError(f'edit {index}: {err}') from err
+            found.append((section, edit['host'], item, edit['value']))
+
+        # Each changed item of a host is sent once, with its last value
+        sends = {}
+        for section, hostname, item, value in found:
+            item['lastvalue'] = value
+            if section == 'active':
+                sends.setdefault(hostname, {})[item.row] = item
+        if self.send:
+            for hostname, items in sends.items():
+                self.send(hostname, list(items.values()))
+        return dict(updated=len(found), missing=missing)
+
+    def request(self, method: str, path: str, query: dict, body: bytes):
+        '''Answer a control request, returns the HTTP status and the JSON result'''
+        # pylint: disable=too-many-return-statements
+        section = query.get('section', 'active')
+        if path == '/hosts' and method == 'GET':
+            return 200, dict(hosts=self.hosts(section))
+        if path == '/items' and method == 'GET':
+            items = self.items(query.get('host', ''), section)
+            if items is None:
+                return 404, dict(error='host not found')
+            return 200, dict(host=query['host'], items=items)
+        if path == '/item' and method == 'GET':
+            item = self.find(section, query.get('host', ''), query.get('key'),
+                             query.get('name'))
+            if item is None:
+                return 404, dict(error='item not found')
+            return 200, dict(item)
+        if path == '/values' and method == 'POST':
+            edits = loads(body or b'[]')
+            if isinstance(edits, dict):
+                edits = [edits]
+            if not isinstance(edits, list):
+                raise ValueError('expected a list of edits')
+            return 200, self.set_values(edits)
+        if path in ('/hosts', '/items', '/item', '/values'):
+            return 405, dict(error='method not allowed')
+        return 404, dict(error='not found')
+
+STATUS_TEXT = {200: b'OK', 400: b'Bad Request', 404: b'Not Found', 405: b'Method Not Allowed',
+               413: b'Payload Too Large'}
+
+class ControlServer():
+    """Serve an ItemControl as a small HTTP API, on a local port or a Unix socket
+
+    submit(function, *args) runs a request in the thread that owns the
+    items and returns a concurrent.futures.Future of its result, for the
+    Tk interface. Without it requests run in the server's event loop.
+    """
+
+    def __init__(self, control: ItemControl, submit=None):
+        self.control = control
+        self.submit = submit
+        self.server = None
+
+    async def read_request(self, reader: asyncio.StreamReader):
+        '''Read an HTTP request, returns the method, path, query and body'''
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode("latin-1").split('\r\n')
+        method, target = lines[0].split(' ', 2)[:2]
+        length = 0
+        for line in lines[1:]:
+            field, _, value = line.partition(':')
+            if field.strip().lower() == 'content-length':
+                length = int(value)
+        if length > ZABBIX_CONTROL_MAX_BODY:
+            raise OverflowError(f'request body of {length} bytes')
+        body = await reader.readexactly(length) if length else b''
+        url = urllib.parse.urlsplit(target)
+        return method, url.path, dict(urllib.parse.parse_qsl(url.query)), body
+
+    async def respond(self, method: str, path: str, query: dict, body: bytes):
+        '''Run a request where the items are owned, returns the status and result'''
+        if self.submit:
+            return await asyncio.wrap_future(
+                self.submit(self.control.request, method, path, query, body))
+        return self.control.request(method, path, query, body)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        '''Answer one HTTP request'''
+        try:
+            try:
+                request = await asyncio.wait_for(self.read_request(reader),
+                                                 ZABBIX_CONTROL_TIMEOUT)
+                status, result = await self.respond(*request)
+            except OverflowError as err:
+                status, result = 413, dict(error=str(err))
+            except (TypeError, ValueError) as err:
+                status, result = 400, dict(error=str(err))
+            body = dumps(result)
+            writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                         b'Content-Length: %d\r\nConnection: close\r\n\r\n' % (
+                             status, STATUS_TEXT[status], len(body)))
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError) as err:
+            logging.debug('control request failed: %s', err)
+        finally:
+            writer.close()
+
+    async def start(self, port: int = None, listen: str = ZABBIX_CONTROL_LISTEN,
+                    path: str = None):
+        '''Listen on listen:port, or on the Unix socket at path'''
+        if path:
+            self.server = await asyncio.start_unix_server(self.handle, path)
+            logging.info('control API on %s', path)
+        else:
+            self.server = await asyncio.start_server(self.handle, listen, port,
+                                                     reuse_address=True)
+            logging.info('control API on http://%s:%d/', listen, port)
+        return self.server
+
+    async def stop(self):
+        '''Stop listening'''
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+def control_from_config(config):
+    '''Get the control port, listen address and socket path from the config
+
+    Returns None for the port and path if the control API is disabled.
+    '''
+    port = config.getint('SETTINGS', 'control_port', fallback=0) or None
+    path = config.get('SETTINGS', 'control_socket', fallback=None) or None
+    return port, config.get('SETTINGS', 'control_listen', fallback=ZABBIX_CONTROL_LISTEN), path
+
+def start_control_thread(control_server: ControlServer, port: int = None,
+                         listen: str = ZABBIX_CONTROL_LISTEN, path: str = None):
+    '''Serve the control API from a background thread, for the Tk interface, returns its loop'''
+    return start_loop_thread(lambda: control_server.start(port, listen, path), 'ZabbixControl')
@@ -0,0 +1,133 @@
+#
+# Encode JSON messages and agent data values
+#
+
+"""JSON and agent data encoding"""
+import itertools
+import json
+import math
+from json.encoder import encode_basestring_ascii
+from zabbixsim.scheduler import NS_PER_SECOND
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps_json(data):
+    '''Encode a JSON message to bytes with the standard library'''
+    return json.dumps(data, sort_keys=False).encode("utf-8")
+
+def loads_json(payload):
+    '''Decode a JSON payload with the standard library, without copying it to bytes first'''
+    return json.loads(str(payload, 'utf-8'))
+
+def encode_value_json(value):
+    '''Encode a value as JSON with the standard library, as orjson does'''
+    value_type = type(value)
+    if value_type is str:
+        return encode_basestring_ascii(value).encode("ascii")
+    if value_type is float:
+        # NaN and Infinity are not JSON, like orjson they are null
+        return repr(value).encode("ascii") if math.isfinite(value) else b'null'
+    if value_type is int:
+        return b'%d' % value
+    return dumps_json(value)
+
+# orjson when it is available, it encodes to bytes and decodes memory views.
+# Values are encoded one at a time, so without a wrapper. The store keeps
+# unsigned values to 64 bits, which is as far as orjson encodes integers.
+if orjson is not None:
+    dumps = orjson.dumps
+    loads = orjson.loads
+    encode_value = orjson.dumps
+else:
+    dumps = dumps_json
+    loads = loads_json
+    encode_value = encode_value_json
+
+class AgentDataEncoder():
+    """Encode agent data values from pre-encoded host and key fragments
+
+    The host and key of a value never change, so each hostname and key is
+    encoded once, and a value is its host, key, value and clock fragments
+    joined. Values are kept encoded, without their id, and numbered when
+    they are joined into a payload, so values from many hosts and calls
+    can share a packet. Times are in nanoseconds since the epoch, sent as
+    the clock and ns of the value or packet.
+    """
+
+    def __init__(self, encode=encode_value):
+        self.encode = encode
+        self.hosts = {}
+        self.keys = {}
+
+    def host(self, hostname: str):
+        '''Get the encoded host fragment'''
+        fragment = self.hosts.get(hostname)
+        if fragment is None:
+            fragment = b'"host":%b,' % encode_value_json(hostname)
+            self.hosts[hostname] = fragment
+        return fragment
+
+    def key(self, key: str):
+        '''Get the encoded key fragment, up to the value'''
+        fragment = self.keys.get(key)
+        if fragment is None:
+            fragment = b'"key":%b,"value":' % encode_value_json(key)
+            self.keys[key] = fragment
+        return fragment
+
+    def forget(self, hostname: str):
+        '''Drop the encoded host fragment of a removed host'''
+        self.hosts.pop(hostname, None)
+
+    @staticmethod
+    def tails(stamps):
+        '''Encode the clock fragments of the values, stamps is one time for all or a list'''
+        if isinstance(stamps, int):
+            return itertools.repeat(b',"clock":%d,"ns":%d}' % divmod(stamps, NS_PER_SECOND))
+        # Values due together share their time, and its fragment
+        tails = {}
+        for stamp in stamps:
+            if stamp not in tails:
+                tails[stamp] = b',"clock":%d,"ns":%d}' % divmod(stamp, NS_PER_SECOND)
+        return [tails[stamp] for stamp in stamps]
+
+    def values(self, hostname: str, items, stamps, first_id: int = None):
+        '''Encode the values of items of one host, numbered from first_id if it is set'''
+        host = self.host(hostname)
+        keys = self.keys
+        key = self.key
+        encode = self.encode
+        if first_id is None:
+            return [b'{%b%b%b%b' % (host, keys.get(item['key_']) or key(item['key_']),
+                                     encode(item['lastvalue']), tail)
+                    for item, tail in zip(items, self.tails(stamps))]
+        return [b'{"id":%d,%b%b%b%b' % (item_id, host,
+                                         keys.get(item['key_']) or key(item['key_']),
+                                         encode(item['lastvalue']), tail)
+                for item_id, item, tail in zip(itertools.count(first_id), items,
+                                               self.tails(stamps))]
+
+    @staticmethod
+    def envelope(session: str, stamp: int, data: bytes):
+        '''Wrap the joined values in an agent data payload'''
+        clock, ns = divmod(stamp, NS_PER_SECOND)
+        return b'{"request":"agent data","session":"%b","clock":%d,"ns":%d,"data":[%b]}' % (
+            session.encode("ascii"), clock, ns, data)
+
+    def payload(self, session: str, stamp: int, fragments: list):
+        '''Join encoded values into an agent data payload, numbering each value'''
+        return self.envelope(session, stamp, b','.join(
+            [b'{"id":%d,%b' % (item_id, fragment[1:])
+             for item_id, fragment in enumerate(fragments, 1)]))
+
+    def host_payload(self, session: str, stamp: int, hostname: str, items, stamps):
+        '''Encode the values of items of one host straight into an agent data payload'''
+        # pylint: disable=too-many-arguments
+        return self.envelope(session, stamp, b','.join(
+            self.values(hostname, items, stamps, first_id=1)))
+
+# Shared by every sender, the fragments are the same whichever sends a value
+AGENT_DATA = AgentDataEncoder()
@@ -0,0 +1,196 @@
+#
+# Generate item values from specs in the simulation files
+#
+
+"""Vectorized value generators"""
+import asyncio
+import logging
+import math
+import time
+from zabbixsim.store import ItemStore, COLUMN_FLOAT, COLUMN_UNSIGNED
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ZABBIX_GENERATOR_INTERVAL = 1.0
+
+# Parameters of each generator type, with their defaults
+GENERATOR_PARAMS = {
+    'sine': dict(amplitude=1.0, offset=0.0, period=3600.0, phase=0.0),
+    'gaussian': dict(mean=0.0, stddev=1.0),
+    'random_walk': dict(start=0.0, step=1.0),
+    'counter': dict(start=0.0, rate=1.0, wrap=float(1 << 64)),
+    'step': dict(interval=60.0),
+    'replay': dict(interval=60.0),
+}
+
+# Parameters every generator type has
+COMMON_PARAMS = dict(noise=0.0, min=-math.inf, max=math.inf)
+
+class GeneratorBatch():
+    """The rows of one generator type, with their parameters as arrays"""
+
+    def __init__(self, kind: str, rows: list, specs: list, started: float):
+        self.kind = kind
+        self.rows = numpy.array(rows, dtype=numpy.int64)
+        self.started = started
+        self.updated = None
+        defaults = dict(GENERATOR_PARAMS[kind], **COMMON_PARAMS)
+        self.params = {name: numpy.array([float(spec.get(name, default)) for spec in specs])
+                       for name, default in defaults.items()}
+        self.has_noise = bool(self.params['noise'].any())
+        self.clipped = bool(numpy.isfinite(self.params['min']).any() or
+                            numpy.isfinite(self.params['max']).any())
+
+        # Random walks continue from their current value
+        if kind == 'random_walk':
+            self.current = self.params['start'].copy()
+
+        # Step and replay series are held end to end, with the offset and
+        # length of each row's series
+        if kind in ('step', 'replay'):
+            series = [[float(value) for value in spec['values']] for spec in specs]
+            self.lengths = numpy.array([len(values) for values in series], dtype=numpy.int64)
+            self.offsets = numpy.concatenate(([0], numpy.cumsum(self.lengths)[:-1]))
+            self.series = numpy.array([value for values in series for value in values])
+            self.loop = numpy.array([bool(spec.get('loop', kind == 'step')) for spec in specs])
+
+    def evaluate(self, now: float, rng):
+        '''Get the value of every row at now'''
+        params = self.params
+        kind = self.kind
+        elapsed = now - self.started
+        if kind == 'sine':
+            values = params['offset'] + params['amplitude'] * numpy.sin(
+                2 * math.pi * now / params['period'] + params['phase'])
+        elif kind == 'gaussian':
+            values = params['mean'] + params['stddev'] * rng.standard_normal(len(self.rows))
+        elif kind == 'random_walk':
+            # Steps are scaled to the time since the last update, so the
+            # walk does not depend on how often it is updated
+            interval = ZABBIX_GENERATOR_INTERVAL if self.updated is None else now - self.updated
+            self.current += params['step'] * math.sqrt(max(interval, 0)) * \
+                rng.standard_normal(len(self.rows))
+            numpy.clip(self.current, params['min'], params['max'], out=self.current)
+            values = self.current
+        elif kind == 'counter':
+            values = numpy.fmod(params['start'] + params['rate'] * elapsed, params['wrap'])
+        else:
+            index = (elapsed // params['interval']).astype(numpy.int64)
+            index = numpy.where(self.loop, index % self.lengths,
+                                numpy.minimum(index, self.lengths - 1))
+            values = self.series[self.offsets + index]
+        self.updated = now
+
+        if self.has_noise:
+            values = values + params['noise'] * rng.standard_normal(len(self.rows))
+        if self.clipped:
+            values = numpy.clip(values, params['min'], params['max'])
+        return values
+
+class ValueGenerators():
+    """Evaluate the value generators of an item store, all rows of a type in one batch
+
+    Each row with a generator spec, such as
+
+        generator: {type: sine, amplitude: 10, offset: 50, period: 600, noise: 1}
+
+    has its value replaced on every update. Sine, counter, step and replay
+    values only depend on the time of the update. Gaussian values and noise
+    are drawn afresh on each update, and random walks step from their last
+    value, scaled to the time since it, so their spread does not depend on
+    how often they are updated but their values do. Needs numpy.
+    """
+
+    def __init__(self, store: ItemStore, seed: int = None):
+        self.store = store
+        self.rng = numpy.random.default_rng(seed) if numpy else None
+        self.started = time.time()
+        self.version = None
+        self.batches = []
+        self.warned = False
+
+    def sync(self):
+        '''Rebuild the batches when the store's generator specs have changed'''
+        store = self.store
+        if self.version == store.generators_version:
+            return
+        self.version = store.generators_version
+
+        # Keep the random walks where they are
+        walks = {}
+        for batch in self.batches:
+            if batch.kind == 'random_walk':
+                walks.update(zip(batch.rows.tolist(), batch.current.tolist()))
+
+        kinds = {}
+        for row, spec in store.generators.items():
+            kind = spec.get('type') if isinstance(spec, dict) else None
+            if kind not in GENERATOR_PARAMS:
+                logging.warning('%s: unknown generator %s', store.item_keys[row], spec)
+                continue
+            if row in walks:
+                spec = dict(spec, start=walks[row])
+            elif kind in ('random_walk', 'counter') and 'start' not in spec:
+                # Start from the recorded value
+                try:
+                    spec = dict(spec, start=float(store.get_value(row)))
+                except ValueError:
+                    pass
+            kinds.setdefault(kind, ([], []))
+            kinds[kind][0].append(row)
+            kinds[kind][1].append(spec)
+
+        self.batches = []
+        for kind, (rows, specs) in kinds.items():
+            try:
+                self.batches.append(GeneratorBatch(kind, rows, specs, self.started))
+            except (KeyError, TypeError, ValueError) as err:
+                logging.warning('invalid %s generators: %s', kind, err)
+
+    def update(self, now: float = None):
+        '''Set the value of every row with a generator, returns the number of rows updated'''
+        if numpy is None:
+            if self.store.generators and not self.warned:
+                logging.warning('value generators need numpy, sending the recorded values')
+                self.warned = True
+            return 0
+
+        self.sync()
+        now = time.time() if now is None else now
+        store = self.store
+        updated = 0
+        for batch in self.batches:
+            values = batch.evaluate(now, self.rng)
+            columns = numpy.frombuffer(store.columns, dtype=numpy.int8)[batch.rows]
+            slots = numpy.frombuffer(store.slots, dtype=numpy.uint32)[batch.rows]
+
+            # Write straight into the value columns, the views are released
+            # before returning so the columns can grow again
+            is_float = columns == COLUMN_FLOAT
+            if is_float.any():
+                float_values = numpy.frombuffer(store.float_values, dtype=numpy.float64)
+                float_values[slots[is_float]] = values[is_float]
+                del float_values
+            is_unsigned = columns == COLUMN_UNSIGNED
+            if is_unsigned.any():
+                unsigned_values = numpy.frombuffer(store.unsigned_values, dtype=numpy.uint64)
+                unsigned_values[slots[is_unsigned]] = numpy.clip(
+                    numpy.rint(values[is_unsigned]), 0, float(1 << 64) - 2048)
+                del unsigned_values
+
+            # Character items take the value as text, one at a time
+            is_text = ~(is_float | is_unsigned)
+            for row, value in zip(batch.rows[is_text].tolist(), values[is_text].tolist()):
+                store.set_value(row, f'{value:g}')
+            updated += len(batch.rows)
+        return updated
+
+async def run_generators(generators: list, interval: float = ZABBIX_GENERATOR_INTERVAL):
+    '''Update the value generators every interval seconds'''
+    while True:
+        for value_generators in generators:
+            value_generators.update()
+        await asyncio.sleep(interval)
@@ -0,0 +1,669 @@
+#
+# Simulate many Zabbix active agents without a user interface
+#
+
+"""Headless asyncio simulator"""
+import asyncio
+import logging
+import random
+import time
+from zabbixsim.active import ZabbixActive
+from zabbixsim.active import ZABBIX_ACTIVE_PORT, ZABBIX_REFRESH_ACTIVE_CHECKS, ZABBIX_SEND_ACTIVE
+from zabbixsim.batch import AgentDataBatcher
+from zabbixsim.batch import ZABBIX_BATCH_BYTES, ZABBIX_BATCH_DELAY, ZABBIX_BATCH_VALUES
+from zabbixsim.buffer import BufferSender, buffer_from_config
+from zabbixsim.buffer import ZABBIX_BUFFER_SEND, ZABBIX_RETRY_MAX, ZABBIX_RETRY_MIN
+from zabbixsim.checks import ActiveChecks, apply_checks, first_refresh_slot, jittered
+from zabbixsim.control import ControlServer, ItemControl, control_from_config
+from zabbixsim.generators import ValueGenerators, run_generators, ZABBIX_GENERATOR_INTERVAL
+from zabbixsim.history import HistoryFile, HistoryReplay, ZABBIX_REPLAY_SPEED
+from zabbixsim.encoding import AGENT_DATA, dumps
+from zabbixsim.loader import build_stores, clones_from_config, load_config, load_index
+from zabbixsim.metrics import METRICS, metrics_from_config, start_metrics
+from zabbixsim.passive import passive_from_config
+from zabbixsim.pool import AsyncConnectionPool, ZABBIX_POOL_IDLE, ZABBIX_POOL_SIZE, ZABBIX_TIMEOUT
+from zabbixsim.protocol import NotAnsweredError, ZBXD_PREFIX_SIZE
+from zabbixsim.protocol import decode_json, encode_parts, read_payload
+from zabbixsim.reload import SimWatcher, reload_host, reschedule_host, watch_sim_files
+from zabbixsim.reload import ZABBIX_RELOAD_INTERVAL
+from zabbixsim.routing import ServerRoutes, routes_from_config, target_directory, target_name
+from zabbixsim.scheduler import Scheduler, due_stamp, wall_clock_offset
+
+ZABBIX_STATS_INTERVAL = 10
+
+class AsyncZabbixActive(ZabbixActive):
+    """ZabbixActive using asyncio streams"""
+    # pylint: disable=invalid-overridden-method
+
+    def __init__(self, server: str, active_data: dict, port: int = ZABBIX_ACTIVE_PORT,
+                 timeout: float = ZABBIX_TIMEOUT, pool: AsyncConnectionPool = None,
+                 compress: bool = False, nodes: list = None):
+        # pylint: disable=too-many-arguments
+        super().__init__(server, active_data, port=port, compress=compress, nodes=nodes)
+        self.timeout = timeout
+        self.pool = pool or AsyncConnectionPool(timeout=timeout)
+
+    def encode_message(self, data):
+        '''Generate the zabbix formatted message, from a dict or an encoded payload'''
+        if not isinstance(data, (bytes, bytearray)):
+            data = dumps(data)
+        return encode_parts(data, self.compress)
+
+    @staticmethod
+    async def read_response(reader: asyncio.StreamReader):
+        '''Read one response payload, NotAnsweredError if none of it could be read'''
+        try:
+            prefix = await reader.read(ZBXD_PREFIX_SIZE)
+        except ConnectionError as err:
+            raise NotAnsweredError(f'connection failed: {err}') from err
+        if not prefix:
+            raise NotAnsweredError('connection closed before the response')
+        try:
+            return await read_payload(reader, prefix=prefix)
+        except asyncio.IncompleteReadError as err:
+            raise ConnectionError('connection closed during the response') from err
+
+    async def receive_message(self, reader: asyncio.StreamReader):
+        '''Receive one response'''
+        payload = await asyncio.wait_for(self.read_response(reader), self.timeout)
+        METRICS.counters['bytes_received_total'] += len(payload)
+        parsed = decode_json(payload)
+        logging.debug(parsed["response"])
+        return parsed
+
+    async def send_messages(self, messages: list):
+        '''Send the messages back to back on one connection, returns the responses
+
+        Each node is tried once, the messages are sent to the next node only
+        when the node failed before answering any of them, other failures
+        are raised so the values are not stored twice.
+        '''
+        for attempt in range(len(self.nodes)):
+            address = (self.server, self.port)
+            try:
+                return await self.send_node(address, messages)
+            except NotAnsweredError as err:
+                if attempt + 1 == len(self.nodes):
+                    raise
+                self.failover(address, err)
+        return []
+
+    async def send_node(self, address: tuple, messages: list):
+        '''Send the messages back to back on one connection to address, returns the responses'''
+        responses = []
+        while len(responses) < len(messages):
+            pending = messages[len(responses):]
+            if responses and not self.pool.supports_pipelining(address):
+                pending = pending[:1]
+
+            try:
+                connection, reused = await self.pool.acquire(address)
+            except (OSError, asyncio.TimeoutError) as err:
+                if responses:
+                    raise
+                raise NotAnsweredError(f'connect failed: {err!r}') from err
+            reader, writer = connection
+            received = len(responses)
+            try:
+                started = time.perf_counter()
+                try:
+                    for data in pending:
+                        parts = self.encode_message(data)
+                        writer.writelines(parts)
+                        METRICS.counters['bytes_sent_total'] += sum(map(len, parts))
+                    await writer.drain()
+                except ConnectionError as err:
+                    raise NotAnsweredError(f'connection failed: {err}') from err
+                sent = time.perf_counter()
+                METRICS.histograms['send_seconds'].observe(sent - started)
+                METRICS.counters['packets_sent_total'] += len(pending)
+                for _ in pending:
+                    responses.append(await self.receive_message(reader))
+                    METRICS.histograms['receive_seconds'].observe(time.perf_counter() - sent)
+            except asyncio.TimeoutError:
+                self.pool.release(address, connection, reusable=False)
+                raise
+            except NotAnsweredError as err:
+                self.pool.release(address, connection, reusable=False)
+                # The server closed the connection after its last response, or
+                # while it was idle, so what was not answered is sent again.
+                # Other failures are raised, the server may have stored the values.
+                if len(responses) > received:
+                    self.pool.persistent[address] = False
+                elif responses:
+                    raise ConnectionError(f'connection to {address} failed after '
+                                          f'{len(responses)} responses') from err
+                elif not reused:
+                    raise
+                continue
+            except BaseException:
+                self.pool.release(address, connection, reusable=False)
+                raise
+            self.pool.release(address, connection)
+        return responses
+
+    async def send_message(self, data: dict):
+        '''Send the message to the Zabbix server'''
+        return (await self.send_messages([data]))[0]
+
+    async def refresh_checks(self, host_check: str):
+        '''Query the Zabbix server for an active check, returns the checks or None'''
+        received_data = await self.send_message(self.active_checks_message(host_check))
+        return self.active_checks(host_check, received_data)
+
+    async def agent_data(self, hostname :str, due_items :list, stamps: list = None):
+        '''Process the active agent data, returns the number of values sent'''
+        payload = self.encode_agent_data(hostname, due_items, stamps)
+        if not payload:
+            return 0
+
+        received_data = await self.send_message(payload)
+        logging.debug(received_data.get("info"))
+        return len(due_items)
+
+    async def refresh_and_send(self, hostname :str, due_items :list, stamps: list = None):
+        '''Pipeline the active checks and agent data requests, returns the checks and values sent'''
+        messages = [self.active_checks_message(hostname)]
+        payload = self.encode_agent_data(hostname, due_items, stamps)
+        if payload:
+            messages.append(payload)
+
+        responses = await self.send_messages(messages)
+        checks = self.active_checks(hostname, responses[0])
+        if not payload:
+            return checks, 0
+        logging.debug(responses[1].get("info"))
+        return checks, len(due_items)
+
+class HeadlessSim():
+    """Run every simulated host as an independent asyncio task"""
+
+    def __init__(self, zabbix_active: AsyncZabbixActive, active_data: dict,
+                 batcher: AgentDataBatcher = None, hostnames: list = None, owns=None,
+                 sender: BufferSender = None, checks: ActiveChecks = None, name: str = None):
+        # pylint: disable=too-many-arguments
+        self.zabbix_active = zabbix_active
+        self.name = name
+        self.active_data = active_data
+        self.batcher = batcher
+        self.sender = sender
+
+        # With checks each host sends the items the server asks for, on their delays
+        self.checks = checks
+        self.hostnames = list(active_data) if hostnames is None else hostnames
+
+        # owns(hostname) tells if a reloaded host is run here, all are by default
+        self.owns = owns
+
+        # Running hosts, and sends of edited values
+        self.tasks = {}
+        self.schedulers = {}
+        self.waiters = {}
+        self.edits = set()
+
+        # Throughput counters
+        self.packets_sent = 0
+        self.values_sent = 0
+        self.errors = 0
+
+    async def send_host(self, hostname: str, due_items: list, stamps: list = None,
+                        refresh: bool = False):
+        '''Send the due items for a host, and refresh its checks, logging any failure
+
+        Each value is stamped with its due time in stamps, in ns since the epoch.
+        '''
+        if stamps:
+            METRICS.observe_sent(stamps, time.time_ns())
+        if self.sender:
+            # Waits while the buffer is full with the block policy
+            await self.sender.put(hostname, due_items, stamps)
+            if not refresh:
+                return
+            due_items = []
+        elif self.batcher:
+            self.batcher.add(hostname, due_items, stamps)
+            # Waits while the sends are behind
+            await self.batcher.wait()
+            if not refresh:
+                return
+            due_items = []
+
+        try:
+            if refresh:
+                checks, values = await self.zabbix_active.refresh_and_send(hostname, due_items,
+                                                                           stamps)
+                scheduler = self.schedulers.get(hostname)
+                if checks is not None and self.checks is not None and scheduler:
+                    delta = self.checks.update(hostname, checks)
+                    apply_checks(scheduler, self.active_data, hostname, self.checks, delta,
+                                 time.monotonic())
+            else:
+                values = await self.zabbix_active.agent_data(hostname, due_items, stamps)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as err:
+            self.errors += 1
+            METRICS.host_errors[hostname] += 1
+            logging.warning('%s: send failed: %s', hostname, err)
+            return
+        if values:
+            self.packets_sent += 1
+            self.values_sent += values
+            METRICS.counters['values_sent_total'] += values
+
+    def send_items(self, hostname: str, items: list):
+        '''Send edited items of a running host now, outside their schedule'''
+        if hostname not in self.tasks:
+            return
+        task = asyncio.ensure_future(self.send_host(hostname, items))
+        self.edits.add(task)
+        task.add_done_callback(self.edits.discard)
+
+    def wake_host(self, hostname: str):
+        '''Wake a sleeping host to check its schedule'''
+        waiter = self.waiters.get(hostname)
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+
+    async def sleep_host(self, hostname: str, delay: float):
+        '''Sleep for delay seconds, or until the host is woken'''
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        handle = loop.call_later(delay, self.wake_host, hostname)
+        self.waiters[hostname] = waiter
+        try:
+            await waiter
+        finally:
+            handle.cancel()
+
+    async def run_host(self, hostname: str, start_delay: float = 0):
+        '''Refresh checks and send each active item on its delay, forever'''
+        await asyncio.sleep(start_delay)
+
+        # Lazy hosts are unpacked when first scheduled
+        active_data = self.active_data
+        scheduler = Scheduler()
+        start = time.monotonic()
+        for row in active_data[hostname].rows:
+            scheduler.schedule(row, active_data.delays[row], start)
+        self.schedulers[hostname] = scheduler
+        clone = active_data.clones.get(hostname)
+
+        # Checks are refreshed when the host starts, then in the host's slot
+        # of each refresh interval so the hosts do not all refresh at once
+        refresh_due = start
+        refresh_slot = first_refresh_slot(hostname, start, ZABBIX_REFRESH_ACTIVE_CHECKS)
+        lag = METRICS.histograms['scheduler_lag_seconds']
+        while True:
+            next_due = scheduler.next_due()
+            wake = refresh_due if next_due is None else min(next_due, refresh_due)
+            await self.sleep_host(hostname, max(0, wake - time.monotonic()))
+
+            now = time.monotonic()
+            refresh = now >= refresh_due
+            if refresh:
+                refresh_due = jittered(refresh_slot, ZABBIX_REFRESH_ACTIVE_CHECKS)
+                refresh_slot += ZABBIX_REFRESH_ACTIVE_CHECKS
+            # Values are stamped with the time they were due
+            offset = wall_clock_offset()
+            due_items = []
+            stamps = []
+            for row, due in scheduler.pop_due(now):
+                lag.observe(now - due)
+                due_items.append(active_data.item(row, clone))
+                stamps.append(due_stamp(due, offset))
+            if scheduler.skipped:
+                METRICS.counters['checks_skipped_total'] += scheduler.skipped
+                scheduler.skipped = 0
+            if due_items or refresh:
+                await self.send_host(hostname, due_items, stamps, refresh)
+
+    def start_host(self, hostname: str):
+        '''Start running a host, after a random delay to avoid a connect storm'''
+        start_delay = random.uniform(0, ZABBIX_SEND_ACTIVE)
+        self.tasks[hostname] = asyncio.ensure_future(self.run_host(hostname, start_delay))
+
+    def reload(self, changed: list, removed: list):
+        '''Apply reloaded hosts, each host keeps the schedule of its unchanged items'''
+        reload_sims([self], self.active_data, changed, removed)
+
+    def reload_host(self, hostname: str, old_rows: range, new_rows: range, now: float):
+        '''Start, stop or reschedule a host whose rows were reloaded'''
+        scheduler = self.schedulers.get(hostname)
+        if hostname not in self.active_data:
+            self.remove_host(hostname)
+        elif hostname not in self.tasks:
+            self.start_host(hostname)
+        elif scheduler:
+            reschedule_host(scheduler, self.active_data, old_rows, new_rows, now)
+            if self.checks is not None:
+                apply_checks(scheduler, self.active_data, hostname, self.checks, None, now)
+            self.wake_host(hostname)
+
+    def remove_host(self, hostname: str):
+        '''Stop running a host'''
+        task = self.tasks.pop(hostname, None)
+        if task:
+            task.cancel()
+        self.schedulers.pop(hostname, None)
+        self.waiters.pop(hostname, None)
+        if self.checks is not None:
+            self.checks.remove(hostname)
+        AGENT_DATA.forget(hostname)
+
+    def start(self):
+        '''Start running all the hosts'''
+        if self.sender:
+            self.sender.start()
+        for hostname in self.hostnames:
+            self.start_host(hostname)
+
+    async def stop(self):
+        '''Stop the hosts and send what is batched or buffered'''
+        tasks = list(self.tasks.values()) + list(self.edits)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.batcher:
+            await self.batcher.close()
+        if self.sender:
+            await self.sender.close()
+
+    async def run(self, duration: float = None):
+        '''Run all the hosts, for duration seconds or until cancelled'''
+        self.start()
+        started = time.monotonic()
+        try:
+            await asyncio.wait([asyncio.get_running_loop().create_future()], timeout=duration)
+        finally:
+            await self.stop()
+            self.log_stats(time.monotonic() - started)
+
+    def totals(self):
+        '''Get the packets and values sent and the errors, including batched and buffered sends'''
+        packets_sent, values_sent, errors = self.packets_sent, self.values_sent, self.errors
+        for queue in (self.batcher, self.sender):
+            if queue:
+                packets_sent += queue.packets_sent
+                values_sent += queue.values_sent
+                errors += queue.errors
+        return packets_sent, values_sent, errors
+
+    def log_totals(self, elapsed: float):
+        '''Log the throughput of the hosts, with the name of the simulator if it has one'''
+        packets_sent, values_sent, errors = self.totals()
+        logging.info('%shosts %d, packets %d (%.1f/s), values %d (%.1f/s), errors %d',
+                     f'{self.name}: ' if self.name else '', len(self.tasks),
+                     packets_sent, packets_sent / elapsed, values_sent, values_sent / elapsed,
+                     errors)
+
+    def log_stats(self, elapsed: float):
+        '''Log the throughput of the simulator'''
+        if elapsed <= 0:
+            return
+        self.log_totals(elapsed)
+        log_latency()
+
+class SimGroup():
+    """Run the hosts of each target in its own HeadlessSim
+
+    Each target has its own connections, batcher or send buffer and
+    checks, so a slow or failed server only holds up its own hosts.
+    """
+
+    def __init__(self, sims: list, active_data: dict):
+        self.sims = sims
+        self.active_data = active_data
+
+    def reload(self, changed: list, removed: list):
+        '''Apply reloaded hosts to the simulators of their targets'''
+        reload_sims(self.sims, self.active_data, changed, removed)
+
+    async def run(self, duration: float = None):
+        '''Run the hosts of every target, for duration seconds or until cancelled'''
+        for sim in self.sims:
+            sim.start()
+        started = time.monotonic()
+        try:
+            await asyncio.wait([asyncio.get_running_loop().create_future()], timeout=duration)
+        finally:
+            await asyncio.gather(*[sim.stop() for sim in self.sims])
+            self.log_stats(time.monotonic() - started)
+
+    def totals(self):
+        '''Get the packets and values sent and the errors of every target'''
+        return tuple(map(sum, zip(*[sim.totals() for sim in self.sims])))
+
+    def log_stats(self, elapsed: float):
+        '''Log the throughput of each target'''
+        if elapsed <= 0:
+            return
+        for sim in self.sims:
+            sim.log_totals(elapsed)
+        log_latency()
+
+def log_latency():
+    '''Log the latency and send deviation of the values sent'''
+    summary = METRICS.summary()
+    if summary:
+        logging.info('latency %s', summary)
+    deviation = METRICS.deviation_report()
+    if deviation:
+        logging.info('send deviation %s', deviation)
+
+def reload_sims(sims: list, active_data, changed: list, removed: list):
+    '''Apply reloaded hosts to the simulators that run them
+
+    The store is reloaded once, and each host keeps the schedule of its
+    unchanged items in every simulator that runs it. The clones of a
+    reloaded host are reloaded with it.
+    '''
+    now = time.monotonic()
+    for hostname, sections, blob in changed:
+        hosts = [hostname] + active_data.clones_of(hostname)
+        sim_hosts = [(sim, [name for name in hosts if not sim.owns or sim.owns(name)])
+                     for sim in sims]
+        if not any(names for _, names in sim_hosts):
+            continue
+        old_rows, new_rows = reload_host(active_data, hostname, sections, blob, 'active')
+        for sim, names in sim_hosts:
+            for name in names:
+                sim.reload_host(name, old_rows, new_rows, now)
+
+    for hostname in removed:
+        hosts = [hostname] + active_data.clones_of(hostname)
+        active_data.remove_host(hostname)
+        for sim in sims:
+            for name in hosts:
+                sim.remove_host(name)
+
+async def report_stats(simulator, report, zabbix_passive=None,
+                       interval: float = ZABBIX_STATS_INTERVAL):
+    '''Report the running totals of a HeadlessSim or HistoryReplay every interval seconds'''
+    while True:
+        await asyncio.sleep(interval)
+        report(simulator.totals() + (zabbix_passive.requests if zabbix_passive else 0,))
+
+def replay_from_config(config, zabbix_active, passive_data, hostnames: list = None,
+                       passive_hostnames: list = None):
+    '''Create the history replay from the config, or None if no history file is replayed'''
+    # pylint: disable=too-many-arguments
+    replay_path = config.get('SETTINGS', 'replay', fallback=None)
+    if not replay_path:
+        return None
+    return HistoryReplay(
+        HistoryFile(replay_path), zabbix_active, passive_data, hostnames, passive_hostnames,
+        speed=config.getfloat('SETTINGS', 'replay_speed', fallback=ZABBIX_REPLAY_SPEED),
+        loop=config.getboolean('SETTINGS', 'replay_loop', fallback=False),
+        original_clock=config.get('SETTINGS', 'replay_clock', fallback='replay') == 'original',
+        max_values=config.getint('SETTINGS', 'batch_max_values', fallback=ZABBIX_BATCH_VALUES))
+
+def target_sim(config, nodes: list, active_data, pool: AsyncConnectionPool,
+               hostnames: list = None, owns=None, name: str = None):
+    '''Create the HeadlessSim sending to the nodes of one target, with the settings from the config
+
+    With name the target is named in the logs, and its values are spilled
+    to a subdirectory of its own.
+    '''
+    # pylint: disable=too-many-arguments
+    compress = config.getboolean('SETTINGS', 'compression', fallback=False)
+    batch = config.getboolean('SETTINGS', 'batch', fallback=False)
+    batch_max_values = config.getint('SETTINGS', 'batch_max_values', fallback=ZABBIX_BATCH_VALUES)
+    batch_max_bytes = config.getint('SETTINGS', 'batch_max_bytes', fallback=ZABBIX_BATCH_BYTES)
+    batch_max_delay = config.getfloat('SETTINGS', 'batch_max_delay', fallback=ZABBIX_BATCH_DELAY)
+
+    server, port = nodes[0]
+    zabbix_active = AsyncZabbixActive(server, active_data, port=port, pool=pool,
+                                      compress=compress, nodes=nodes)
+    batcher = None
+    sender = None
+    buffer = buffer_from_config(config, target_directory(nodes) if name else None)
+    if buffer is not None:
+        # The buffer batches values itself, it replaces the batcher
+        sender = BufferSender(
+            zabbix_active, buffer, packet_values=batch_max_values,
+            send_interval=config.getfloat('SETTINGS', 'buffer_send', fallback=ZABBIX_BUFFER_SEND),
+            retry_min=config.getfloat('SETTINGS', 'buffer_retry_min', fallback=ZABBIX_RETRY_MIN),
+            retry_max=config.getfloat('SETTINGS', 'buffer_retry_max', fallback=ZABBIX_RETRY_MAX))
+    elif batch:
+        batcher = AgentDataBatcher(zabbix_active, max_values=batch_max_values,
+                                   max_bytes=batch_max_bytes, max_delay=batch_max_delay)
+    checks = ActiveChecks() if config.getboolean('SETTINGS', 'server_checks',
+                                                 fallback=True) else None
+    return HeadlessSim(zabbix_active, active_data, batcher, hostnames, owns, sender, checks,
+                       name)
+
+def route_sims(config, routes: ServerRoutes, active_data, pool: AsyncConnectionPool,
+               hostnames: list = None, owns=None):
+    '''Create a HeadlessSim for each target, running the hosts routed to it'''
+    # pylint: disable=too-many-arguments
+    if len(routes.targets) == 1:
+        return [target_sim(config, routes.targets[0], active_data, pool, hostnames, owns)]
+
+    hostnames = list(active_data) if hostnames is None else hostnames
+    sims = []
+    for target, nodes in enumerate(routes.targets):
+        def target_owns(hostname, target=target):
+            return routes.routed(target, hostname) and (owns is None or owns(hostname))
+        sims.append(target_sim(config, nodes, active_data, pool,
+                               routes.hosts_of(target, hostnames), target_owns,
+                               target_name(nodes)))
+    return sims
+
+async def run_hosts(config, active_data, passive_data, duration: float = None,
+                    hostnames: list = None, passive_hostnames: list = None, report=None,
+                    watcher: SimWatcher = None, owns=None):
+    '''Run the hosts with the settings from the config
+
+    hostnames and passive_hostnames select the hosts to run, all of them
+    by default, and owns(hostname) tells if a host added by a reload is
+    run. report is called with the (packets, values, errors, passive
+    requests) totals while running and when finished. With watcher the
+    simulation files are reloaded when they change. With a replay file
+    its history is sent instead of the recorded values.
+    '''
+    # pylint: disable=too-many-arguments,too-many-locals
+    pool_size = config.getint('SETTINGS', 'pool_size', fallback=ZABBIX_POOL_SIZE)
+    pool_idle_timeout = config.getfloat('SETTINGS', 'pool_idle_timeout',
+                                        fallback=ZABBIX_POOL_IDLE)
+
+    # Connections are pooled for each address, so each target has its own
+    pool = AsyncConnectionPool(max_size=pool_size, idle_timeout=pool_idle_timeout)
+    sims = route_sims(config, routes_from_config(config), active_data, pool, hostnames, owns)
+    headless_sim = sims[0] if len(sims) == 1 else SimGroup(sims, active_data)
+
+    # History is replayed to the first target
+    replay = replay_from_config(config, sims[0].zabbix_active, passive_data, hostnames,
+                                passive_hostnames)
+    simulator = replay or headless_sim
+
+    zabbix_passive = passive_from_config(config, passive_data, passive_hostnames)
+    if zabbix_passive:
+        await zabbix_passive.start()
+
+    # Edited values are sent by the simulators that run the host
+    def send_items(hostname, items):
+        for sim in sims:
+            sim.send_items(hostname, items)
+    control_port, control_listen, control_path = control_from_config(config)
+    control_server = None
+    if control_port or control_path:
+        control_server = ControlServer(ItemControl(active_data, passive_data, send_items))
+        await control_server.start(control_port, control_listen, control_path)
+
+    # Queue depths are only measured when the metrics are scraped
+    METRICS.add_gauge('hosts_running', lambda: sum(len(sim.tasks) for sim in sims))
+    METRICS.add_gauge('pool_idle_connections',
+                      lambda: sum(len(idle) for idle in pool.idle.values()))
+    batchers = [sim.batcher for sim in sims if sim.batcher]
+    if batchers:
+        METRICS.add_gauge('batch_pending_values',
+                          lambda: sum(len(batcher.fragments) for batcher in batchers))
+        METRICS.add_gauge('batch_sending_packets',
+                          lambda: sum(len(batcher.sending) for batcher in batchers))
+    buffers = [sim.sender.buffer for sim in sims if sim.sender]
+    if buffers:
+        METRICS.add_gauge('buffer_values', lambda: sum(map(len, buffers)))
+        METRICS.add_gauge('buffer_spilled_bytes',
+                          lambda: sum(buffer.spill_bytes for buffer in buffers))
+    if replay:
+        METRICS.add_gauge('replay_pending_values', lambda: len(replay.pending))
+        METRICS.add_gauge('replay_sending_packets', lambda: len(replay.sending))
+    metrics_port, metrics_listen = metrics_from_config(config)
+    metrics_server = await start_metrics(metrics_port, metrics_listen) if metrics_port else None
+
+    background = []
+    if report:
+        background.append(asyncio.ensure_future(
+            report_stats(simulator, report, zabbix_passive)))
+    generator_interval = config.getfloat('SETTINGS', 'generator_interval',
+                                         fallback=ZABBIX_GENERATOR_INTERVAL)
+    background.append(asyncio.ensure_future(run_generators(
+        [ValueGenerators(active_data), ValueGenerators(passive_data)], generator_interval)))
+    if watcher:
+        reloaders = ([] if replay else [headless_sim.reload]) + \
+            ([zabbix_passive.reload] if zabbix_passive else [])
+        reload_interval = config.getfloat('SETTINGS', 'reload_interval',
+                                          fallback=ZABBIX_RELOAD_INTERVAL)
+        background.append(asyncio.ensure_future(
+            watch_sim_files(watcher, reloaders, reload_interval)))
+    try:
+        await simulator.run(duration)
+    finally:
+        for task in background:
+            task.cancel()
+        if replay:
+            replay.history.close()
+        if metrics_server:
+            metrics_server.close()
+        if control_server:
+            await control_server.stop()
+        if zabbix_passive:
+            await zabbix_passive.stop()
+            logging.info('passive requests %d, unsupported %d',
+                         zabbix_passive.requests, zabbix_passive.unsupported)
+        if report:
+            report(simulator.totals() + (zabbix_passive.requests if zabbix_passive else 0,))
+
+def run_headless(duration: float = None, shards: int = None):
+    '''Load the simulation data and run it headless, in shards processes when over one'''
+    config = load_config()
+    snapshot = config.getboolean('SETTINGS', 'snapshot', fallback=False)
+    load_workers = config.getint('SETTINGS', 'load_workers', fallback=None)
+    shards = shards or config.getint('SETTINGS', 'shards', fallback=1)
+
+    index = load_index(snapshot=snapshot, workers=load_workers)
+    active_data, passive_data, hostnames = build_stores(index)
+    clones_from_config(config, active_data, passive_data, hostnames)
+    watcher = None
+    if config.getboolean('SETTINGS', 'reload', fallback=False):
+        watcher = SimWatcher(index, workers=load_workers)
+
+    if shards > 1:
+        # pylint: disable=import-outside-toplevel
+        from zabbixsim.shard import run_sharded
+        run_sharded(config, active_data, passive_data, shards, duration, watcher)
+        return
+
+    try:
+        asyncio.run(run_hosts(config, active_data, passive_data, duration, watcher=watcher))
+    except KeyboardInterrupt:
+        pass
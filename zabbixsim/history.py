@@ -0,0 +1,332 @@
+#
+# Recorded item history, written in chunks and replayed from a memory map
+#
+
+"""Item history replay"""
+import asyncio
+import logging
+import marshal
+import mmap
+import os
+import struct
+import time
+from array import array
+from zabbixsim.batch import SendTasks
+from zabbixsim.metrics import METRICS
+from zabbixsim.scheduler import NS_PER_SECOND
+from zabbixsim.store import VALUE_TYPE_FLOAT, VALUE_TYPE_UNSIGNED
+
+HISTORY_FILE = 'zabbixsim.history'
+HISTORY_MAGIC = b'ZHST'
+HISTORY_VERSION = 1
+
+# magic, version, index offset
+HISTORY_HEADER = struct.Struct('<4sIQ')
+
+# values, text bytes, first and last stamp in ns
+HISTORY_CHUNK = struct.Struct('<IIqq')
+
+FLOAT_VALUE = struct.Struct('d')
+UNSIGNED_VALUE = struct.Struct('Q')
+
+ZABBIX_REPLAY_SPEED = 1.0
+ZABBIX_REPLAY_VALUES = 1000
+ZABBIX_REPLAY_TICK = 0.05
+ZABBIX_REPLAY_INFLIGHT = 4
+
+def parse_value(value_type: int, value: str):
+    '''Convert a value from the API to the type it is stored as'''
+    if value_type == VALUE_TYPE_FLOAT:
+        return float(value)
+    if value_type == VALUE_TYPE_UNSIGNED:
+        return int(value)
+    return str(value)
+
+class HistoryWriter():
+    """Write item history to a file, one chunk of values at a time
+
+    The file has a header, the chunks in time order and a marshalled index
+    of the items and chunks. A chunk holds the values of a time window
+    sorted by time, in columns of item numbers, stamps in ns, numeric
+    values as 8 bytes and the offsets and bytes of the text values. The
+    file is written under a temporary name and replaced when closed.
+    """
+
+    def __init__(self, path: str, items: list, source: str = 'history'):
+        self.path = path
+        self.items = items
+        self.source = source
+        self.chunks = []
+        self.values_written = 0
+        self.file = open(path + '.tmp', 'wb')  # pylint: disable=consider-using-with
+        self.file.write(HISTORY_HEADER.pack(HISTORY_MAGIC, HISTORY_VERSION, 0))
+
+    def write_chunk(self, values: list):
+        '''Write a chunk of (stamp_ns, item, value) values, sorted by stamp'''
+        if not values:
+            return
+        count = len(values)
+        item_numbers = array('I', [item for _, item, _ in values])
+        stamps = array('q', [stamp for stamp, _, _ in values])
+        numbers = bytearray(count * 8)
+        offsets = array('I', [0])
+        text = bytearray()
+        for position, (_, item, value) in enumerate(values):
+            value_type = self.items[item][2]
+            if value_type == VALUE_TYPE_FLOAT:
+                FLOAT_VALUE.pack_into(numbers, position * 8, value)
+            elif value_type == VALUE_TYPE_UNSIGNED:
+                UNSIGNED_VALUE.pack_into(numbers, position * 8, value)
+            else:
+                text += value.encode("utf-8")
+            offsets.append(len(text))
+
+        self.chunks.append((self.file.tell(), count, len(text), stamps[0], stamps[-1]))
+        self.file.write(HISTORY_CHUNK.pack(count, len(text), stamps[0], stamps[-1]))
+        for column in (item_numbers, stamps, numbers, offsets, text):
+            self.file.write(column)
+        self.values_written += count
+
+    def close(self, time_from: int, time_till: int):
+        '''Write the index and replace the file, time_from is where replay starts'''
+        index_offset = self.file.tell()
+        self.file.write(marshal.dumps(dict(source=self.source, time_from=time_from,
+                                           time_till=time_till, items=self.items,
+                                           chunks=self.chunks)))
+        self.file.seek(0)
+        self.file.write(HISTORY_HEADER.pack(HISTORY_MAGIC, HISTORY_VERSION, index_offset))
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def discard(self):
+        '''Remove the partly written file'''
+        self.file.close()
+        os.remove(self.path + '.tmp')
+
+class HistoryFile():
+    """Read a history file through a memory map, a chunk at a time
+
+    Only the index is loaded, the values are decoded from the mapped
+    chunks as they are replayed.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, index_offset = HISTORY_HEADER.unpack_from(self.map)
+            if magic != HISTORY_MAGIC or version != HISTORY_VERSION or not index_offset:
+                raise ValueError(f'{path} is not a history file')
+            index = marshal.loads(self.map[index_offset:])
+        except (struct.error, EOFError, TypeError) as err:
+            raise ValueError(f'{path} is not a history file') from err
+        self.source = index['source']
+        self.time_from = index['time_from']
+        self.time_till = index['time_till']
+        self.items = index['items']
+        self.chunks = index['chunks']
+
+    def values(self):
+        '''Get every (stamp_ns, item, value) in time order'''
+        value_types = [value_type for _, _, value_type, _ in self.items]
+        for offset, count, text_size, _, _ in self.chunks:
+            start = offset + HISTORY_CHUNK.size
+            view = memoryview(self.map)[start:start + count * 24 + (count + 1) * 4 + text_size]
+            item_numbers = view[:count * 4].cast('I')
+            stamps = view[count * 4:count * 12].cast('q')
+            floats = view[count * 12:count * 20].cast('d')
+            unsigned = view[count * 12:count * 20].cast('Q')
+            offsets = view[count * 20:count * 24 + 4].cast('I')
+            text = view[count * 24 + 4:]
+            try:
+                for position in range(count):
+                    item = item_numbers[position]
+                    value_type = value_types[item]
+                    if value_type == VALUE_TYPE_FLOAT:
+                        value = floats[position]
+                    elif value_type == VALUE_TYPE_UNSIGNED:
+                        value = unsigned[position]
+                    else:
+                        value = str(text[offsets[position]:offsets[position + 1]], 'utf-8')
+                    yield stamps[position], item, value
+            finally:
+                for column in (item_numbers, stamps, floats, unsigned, offsets, text, view):
+                    column.release()
+
+    def close(self):
+        '''Unmap the file'''
+        self.map.close()
+
+class HistoryReplay():
+    """Send recorded history as agent data, speed times faster than it happened
+
+    The start of the history is replayed when the replay starts and each
+    value is sent when its place in the compressed timeline is reached,
+    with that time as its clock and ns, or its recorded clock and ns with
+    original_clock. Values due within ZABBIX_REPLAY_TICK of each other are
+    sent together, in packets of up to max_values values from any hosts.
+    Passive items have their value set in the passive store instead, for
+    the passive agent to answer with.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, history: HistoryFile, zabbix_active, passive_data=None,
+                 hostnames: list = None, passive_hostnames: list = None,
+                 speed: float = ZABBIX_REPLAY_SPEED, loop: bool = False,
+                 original_clock: bool = False, max_values: int = ZABBIX_REPLAY_VALUES):
+        # pylint: disable=too-many-arguments
+        self.history = history
+        self.zabbix_active = zabbix_active
+        self.passive_data = passive_data
+        self.speed = speed
+        self.loop = loop
+        self.original_clock = original_clock
+        self.max_values = max_values
+
+        # The section of each item, None if it is not replayed here
+        hostnames = None if hostnames is None else set(hostnames)
+        passive_hostnames = None if passive_hostnames is None else set(passive_hostnames)
+        self.targets = []
+        for hostname, _, _, section in history.items:
+            selected = hostnames if section == 'active' else passive_hostnames
+            if section == 'passive' and passive_data is None:
+                self.targets.append(None)
+            else:
+                self.targets.append(section if selected is None or hostname in selected
+                                    else None)
+
+        self.pending = []
+        self.sending = SendTasks(ZABBIX_REPLAY_INFLIGHT)
+
+        # Throughput counters, and how far behind the timeline sends were
+        self.packets_sent = 0
+        self.values_sent = 0
+        self.errors = 0
+        self.passive_values = 0
+        self.max_lag = 0.0
+
+    def set_passive(self, item: int, value):
+        '''Set the value of a passive item, finding its row again after a reload'''
+        hostname, key, _, _ = self.history.items[item]
+        store = self.passive_data
+        if hostname not in store:
+            return
+        # The rows of a reloaded host are reused, so the row is looked up by key each time
+        row = store.key_rows(hostname).get(key)
+        if row is None:
+            return
+        store.set_value(row, value)
+        self.passive_values += 1
+
+    def flush(self):
+        '''Send the pending values as one packet'''
+        if not self.pending:
+            return
+        values = self.pending
+        self.pending = []
+        self.sending.start(self.send, values)
+
+    async def send(self, values: list):
+        '''Send one packet of values'''
+        try:
+            received_data = await self.zabbix_active.send_message(
+                self.zabbix_active.history_data_message(values))
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as err:
+            self.errors += 1
+            METRICS.counters['replay_errors_total'] += 1
+            logging.warning('replay of %d values failed: %s', len(values), err)
+            return
+        logging.debug(received_data.get("info"))
+        self.packets_sent += 1
+        self.values_sent += len(values)
+        METRICS.counters['values_sent_total'] += len(values)
+
+    async def replay(self, deadline: float = None):
+        '''Replay the history once, returns False if the deadline was reached'''
+        history = self.history
+        speed = self.speed
+        started = time.monotonic()
+        wall_started = time.time_ns()
+
+        values = history.values()
+        try:
+            await self.replay_values(values, started, wall_started, deadline)
+        finally:
+            # Release the views of the mapped file
+            values.close()
+        self.flush()
+
+        # The replay lasts as long as the compressed time window
+        end = started + (history.time_till - history.time_from) / speed
+        if deadline is not None and end > deadline:
+            await asyncio.sleep(max(0, deadline - time.monotonic()))
+            return False
+        await asyncio.sleep(max(0, end - time.monotonic()))
+        return True
+
+    async def replay_values(self, values, started: float, wall_started: int,
+                            deadline: float = None):
+        '''Send each value when it is due'''
+        items = self.history.items
+        targets = self.targets
+        origin = self.history.time_from * NS_PER_SECOND
+        speed = self.speed
+        lag = METRICS.histograms['scheduler_lag_seconds']
+        for stamp, item, value in values:
+            target = targets[item]
+            if target is None:
+                continue
+            elapsed = (stamp - origin) / NS_PER_SECOND / speed
+            due = started + elapsed
+            now = time.monotonic()
+            if due > now + ZABBIX_REPLAY_TICK:
+                self.flush()
+                if deadline is not None and due > deadline:
+                    return
+                # Waits while the sends are behind
+                await self.sending.wait()
+                await asyncio.sleep(max(0, due - time.monotonic()))
+            else:
+                self.max_lag = max(self.max_lag, now - due)
+                lag.observe(max(0, now - due))
+
+            if target == 'passive':
+                self.set_passive(item, value)
+                continue
+            clock, ns = divmod(stamp if self.original_clock
+                               else wall_started + int(elapsed * NS_PER_SECOND), NS_PER_SECOND)
+            self.pending.append(dict(host=items[item][0], key=items[item][1],
+                                     value=str(value), clock=clock, ns=ns))
+            if len(self.pending) >= self.max_values:
+                self.flush()
+                # Let the sends run when a burst of values is due at once, waiting
+                # while they are behind
+                await asyncio.sleep(0)
+                await self.sending.wait()
+
+    async def run(self, duration: float = None):
+        '''Replay the history, for duration seconds or until cancelled or finished'''
+        started = time.monotonic()
+        deadline = None if duration is None else started + duration
+        logging.info('replaying %s of %d items from %s at %gx', self.history.source,
+                     len(self.history.items), time.ctime(self.history.time_from), self.speed)
+        try:
+            while await self.replay(deadline) and self.loop:
+                pass
+        finally:
+            self.flush()
+            await self.sending.join()
+            self.log_stats(time.monotonic() - started)
+
+    def totals(self):
+        '''Get the packets and values sent and the errors'''
+        return self.packets_sent, self.values_sent, self.errors
+
+    def log_stats(self, elapsed: float):
+        '''Log the throughput of the replay'''
+        if elapsed <= 0:
+            return
+        logging.info('replay packets %d (%.1f/s), values %d (%.1f/s), passive values %d, '
+                     'errors %d, max lag %.3fs', self.packets_sent, self.packets_sent / elapsed,
+                     self.values_sent, self.values_sent / elapsed, self.passive_values,
+                     self.errors, self.max_lag)
@@ -0,0 +1,265 @@
+#
+# Load the zabbixsim configuration and simulation files
+#
+
+"""Simulation data loader"""
+import concurrent.futures
+import configparser
+import functools
+import glob
+import hashlib
+import logging
+import marshal
+import mmap
+import os
+import random
+import struct
+import yaml
+from zabbixsim.store import ItemStore, VALUE_TYPE_TEXT
+
+DEFAULTS = 'zabbixsim.cfg'
+
+# Compiled simulation files, see write_snapshot
+SNAPSHOT_FILE = '.zabbixsim.snapshot'
+SNAPSHOT_MAGIC = b'ZSIM'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<4sIQ')
+
+SECTIONS = ('active', 'passive')
+
+# Hostname of clone n of a recorded host, see add_clones
+ZABBIX_CLONE_NAME = '{host}-{n:05}'
+
+def load_config(config_path: str = DEFAULTS):
+    '''Load the zabbixsim config file'''
+    config = configparser.ConfigParser()
+    logging.debug('ConfigPath = %s', config_path)
+    config.read(config_path)
+    return config
+
+def yaml_loader():
+    '''Get the fastest safe YAML loader, libyaml when it is available'''
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def item_row(item: dict):
+    '''Convert a recorded item to a (name, key_, value_type, lastvalue, delay, generator) row'''
+    return (item['name'], item['key_'], item.get('value_type', VALUE_TYPE_TEXT),
+            item.get('lastvalue'), item['delay'], item.get('generator'))
+
+def compile_host(host_data: dict):
+    '''Compile the sections of a host, returns the section names and the marshalled rows'''
+    rows = {section: [item_row(item) for item in host_data[section]]
+            for section in SECTIONS if section in host_data}
+    try:
+        blob = marshal.dumps(rows)
+    except ValueError:
+        # Values YAML loaded as other types, such as dates, are kept as text
+        rows = {section: [row[:3] + (str(row[3]),) + row[4:] for row in section_rows]
+                for section, section_rows in rows.items()}
+        blob = marshal.dumps(rows)
+    return tuple(rows), blob
+
+def parse_sim_file(filename: str):
+    '''Parse a simulation file, returns its digest and compiled hosts'''
+    with open(filename, 'rb') as file:
+        content = file.read()
+    loaded_data = yaml.load(content, Loader=yaml_loader()) or {}
+
+    hosts = []
+    for hostname, host_data in loaded_data.items():
+        sections, blob = compile_host(host_data)
+        hosts.append((str(hostname), sections, blob))
+    return hashlib.sha1(content).hexdigest(), hosts
+
+def parse_sim_files(filenames: list, workers: int = None):
+    '''Parse simulation files, in parallel processes when there are several'''
+    workers = min(workers or os.cpu_count() or 1, len(filenames))
+    if workers <= 1:
+        return [parse_sim_file(filename) for filename in filenames]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(filenames) // (workers * 4))
+        return list(executor.map(parse_sim_file, filenames, chunksize=chunksize))
+
+def file_digest(filename: str):
+    '''Get the digest of a file'''
+    with open(filename, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+def read_snapshot(snapshot_path: str):
+    '''Read the snapshot index, returns the index with each host blob as a memory view'''
+    try:
+        with open(snapshot_path, 'rb') as file:
+            snapshot = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return {}
+
+    view = memoryview(snapshot)
+    try:
+        magic, version, index_size = SNAPSHOT_HEADER.unpack_from(view)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            return {}
+        blobs_start = SNAPSHOT_HEADER.size + index_size
+        index = marshal.loads(view[SNAPSHOT_HEADER.size:blobs_start])
+    except (struct.error, EOFError, ValueError, TypeError):
+        logging.warning('ignoring invalid snapshot %s', snapshot_path)
+        return {}
+
+    for entry in index.values():
+        entry[3] = [(hostname, sections, view[blobs_start + offset:blobs_start + offset + size])
+                    for hostname, sections, offset, size in entry[3]]
+    return index
+
+def write_snapshot(snapshot_path: str, index: dict):
+    '''Write the snapshot, a marshalled index followed by the host blobs
+
+    The index maps each file name to [mtime_ns, size, digest, hosts] and
+    each host is (hostname, sections, offset, size) of its blob.
+    '''
+    blobs = []
+    offset = 0
+    snapshot_index = {}
+    for filename, (mtime_ns, size, digest, hosts) in index.items():
+        snapshot_hosts = []
+        for hostname, sections, blob in hosts:
+            snapshot_hosts.append((hostname, sections, offset, len(blob)))
+            blobs.append(blob)
+            offset += len(blob)
+        snapshot_index[filename] = [mtime_ns, size, digest, snapshot_hosts]
+
+    index_data = marshal.dumps(snapshot_index)
+    temp_path = snapshot_path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(index_data)))
+        file.write(index_data)
+        for blob in blobs:
+            file.write(blob)
+    os.replace(temp_path, snapshot_path)
+
+def load_section(blob, section: str):
+    '''Unmarshal the rows of a host section'''
+    return marshal.loads(blob)[section]
+
+def scan_sim_files(directory: str, cached: dict):
+    '''Compare the simulation files with the cached index
+
+    Returns the new index and the files to parse. Files whose mtime and
+    size are unchanged, or whose digest is unchanged, keep their cached
+    hosts and the files to parse have no hosts yet.
+    '''
+    index = {}
+    stale = []
+    for filename in sorted(glob.glob(os.path.join(directory, "*.yaml"))):
+        name = os.path.basename(filename)
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            continue
+        entry = cached.get(name)
+        if entry and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+            index[name] = entry
+        elif entry and entry[2] == file_digest(filename):
+            index[name] = [stat.st_mtime_ns, stat.st_size] + entry[2:]
+        else:
+            index[name] = [stat.st_mtime_ns, stat.st_size, None, []]
+            stale.append(filename)
+    return index, stale
+
+def load_index(directory: str = None, snapshot: bool = False, workers: int = None):
+    '''Load the compiled hosts of the simulation files, see load_sim_data'''
+    directory = directory or os.getcwd()
+    snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+    cached = read_snapshot(snapshot_path) if snapshot else {}
+
+    index, stale = scan_sim_files(directory, cached)
+    for filename, (digest, hosts) in zip(stale, parse_sim_files(stale, workers)):
+        index[os.path.basename(filename)][2:] = [digest, hosts]
+    logging.info('loaded %d simulation files, %d parsed', len(index), len(stale))
+
+    if snapshot and (stale or index.keys() != cached.keys() or
+                     any(index[name][:2] != cached[name][:2] for name in index)):
+        write_snapshot(snapshot_path, index)
+    return index
+
+def build_stores(index: dict):
+    '''Add the compiled hosts to item stores, returns the active data, passive data and hostnames'''
+    active_data = ItemStore()
+    passive_data = ItemStore()
+    hostnames = []
+    stores = dict(active=active_data, passive=passive_data)
+    for _, _, _, hosts in index.values():
+        for hostname, sections, blob in hosts:
+            for section in sections:
+                stores[section].add_lazy_host(hostname, functools.partial(load_section,
+                                                                          blob, section))
+
+            # Load the hostnames
+            hostnames.append(hostname)
+
+    return active_data, passive_data, hostnames
+
+def add_clones(active_data: ItemStore, passive_data: ItemStore, hostnames: list, count: int,
+               name_format: str = ZABBIX_CLONE_NAME, offset: float = 0.0,
+               templates: list = None):
+    '''Add count clones of each template host, all recorded hosts by default
+
+    Clone n of a host is named from name_format with {host} and {n}, from
+    1. Clones share the item rows of their host, each has its numeric
+    values moved by a fixed fraction of the value up to offset either way,
+    the same for a clone on every run. Returns the hostnames of the clones.
+    '''
+    # pylint: disable=too-many-arguments
+    clone_names = []
+    existing = set(hostnames)
+    for template in templates or hostnames:
+        if template not in existing:
+            logging.warning('clone template %s is not a recorded host', template)
+            continue
+        for number in range(1, count + 1):
+            hostname = name_format.format(host=template, n=number)
+            if hostname in existing:
+                logging.warning('clone %s of %s is already a host', hostname, template)
+                continue
+            clone_offset = random.Random(hostname).uniform(-offset, offset) if offset else 0.0
+            for store in (active_data, passive_data):
+                if template in store:
+                    store.add_clone(hostname, template, clone_offset)
+            existing.add(hostname)
+            clone_names.append(hostname)
+    return clone_names
+
+def clones_from_config(config, active_data: ItemStore, passive_data: ItemStore, hostnames: list):
+    '''Add the clones set in the config, returns the hostnames with the clones'''
+    count = config.getint('SETTINGS', 'clones', fallback=0)
+    if count <= 0:
+        return hostnames
+    templates = config.get('SETTINGS', 'clone_hosts', fallback='')
+    clone_names = add_clones(
+        active_data, passive_data, hostnames, count,
+        name_format=config.get('SETTINGS', 'clone_name', fallback=ZABBIX_CLONE_NAME, raw=True),
+        offset=config.getfloat('SETTINGS', 'clone_offset', fallback=0.0),
+        templates=[name.strip() for name in templates.split(',') if name.strip()])
+    logging.info('added %d clones', len(clone_names))
+    return hostnames + clone_names
+
+def clone_hostnames(hostnames: list, active_data: ItemStore, passive_data: ItemStore):
+    '''Get the hostnames followed by the clones in the item stores, such as after a reload
+
+    The clones of removed template hosts are removed with them and the
+    clones of the other hosts are kept, in the order they were added.
+    '''
+    existing = set(hostnames)
+    return hostnames + [hostname for hostname in dict.fromkeys([*active_data.clones,
+                                                                *passive_data.clones])
+                        if hostname not in existing]
+
+def load_sim_data(directory: str = None, snapshot: bool = False, workers: int = None):
+    '''Load the recorded items, returns the active data, passive data and hostnames
+
+    Hosts are compiled when loaded and added to the item stores as lazy
+    hosts, their items are only unpacked when the host is first used.
+    With snapshot the compiled hosts are cached in a snapshot file, a
+    simulation file is only parsed again when its mtime, size and digest
+    show it has changed.
+    '''
+    return build_stores(load_index(directory, snapshot, workers))
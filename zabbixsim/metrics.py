@@ -0,0 +1,184 @@
+#
+# Runtime metrics, served in the Prometheus text format
+#
+
+"""Simulator metrics"""
+import asyncio
+import bisect
+import collections
+import logging
+import threading
+
+ZABBIX_METRICS_LISTEN = '127.0.0.1'
+ZABBIX_METRICS_TIMEOUT = 5
+
+# Latency bucket bounds in seconds, 1, 2.5 and 5 in each decade from 100us
+LATENCY_BUCKETS = tuple(scale * 10.0 ** exponent for exponent in range(-4, 2)
+                        for scale in (1, 2.5, 5))
+
+# Send deviation bucket bounds in seconds, 10 in each decade from 10us to 100s, for
+# percentiles within a quarter of their value
+DEVIATION_BUCKETS = tuple(10.0 ** (exponent / 10) for exponent in range(-50, 21))
+
+class Histogram():
+    """Count observations in fixed buckets
+
+    Observing is a bisect and two additions, with no lock. A render from
+    another thread, such as the metrics thread of the Tk interface, works
+    on a copy of the counts and may see a count a moment before its sum,
+    which a scraper does not notice.
+    """
+    __slots__ = ('bounds', 'counts', 'total')
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+
+    def observe(self, value: float, count: int = 1):
+        '''Count one observation, or count observations of the same value'''
+        self.counts[bisect.bisect_left(self.bounds, value)] += count
+        self.total += value * count
+
+    def count(self):
+        '''Get the number of observations'''
+        return sum(self.counts)
+
+    def quantile(self, fraction: float):
+        '''Get the upper bound of the bucket holding a quantile, or None'''
+        target = self.count() * fraction
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return None
+
+class Metrics():
+    """Counters, histograms and gauges of the simulator
+
+    Counters and histograms are updated on the hot path, gauges are
+    functions only called when the metrics are rendered. Rendering copies
+    each mapping before iterating it, since the sending thread may add
+    keys while another thread renders.
+    """
+
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.histograms = collections.defaultdict(Histogram)
+        self.histograms['send_deviation_seconds'] = Histogram(DEVIATION_BUCKETS)
+        self.gauges = {}
+        self.host_errors = collections.defaultdict(int)
+
+    def add_gauge(self, name: str, function):
+        '''Report the value of function() as a gauge'''
+        self.gauges[name] = function
+
+    def render(self):
+        '''Render the metrics in the Prometheus text format'''
+        lines = []
+        for name, value in sorted(list(self.counters.items())):
+            lines += [f'# TYPE zabbixsim_{name} counter', f'zabbixsim_{name} {value}']
+
+        for name, function in sorted(list(self.gauges.items())):
+            try:
+                value = function()
+            except (AttributeError, TypeError, ValueError) as err:
+                logging.debug('gauge %s failed: %s', name, err)
+                continue
+            lines += [f'# TYPE zabbixsim_{name} gauge', f'zabbixsim_{name} {value}']
+
+        for name, histogram in sorted(list(self.histograms.items())):
+            lines.append(f'# TYPE zabbixsim_{name} histogram')
+            counts = list(histogram.counts)
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, counts):
+                cumulative += count
+                lines.append(f'zabbixsim_{name}_bucket{{le="{bound:g}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines += [f'zabbixsim_{name}_bucket{{le="+Inf"}} {cumulative}',
+                      f'zabbixsim_{name}_sum {histogram.total}',
+                      f'zabbixsim_{name}_count {cumulative}']
+
+        lines.append('# TYPE zabbixsim_host_errors_total counter')
+        for hostname, count in sorted(list(self.host_errors.items())):
+            escaped = hostname.replace('\\', '\\\\').replace('"', '\\"')
+            lines.append(f'zabbixsim_host_errors_total{{host="{escaped}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def observe_sent(self, stamps: list, sent: int):
+        '''Count how long after their due time values were sent, all times in ns'''
+        histogram = self.histograms['send_deviation_seconds']
+        for stamp, count in collections.Counter(stamps).items():
+            histogram.observe(max(0, sent - stamp) / 1e9, count)
+
+    def deviation_report(self):
+        '''Get the percentiles of the send deviation and the checks skipped, for the log'''
+        histogram = self.histograms['send_deviation_seconds']
+        count = histogram.count()
+        if not count:
+            return ''
+        percentiles = ' '.join(f'p{fraction * 100:g} {histogram.quantile(fraction) * 1000:.3g}ms'
+                               for fraction in (0.5, 0.9, 0.99, 0.999))
+        return (f'{percentiles} mean {histogram.total / count * 1000:.3g}ms, {count} values, '
+                f'{self.counters["checks_skipped_total"]} checks skipped')
+
+    def summary(self):
+        '''Get a one line summary of the latencies, for the stats log'''
+        parts = []
+        for name, histogram in sorted(list(self.histograms.items())):
+            if histogram.count():
+                parts.append(f'{name} p50 {histogram.quantile(0.5):g}s '
+                             f'p99 {histogram.quantile(0.99):g}s')
+        return ', '.join(parts)
+
+# The metrics of this process
+METRICS = Metrics()
+
+async def handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    '''Answer an HTTP request with the metrics'''
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), ZABBIX_METRICS_TIMEOUT)
+        method, path = request.split(b' ', 2)[:2]
+        if method != b'GET':
+            status, body = b'405 Method Not Allowed', b''
+        elif path.split(b'?')[0] in (b'/', b'/metrics'):
+            status, body = b'200 OK', METRICS.render().encode("utf-8")
+        else:
+            status, body = b'404 Not Found', b''
+        writer.write(b'HTTP/1.1 %s\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body)))
+        writer.write(body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ConnectionError, ValueError) as err:
+        logging.debug('metrics request failed: %s', err)
+    finally:
+        writer.close()
+
+async def start_metrics(port: int, listen: str = ZABBIX_METRICS_LISTEN):
+    '''Serve the metrics on http://listen:port/metrics, returns the server'''
+    server = await asyncio.start_server(handle_scrape, listen, port, reuse_address=True)
+    logging.info('metrics on http://%s:%d/metrics', listen, port)
+    return server
+
+def metrics_from_config(config):
+    '''Get the metrics port and listen address from the config, the port is None if disabled'''
+    port = config.getint('SETTINGS', 'metrics_port', fallback=0) or None
+    return port, config.get('SETTINGS', 'metrics_listen', fallback=ZABBIX_METRICS_LISTEN)
+
+def start_loop_thread(start, name: str):
+    '''Run start() and then an event loop in a background daemon thread, returns the loop
+
+    start() returns the coroutine that starts the servers of the loop, it
+    runs before the thread so errors such as a port in use are raised to
+    the caller. Calls are run in the loop with call_soon_threadsafe.
+    '''
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(start())
+    threading.Thread(target=loop.run_forever, name=name, daemon=True).start()
+    return loop
+
+def start_metrics_thread(port: int, listen: str = ZABBIX_METRICS_LISTEN):
+    '''Serve the metrics from a background thread, for the Tk interface, returns its loop'''
+    return start_loop_thread(lambda: start_metrics(port, listen), 'ZabbixMetrics')
@@ -0,0 +1,275 @@
+#
+# Minimal Zabbix server for testing the simulator
+#
+
+"""Mock Zabbix server"""
+import asyncio
+import http.server
+import json
+import logging
+import threading
+import time
+from zabbixsim.protocol import ProtocolError, encode_parts, read_message
+
+class MockZabbixServer():
+    """Answer active checks and agent data requests, counting what is received
+
+    With keep_alive false the connection is closed after each response, like
+    the Zabbix server. With truncate only that many bytes of each response
+    are sent before the connection is closed, like a server that fails
+    after storing the values.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, checks: dict = None,
+                 keep_alive: bool = True, compress: bool = False, truncate: int = None):
+        # pylint: disable=too-many-arguments
+        self.host = host
+        self.port = port
+        self.checks = checks or {}
+        self.keep_alive = keep_alive
+        self.compress = compress
+        self.truncate = truncate
+        self.server = None
+
+        # The writer of each open connection, by its handler task
+        self.handlers = {}
+
+        # Received counters
+        self.connections = 0
+        self.packets = 0
+        self.values = 0
+
+    def response(self, request: dict):
+        '''Build the response for a request'''
+        if request.get('request') == 'active checks':
+            # Hosts without checks are unknown, as to a server they are not configured on
+            hostname = request.get('host')
+            if hostname not in self.checks:
+                return dict(response="failed", info=f'host [{hostname}] not found')
+            return dict(response="success", data=self.checks[hostname])
+
+        values = len(request.get('data', []))
+        self.values += values
+        return dict(response="success",
+                    info=f'processed: {values}; failed: 0; total: {values}; '
+                         'seconds spent: 0.000001')
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        '''Handle the requests on one connection'''
+        self.connections += 1
+        task = asyncio.current_task()
+        self.handlers[task] = writer
+        try:
+            while True:
+                request = await read_message(reader)
+                self.packets += 1
+
+                json_data = json.dumps(self.response(request)).encode("utf-8")
+                if self.truncate is not None:
+                    writer.write(b''.join(encode_parts(json_data, self.compress))[:self.truncate])
+                    await writer.drain()
+                    break
+                writer.writelines(encode_parts(json_data, self.compress))
+                await writer.drain()
+                if not self.keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            self.handlers.pop(task, None)
+            writer.close()
+
+    async def start(self):
+        '''Start listening, returns the bound port'''
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, backlog=4096)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.debug('mock server listening on %s:%d', self.host, self.port)
+        return self.port
+
+    async def stop(self):
+        '''Stop listening and close the open connections, waiting for their handlers'''
+        self.server.close()
+        await self.server.wait_closed()
+
+        # Closed connections read as ended, so each handler returns rather than being cancelled
+        handlers = list(self.handlers)
+        for writer in self.handlers.values():
+            writer.close()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+class MockZabbixAPI():
+    """Answer the JSON-RPC requests of zabbixrec for synthetic hosts
+
+    Each host has items agent items, half active and half passive, with a
+    value every delay seconds in history.get and hourly in trend.get. Each
+    request takes latency seconds plus item_latency seconds per item
+    returned, like the database queries of a real frontend.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, hosts: int, items: int, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.01, item_latency: float = 0.00001):
+        # pylint: disable=too-many-arguments
+        self.hosts = hosts
+        self.items = items
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.item_latency = item_latency
+        self.server = None
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        # Changed item names, by itemid and by template item, the audit log
+        # of the changes and the items discovered on each host
+        self.item_names = {}
+        self.template_names = {}
+        self.audit = []
+        self.discovered = {}
+
+    def update_item(self, hostid: int, item_num: int, name: str):
+        '''Rename an item, recording the change in the audit log'''
+        itemid = str(hostid * self.items + item_num)
+        self.item_names[itemid] = name
+        self.audit.append(dict(clock=str(int(time.time())), resourcetype='15',
+                               resourceid=itemid))
+
+    def update_template_item(self, item_num: int, name: str):
+        '''Rename an item on its template, the audit log has the template itemid'''
+        self.template_names[item_num] = name
+        self.audit.append(dict(clock=str(int(time.time())), resourcetype='15',
+                               resourceid=str(self.hosts * self.items + item_num)))
+
+    def discover_item(self, hostid: int, name: str):
+        '''Add an item to a host like low level discovery, without an audit record'''
+        items = self.discovered.setdefault(str(hostid), [])
+        itemid = str((self.hosts + 1) * self.items + hostid * 1000 + len(items))
+        items.append(dict(itemid=itemid, hostid=str(hostid), type='7', name=name,
+                          key_=f'sim.discovered[{len(items)}]', value_type='3',
+                          lastvalue='0', delay='1m'))
+
+    def host_items(self, hostid: str, item_types: list):
+        '''Generate the items of a host'''
+        items = []
+        for item_num in range(self.items):
+            item_type = '7' if item_num % 2 else '0'
+            if item_types and item_type not in item_types:
+                continue
+            itemid = str(int(hostid) * self.items + item_num)
+            name = self.template_names.get(item_num, f'Item {item_num:05}')
+            items.append(dict(itemid=itemid,
+                              hostid=hostid,
+                              type=item_type,
+                              name=self.item_names.get(itemid, name),
+                              key_=f'sim.item[{item_num}]',
+                              value_type='3',
+                              lastvalue=str(item_num),
+                              delay='1m' if item_num % 3 else '30'))
+        items.extend(dict(item) for item in self.discovered.get(str(hostid), [])
+                     if not item_types or item['type'] in item_types)
+        return items
+
+    def item_history(self, itemids: list, time_from: int, time_till: int, limit: int,
+                     trends: bool = False):
+        '''Generate the history of items, a value every delay seconds, or hourly trends'''
+        records = []
+        for itemid in itemids:
+            item_num = int(itemid) % self.items
+            delay = 3600 if trends else (60 if item_num % 3 else 30)
+            for clock in range(-(-time_from // delay) * delay, time_till + 1, delay):
+                value = str((clock // delay + item_num) % 100)
+                if trends:
+                    records.append(dict(itemid=itemid, clock=str(clock), value_avg=value))
+                else:
+                    records.append(dict(itemid=itemid, clock=str(clock),
+                                        ns=str(int(itemid) * 7919 % 1000000000), value=value))
+        records.sort(key=lambda record: int(record['clock']))
+        time.sleep(self.item_latency * len(records))
+        return records[:limit]
+
+    def result(self, method: str, params: dict):
+        '''Build the result of a method call'''
+        if method == 'apiinfo.version':
+            return '5.0.0'
+        if method == 'user.login':
+            return '0424bd59b807674191e7d77572075f33'
+        if method == 'user.logout':
+            return True
+        if method == 'host.get':
+            return [dict(hostid=str(hostid), host=f'simhost{hostid:06}')
+                    for hostid in range(self.hosts)]
+        if method == 'auditlog.get':
+            resource_types = [str(resource_type) for resource_type
+                              in params.get('filter', {}).get('resourcetype', [])]
+            return [record for record in self.audit
+                    if int(record['clock']) >= params.get('time_from', 0) and
+                    (not resource_types or record['resourcetype'] in resource_types)]
+        if method == 'item.get' and 'itemids' in params:
+            return [dict(itemid=itemid, hostid=str(int(itemid) // self.items))
+                    for itemid in params['itemids']]
+        if method == 'item.get':
+            hostids = params.get('hostids', [])
+            if not isinstance(hostids, list):
+                hostids = [hostids]
+            item_types = params.get('filter', {}).get('type', [])
+            if not isinstance(item_types, list):
+                item_types = [item_types]
+            items = [item for hostid in hostids for item in self.host_items(hostid, item_types)]
+            output = params.get('output')
+            if isinstance(output, list):
+                items = [{field: item[field] for field in item
+                          if field in output or field == 'itemid'} for item in items]
+            time.sleep(self.item_latency * len(items))
+            return items
+        if method in ('history.get', 'trend.get'):
+            if method == 'history.get' and str(params.get('history')) != '3':
+                return []
+            return self.item_history(params.get('itemids', []), params['time_from'],
+                                     params['time_till'], params.get('limit', 1 << 31),
+                                     trends=method == 'trend.get')
+        raise ValueError(f'unsupported method {method}')
+
+    def start(self):
+        '''Start serving in a background thread, returns the URL'''
+        mock_api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """JSON-RPC request handler"""
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                # pylint: disable=invalid-name
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with mock_api.lock:
+                    mock_api.requests += 1
+                time.sleep(mock_api.latency)
+                try:
+                    response = dict(jsonrpc='2.0', id=request.get('id'),
+                                    result=mock_api.result(request['method'],
+                                                           request.get('params', {})))
+                except ValueError as err:
+                    response = dict(jsonrpc='2.0', id=request.get('id'),
+                                    error=dict(code=-32601, message='Method not found',
+                                               data=str(err)))
+                body = json.dumps(response).encode("utf-8")
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # pylint: disable=arguments-differ
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name='MockZabbixAPI',
+                         daemon=True).start()
+        return f'http://{self.host}:{self.port}/zabbix'
+
+    def stop(self):
+        '''Stop serving'''
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,173 @@
+#
+# Zabbix passive agent protocol
+#
+
+"""Zabbix passive agent"""
+import asyncio
+import contextlib
+import ipaddress
+import logging
+from zabbixsim.metrics import start_loop_thread
+from zabbixsim.protocol import ProtocolError, encode_parts, read_payload, ZBXD_MAGIC
+from zabbixsim.reload import reload_store
+
+ZABBIX_PASSIVE_PORT = 10050
+ZABBIX_PASSIVE_TIMEOUT = 3
+ZABBIX_PASSIVE_BACKLOG = 4096
+ZABBIX_AGENT_VERSION = '5.0.0'
+ZABBIX_NOTSUPPORTED = b'ZBX_NOTSUPPORTED\0'
+
+def passive_addresses(hostnames: list, listen: str = '0.0.0.0', port: int = ZABBIX_PASSIVE_PORT,
+                      mode: str = 'port', first_ip: str = '127.0.1.1'):
+    '''Assign a listen address to each host, returns the listen addresses and address map
+
+    In port mode host n listens on port + n. In ip mode all hosts share
+    one listener on port and host n is polled on first_ip + n, which must
+    be an address of this machine (any 127.x.y.z address on Linux).
+    '''
+    if mode == 'ip':
+        ip_address = ipaddress.ip_address(first_ip)
+        address_map = {(str(ip_address + index), port): hostname
+                       for index, hostname in enumerate(hostnames)}
+        return [(listen, port)], address_map
+
+    address_map = {(None, port + index): hostname for index, hostname in enumerate(hostnames)}
+    return [(listen, host_port) for _, host_port in address_map], address_map
+
+def format_value(value):
+    '''Format an item value as the agent would return it'''
+    if isinstance(value, float):
+        return repr(value).encode("utf-8")
+    return str(value).encode("utf-8")
+
+class ZabbixPassive():
+    """Answer passive checks for the simulated hosts
+
+    lock guards the item store when another thread changes it, as the Tk
+    interface does while the passive agent runs in a background thread.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, passive_data, listen: list, address_map: dict,
+                 timeout: float = ZABBIX_PASSIVE_TIMEOUT, lock=None):
+        # pylint: disable=too-many-arguments
+        logging.debug("ZabbixPassive")
+        self.passive_data = passive_data
+        self.listen = listen
+        self.address_map = address_map
+        self.timeout = timeout
+        self.lock = lock or contextlib.nullcontext()
+        self.servers = []
+
+        # Request counters
+        self.requests = 0
+        self.unsupported = 0
+
+    def hostname_for(self, sockname: tuple):
+        '''Get the host polled on a local address'''
+        local_ip, local_port = sockname[:2]
+        return self.address_map.get((local_ip, local_port)) or \
+            self.address_map.get((None, local_port))
+
+    def keys_for(self, hostname: str):
+        '''Get the key index of a host, clones share the index of their template'''
+        return self.passive_data.key_rows(hostname)
+
+    def get_value(self, hostname: str, key: str):
+        '''Get the response for a key of a host'''
+        with self.lock:
+            row = self.keys_for(hostname).get(key) if hostname else None
+            if row is not None:
+                return format_value(self.passive_data.host_value(hostname, row))
+
+        # Keys every agent supports
+        if key == 'agent.ping':
+            return b'1'
+        if key == 'agent.hostname' and hostname:
+            return hostname.encode("utf-8")
+        if key == 'agent.version':
+            return ZABBIX_AGENT_VERSION.encode("utf-8")
+
+        self.unsupported += 1
+        return ZABBIX_NOTSUPPORTED + b'Unsupported item key.'
+
+    def reload(self, changed: list, removed: list):
+        '''Apply reloaded hosts, new hosts are only answered if they have an address'''
+        with self.lock:
+            reload_store(self.passive_data, 'passive', changed, removed)
+
+    async def read_key(self, reader: asyncio.StreamReader):
+        '''Read the requested key, ZBXD framed or a plain line from older servers'''
+        prefix = b''
+        while len(prefix) < len(ZBXD_MAGIC) and b'\n' not in prefix:
+            data = await reader.read(len(ZBXD_MAGIC) - len(prefix))
+            if not data:
+                break
+            prefix += data
+
+        if prefix.startswith(ZBXD_MAGIC):
+            request = await read_payload(reader, prefix=prefix)
+        elif b'\n' in prefix:
+            request = prefix
+        else:
+            request = prefix + await reader.readline()
+        return str(request, 'utf-8').strip()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        '''Answer one passive check'''
+        try:
+            key = await asyncio.wait_for(self.read_key(reader), self.timeout)
+            self.requests += 1
+            hostname = self.hostname_for(writer.get_extra_info('sockname'))
+            logging.debug('passive %s %s', hostname, key)
+            writer.writelines(encode_parts(self.get_value(hostname, key)))
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError,
+                ProtocolError, UnicodeDecodeError) as err:
+            logging.debug('passive check failed: %s', err)
+        finally:
+            writer.close()
+
+    async def start(self):
+        '''Start listening on every listen address'''
+        for listen_ip, port in self.listen:
+            self.servers.append(await asyncio.start_server(
+                self.handle, listen_ip, port, backlog=ZABBIX_PASSIVE_BACKLOG, reuse_address=True))
+        logging.info('passive agent listening on %d addresses for %d hosts',
+                     len(self.listen), len(self.address_map))
+
+    async def stop(self):
+        '''Stop listening'''
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.servers = []
+
+def passive_from_config(config, passive_data, hostnames: list = None, lock=None):
+    '''Create the passive agent from the config, or None if it is not enabled
+
+    With hostnames only those hosts are answered, on the same addresses
+    they have when all hosts are answered, each on its own listener.
+    lock guards the item store, see ZabbixPassive.
+    '''
+    if not config.getboolean('SETTINGS', 'passive', fallback=False) or not passive_data:
+        return None
+    listen, address_map = passive_addresses(
+        list(passive_data),
+        listen=config.get('SETTINGS', 'passive_listen', fallback='0.0.0.0'),
+        port=config.getint('SETTINGS', 'passive_port', fallback=ZABBIX_PASSIVE_PORT),
+        mode=config.get('SETTINGS', 'passive_mode', fallback='port'),
+        first_ip=config.get('SETTINGS', 'passive_first_ip', fallback='127.0.1.1'))
+    if hostnames is not None:
+        hostnames = set(hostnames)
+        address_map = {address: hostname for address, hostname in address_map.items()
+                       if hostname in hostnames}
+        listen_ip = listen[0][0]
+        listen = [(local_ip or listen_ip, port) for local_ip, port in address_map]
+        if not listen:
+            return None
+    return ZabbixPassive(passive_data, listen, address_map, lock=lock)
+
+def start_passive_thread(zabbix_passive: ZabbixPassive):
+    '''Run the passive agent in a background thread, for the Tk interface, returns its loop'''
+    return start_loop_thread(zabbix_passive.start, 'ZabbixPassive')
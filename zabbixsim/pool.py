@@ -0,0 +1,185 @@
+#
+# Reusable connections to the Zabbix server
+#
+
+"""Connection pools"""
+import asyncio
+import collections
+import logging
+import select
+import socket
+import threading
+import time
+from zabbixsim.metrics import METRICS
+
+ZABBIX_POOL_SIZE = 64
+ZABBIX_POOL_IDLE = 30
+ZABBIX_TIMEOUT = 10
+
+class ConnectionPool():
+    """Bounded pool of blocking sockets for each server address"""
+
+    def __init__(self, max_size: int = ZABBIX_POOL_SIZE, idle_timeout: float = ZABBIX_POOL_IDLE,
+                 timeout: float = ZABBIX_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        # Idle sockets and the number of open sockets for each address
+        self.idle = collections.defaultdict(collections.deque)
+        self.open = collections.defaultdict(int)
+
+        # Addresses that close the connection after each response
+        self.persistent = {}
+        self.lock = threading.Condition()
+
+    @classmethod
+    def healthy(cls, pooled_socket: socket.socket):
+        '''Check an idle socket has not been closed by the server'''
+        try:
+            readable, _, _ = select.select([pooled_socket], [], [], 0)
+            if not readable:
+                return True
+            # An idle socket should never have data waiting, b'' means closed
+            pooled_socket.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def evict_idle(self, address: tuple = None):
+        '''Close the sockets that have been idle for longer than idle_timeout'''
+        expired = time.monotonic() - self.idle_timeout
+        with self.lock:
+            for idle_address in [address] if address else list(self.idle):
+                idle = self.idle[idle_address]
+                while idle and idle[0][1] < expired:
+                    self.close_socket(idle_address, idle.popleft()[0])
+
+    def close_socket(self, address: tuple, pooled_socket: socket.socket):
+        '''Close a socket and free its slot, the lock must be held'''
+        pooled_socket.close()
+        self.open[address] -= 1
+        self.lock.notify()
+
+    def acquire(self, address: tuple):
+        '''Get a connected socket for the address, returns the socket and if it was reused'''
+        self.evict_idle(address)
+        with self.lock:
+            idle = self.idle[address]
+            while True:
+                # Most recently used first, it is the least likely to have been closed
+                while idle:
+                    pooled_socket, _ = idle.pop()
+                    if self.healthy(pooled_socket):
+                        return pooled_socket, True
+                    logging.debug('%s closed an idle connection', address)
+                    self.persistent[address] = False
+                    self.close_socket(address, pooled_socket)
+
+                if self.open[address] < self.max_size:
+                    self.open[address] += 1
+                    break
+                self.lock.wait()
+
+        started = time.perf_counter()
+        try:
+            new_socket = socket.create_connection(address, timeout=self.timeout)
+        except OSError:
+            METRICS.counters['connect_errors_total'] += 1
+            with self.lock:
+                self.open[address] -= 1
+                self.lock.notify()
+            raise
+        METRICS.histograms['connect_seconds'].observe(time.perf_counter() - started)
+        new_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return new_socket, False
+
+    def release(self, address: tuple, pooled_socket: socket.socket, reusable: bool = True):
+        '''Return a socket to the pool, or close it if it can not be reused'''
+        with self.lock:
+            if reusable and self.persistent.get(address, True):
+                self.idle[address].append((pooled_socket, time.monotonic()))
+                self.lock.notify()
+            else:
+                self.close_socket(address, pooled_socket)
+
+    def close(self):
+        '''Close all idle sockets'''
+        with self.lock:
+            for address, idle in self.idle.items():
+                while idle:
+                    self.close_socket(address, idle.pop()[0])
+
+class AsyncConnectionPool():
+    """Bounded pool of asyncio stream connections for each server address"""
+
+    def __init__(self, max_size: int = ZABBIX_POOL_SIZE, idle_timeout: float = ZABBIX_POOL_IDLE,
+                 timeout: float = ZABBIX_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        # Idle connections and the connection slots for each address
+        self.idle = collections.defaultdict(collections.deque)
+        self.slots = {}
+
+        # Addresses that close the connection after each response
+        self.persistent = {}
+
+    @classmethod
+    def healthy(cls, connection: tuple):
+        '''Check an idle connection has not been closed by the server'''
+        reader, writer = connection
+        return not reader.at_eof() and not writer.is_closing()
+
+    def evict_idle(self, address: tuple = None):
+        '''Close the connections that have been idle for longer than idle_timeout'''
+        expired = time.monotonic() - self.idle_timeout
+        for idle_address in [address] if address else list(self.idle):
+            idle = self.idle[idle_address]
+            while idle and idle[0][1] < expired:
+                idle.popleft()[0][1].close()
+
+    def supports_pipelining(self, address: tuple):
+        '''Check if the address can take requests back to back on one connection'''
+        return self.persistent.get(address, True)
+
+    async def acquire(self, address: tuple):
+        '''Get a connection for the address, returns the connection and if it was reused'''
+        if address not in self.slots:
+            self.slots[address] = asyncio.Semaphore(self.max_size)
+        await self.slots[address].acquire()
+
+        self.evict_idle(address)
+        idle = self.idle[address]
+        while idle:
+            connection, _ = idle.pop()
+            if self.healthy(connection):
+                return connection, True
+            logging.debug('%s closed an idle connection', address)
+            self.persistent[address] = False
+            connection[1].close()
+
+        started = time.perf_counter()
+        try:
+            connection = await asyncio.wait_for(asyncio.open_connection(*address), self.timeout)
+        except BaseException:
+            METRICS.counters['connect_errors_total'] += 1
+            self.slots[address].release()
+            raise
+        METRICS.histograms['connect_seconds'].observe(time.perf_counter() - started)
+        return connection, False
+
+    def release(self, address: tuple, connection: tuple, reusable: bool = True):
+        '''Return a connection to the pool, or close it if it can not be reused'''
+        if reusable and self.persistent.get(address, True) and self.healthy(connection):
+            self.idle[address].append((connection, time.monotonic()))
+        else:
+            connection[1].close()
+        self.slots[address].release()
+
+    def close(self):
+        '''Close all idle connections'''
+        for idle in self.idle.values():
+            while idle:
+                idle.pop()[0][1].close()
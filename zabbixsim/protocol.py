@@ -0,0 +1,190 @@
+#
+# Zabbix ZBXD protocol framing
+#
+# https://www.zabbix.com/documentation/current/manual/appendix/protocols/header_datalen
+#
+
+"""ZBXD packet encoder and decoder"""
+import asyncio
+import struct
+import zlib
+from zabbixsim.encoding import dumps, loads
+
+ZBXD_MAGIC = b'ZBXD'
+ZBXD_PROTOCOL = 0x01
+ZBXD_COMPRESSED = 0x02
+ZBXD_LARGE = 0x04
+
+# magic, flags, datalen, reserved (uncompressed size when compressed)
+ZBXD_HEADER = struct.Struct('<4sBII')
+ZBXD_HEADER_LARGE = struct.Struct('<4sBQQ')
+ZBXD_PREFIX_SIZE = 5
+
+ZABBIX_MAX_PACKET = 1 << 30
+ZABBIX_COMPRESS_MIN = 1024
+
+class ProtocolError(ValueError):
+    """Invalid ZBXD packet"""
+
+class NotAnsweredError(ConnectionError):
+    """A connection failed before any of the response was read"""
+
+def header_struct(flags: int):
+    '''Get the header layout for the flags'''
+    return ZBXD_HEADER_LARGE if flags & ZBXD_LARGE else ZBXD_HEADER
+
+def parse_prefix(prefix):
+    '''Check the magic and return the flags'''
+    if bytes(prefix[:4]) != ZBXD_MAGIC:
+        raise ProtocolError(f'invalid ZBXD header {bytes(prefix[:ZBXD_PREFIX_SIZE])!r}')
+    return prefix[4]
+
+def parse_header(header, max_size: int = ZABBIX_MAX_PACKET):
+    '''Parse a complete header, returns the flags, data length and reserved field'''
+    flags = parse_prefix(header)
+    _, _, length, reserved = header_struct(flags).unpack_from(header)
+    if length > max_size or reserved > max_size:
+        raise ProtocolError(f'packet of {max(length, reserved)} bytes is over {max_size}')
+    return flags, length, reserved
+
+def compress_payload(payload: bytes, compress: bool, compress_min: int = ZABBIX_COMPRESS_MIN):
+    '''Compress the payload if enabled and worthwhile, returns the flags, data and reserved'''
+    if compress and len(payload) >= compress_min:
+        return ZBXD_PROTOCOL | ZBXD_COMPRESSED, zlib.compress(payload), len(payload)
+    return ZBXD_PROTOCOL, payload, 0
+
+def decompress_payload(flags: int, data, reserved: int):
+    '''Decompress the data if the compressed flag is set'''
+    if not flags & ZBXD_COMPRESSED:
+        return data
+    payload = zlib.decompress(data)
+    if len(payload) != reserved:
+        raise ProtocolError(f'decompressed {len(payload)} bytes, expected {reserved}')
+    return payload
+
+def encode_parts(payload: bytes, compress: bool = False):
+    '''Frame the payload as a header and data, for writers that keep a reference'''
+    flags, data, reserved = compress_payload(payload, compress)
+    return [ZBXD_HEADER.pack(ZBXD_MAGIC, flags, len(data), reserved), data]
+
+def decode_json(payload):
+    '''Decode a JSON payload without copying it to bytes first'''
+    return loads(payload)
+
+class PacketEncoder():
+    """Encode packets into a reusable buffer"""
+
+    def __init__(self, compress: bool = False, compress_min: int = ZABBIX_COMPRESS_MIN):
+        self.compress = compress
+        self.compress_min = compress_min
+        self.buffer = bytearray(ZBXD_HEADER.size)
+
+    def encode(self, payload: bytes):
+        '''Frame the payload, returns a view valid until the next encode'''
+        flags, data, reserved = compress_payload(payload, self.compress, self.compress_min)
+        size = ZBXD_HEADER.size + len(data)
+        if len(self.buffer) < size:
+            # A new buffer, views of the old one may still be in use
+            self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+
+        ZBXD_HEADER.pack_into(self.buffer, 0, ZBXD_MAGIC, flags, len(data), reserved)
+        self.buffer[ZBXD_HEADER.size:size] = data
+        return memoryview(self.buffer)[:size]
+
+    def encode_message(self, data: dict):
+        '''Frame a JSON message, returns a view valid until the next encode'''
+        return self.encode(dumps(data))
+
+class PacketDecoder():
+    """Incremental decoder that receives packets into a reusable buffer
+
+    Call get_buffer(), fill some of the returned view and call
+    buffer_updated() with the number of bytes written, until it returns
+    True. The header is read first, then exactly the announced length.
+    """
+
+    def __init__(self, max_size: int = ZABBIX_MAX_PACKET):
+        self.max_size = max_size
+        self.buffer = bytearray(ZBXD_HEADER_LARGE.size)
+        self.reset()
+
+    def reset(self):
+        '''Prepare to receive the next packet'''
+        # pylint: disable=attribute-defined-outside-init
+        self.received = 0
+        self.needed = ZBXD_PREFIX_SIZE
+        self.header_size = 0
+        self.flags = 0
+        self.length = 0
+        self.reserved = 0
+
+    def get_buffer(self):
+        '''Get the view to receive into, sized to the bytes still needed'''
+        if len(self.buffer) < self.needed:
+            # A new buffer, views of the old one may still be in use
+            buffer = bytearray(max(self.needed, 2 * len(self.buffer)))
+            buffer[:self.received] = self.buffer[:self.received]
+            self.buffer = buffer
+        return memoryview(self.buffer)[self.received:self.needed]
+
+    def buffer_updated(self, nbytes: int):
+        '''Account for received bytes, returns True when the packet is complete'''
+        self.received += nbytes
+        while self.received == self.needed:
+            if not self.header_size and self.received == ZBXD_PREFIX_SIZE:
+                self.needed = header_struct(parse_prefix(self.buffer)).size
+            elif not self.header_size:
+                self.header_size = self.needed
+                self.flags, self.length, self.reserved = parse_header(self.buffer,
+                                                                      self.max_size)
+                self.needed = self.header_size + self.length
+                if self.length == 0:
+                    return True
+            else:
+                return True
+        return False
+
+    def feed(self, data):
+        '''Copy received data in, returns the unused data when the packet is complete'''
+        view = memoryview(data)
+        while view:
+            target = self.get_buffer()
+            count = min(len(target), len(view))
+            target[:count] = view[:count]
+            view = view[count:]
+            if self.buffer_updated(count):
+                return view
+        return None
+
+    def payload(self):
+        '''Get the decompressed payload of the complete packet'''
+        data = memoryview(self.buffer)[self.header_size:self.needed]
+        return decompress_payload(self.flags, data, self.reserved)
+
+    def message(self):
+        '''Get the JSON message of the complete packet'''
+        return decode_json(self.payload())
+
+    def receive(self, receive_socket):
+        '''Receive one JSON message from a blocking socket'''
+        self.reset()
+        while True:
+            nbytes = receive_socket.recv_into(self.get_buffer())
+            if not nbytes:
+                raise ConnectionError('connection closed before the packet was complete')
+            if self.buffer_updated(nbytes):
+                return self.message()
+
+async def read_payload(reader: asyncio.StreamReader, max_size: int = ZABBIX_MAX_PACKET,
+                       prefix: bytes = b''):
+    '''Read one packet payload from an asyncio stream, after any prefix already read'''
+    prefix += await reader.readexactly(ZBXD_PREFIX_SIZE - len(prefix))
+    header = prefix + await reader.readexactly(
+        header_struct(parse_prefix(prefix)).size - ZBXD_PREFIX_SIZE)
+    flags, length, reserved = parse_header(header, max_size)
+    data = await reader.readexactly(length)
+    return decompress_payload(flags, data, reserved)
+
+async def read_message(reader: asyncio.StreamReader, max_size: int = ZABBIX_MAX_PACKET):
+    '''Read one JSON message from an asyncio stream'''
+    return decode_json(await read_payload(reader, max_size))
@@ -0,0 +1,107 @@
+#
+# Reload changed simulation files while the simulator runs
+#
+
+"""Simulation file hot reload"""
+import asyncio
+import functools
+import logging
+import os
+import random
+import yaml
+from zabbixsim.loader import load_section, parse_sim_files, scan_sim_files
+from zabbixsim.store import ItemStore
+
+ZABBIX_RELOAD_INTERVAL = 5
+
+class SimWatcher():
+    """Poll the simulation files for changes, parsing only the files that changed"""
+
+    def __init__(self, index: dict, directory: str = None, workers: int = None):
+        self.index = index
+        self.directory = directory or os.getcwd()
+        self.workers = workers
+
+    def poll(self):
+        '''Parse the changed files, returns the changed hosts and the removed hostnames
+
+        Changed hosts are (hostname, sections, blob), only hosts whose
+        compiled items differ from the last load are included.
+        '''
+        index, stale = scan_sim_files(self.directory, self.index)
+        if not stale and index.keys() == self.index.keys():
+            self.index = index
+            return [], []
+
+        for filename, (digest, hosts) in zip(stale, parse_sim_files(stale, self.workers)):
+            index[os.path.basename(filename)][2:] = [digest, hosts]
+
+        old_hosts = {hostname: (sections, blob) for _, _, _, hosts in self.index.values()
+                     for hostname, sections, blob in hosts}
+        new_hosts = {hostname: (sections, blob) for _, _, _, hosts in index.values()
+                     for hostname, sections, blob in hosts}
+        self.index = index
+
+        changed = [(hostname, sections, blob) for hostname, (sections, blob) in new_hosts.items()
+                   if old_hosts.get(hostname, (None, None))[1] != blob]
+        removed = [hostname for hostname in old_hosts if hostname not in new_hosts]
+        logging.info('reloaded %d simulation files, %d hosts changed, %d removed',
+                     len(stale), len(changed), len(removed))
+        return changed, removed
+
+    def hostnames(self):
+        '''Get the hostnames in the simulation files'''
+        return [hostname for _, _, _, hosts in self.index.values() for hostname, _, _ in hosts]
+
+def reload_host(store: ItemStore, hostname: str, sections: tuple, blob, section: str):
+    '''Replace the section of a host in its item store, returns the old and new rows'''
+    if section in sections:
+        return store.replace_host(hostname, functools.partial(load_section, blob, section))
+    return store.remove_host(hostname), range(0)
+
+def reload_store(store: ItemStore, section: str, changed: list, removed: list):
+    '''Apply reloaded hosts to the item store of a section'''
+    for hostname, sections, blob in changed:
+        reload_host(store, hostname, sections, blob, section)
+    for hostname in removed:
+        store.remove_host(hostname)
+
+def reschedule_host(scheduler, store: ItemStore, old_rows: range, new_rows: range, now: float):
+    '''Move the schedule of a reloaded host from its old rows to its new rows
+
+    Items whose key is unchanged keep their next due time, or are due
+    after their new delay if that is sooner. New items are spread over
+    their first delay, so a reload never causes a burst of sends.
+    '''
+    item_keys = store.item_keys
+    delays = store.delays
+    old_keys = {item_keys[row]: row for row in old_rows}
+    for row in new_rows:
+        delay = delays[row]
+        old_row = old_keys.pop(item_keys[row], None)
+        due = None
+        if old_row is not None:
+            due = scheduler.due(old_row)
+            scheduler.unschedule(old_row)
+        if due is None:
+            due = now + random.uniform(0, delay)
+        elif delays[old_row] != delay:
+            due = min(due, now + delay)
+        scheduler.schedule(row, delay, due)
+
+    for row in old_keys.values():
+        scheduler.unschedule(row)
+
+async def watch_sim_files(watcher: SimWatcher, reloaders: list,
+                          interval: float = ZABBIX_RELOAD_INTERVAL):
+    '''Poll the simulation files, passing the changes to each reloader(changed, removed)'''
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            changed, removed = await loop.run_in_executor(None, watcher.poll)
+        except (OSError, ValueError, yaml.YAMLError) as err:
+            logging.warning('reload failed: %s', err)
+            continue
+        for reloader in reloaders:
+            reloader(changed, removed)
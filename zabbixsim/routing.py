@@ -0,0 +1,132 @@
+#
+# Route the simulated hosts to Zabbix servers and proxies
+#
+
+"""Server and proxy routing"""
+import fnmatch
+import logging
+import re
+import zlib
+from zabbixsim.active import ZABBIX_ACTIVE_PORT
+
+ROUTE_SPLIT = 'split'
+ROUTE_ALL = 'all'
+
+def parse_address(address: str, default_port: int = ZABBIX_ACTIVE_PORT):
+    '''Parse a host[:port] address, an IPv6 address with a port is written [address]:port'''
+    address = address.strip()
+    port = ''
+    if address.startswith('['):
+        host, _, port = address[1:].partition(']')
+        if port and not port.startswith(':'):
+            raise ValueError(f'invalid address {address}')
+        port = port[1:]
+    elif address.count(':') == 1:
+        host, port = address.split(':')
+    else:
+        host = address
+    if not host:
+        raise ValueError(f'invalid address {address}')
+    return host, int(port) if port else default_port
+
+def parse_server_active(value: str, default_port: int = ZABBIX_ACTIVE_PORT):
+    '''Parse a list of targets written like the agent ServerActive
+
+    Targets are separated by ',' and each is a server or proxy, or the
+    nodes of a cluster separated by ';' that are failed over between.
+    Returns the (host, port) nodes of each target.
+    '''
+    targets = []
+    for target in value.split(','):
+        nodes = [parse_address(node, default_port) for node in target.split(';') if node.strip()]
+        if nodes:
+            targets.append(nodes)
+    return targets
+
+def target_name(nodes: list):
+    '''Get the name of a target from its nodes'''
+    return ';'.join(f'[{host}]:{port}' if ':' in host else f'{host}:{port}'
+                    for host, port in nodes)
+
+def target_directory(nodes: list):
+    '''Get a directory name for a target, such as its spill directory'''
+    return re.sub(r'[^\w.-]+', '_', target_name(nodes))
+
+class ServerRoutes():
+    """The targets the values of each host are sent to
+
+    Hosts are matched against the route patterns in order, and sent to
+    the targets of the first match. Hosts no route matches are split
+    across the default targets by a hash of the hostname, so each host
+    keeps its target across restarts, or with mode all are sent to every
+    default target like the agent does. Patterns are matched without
+    case, configparser keeps the patterns lower case.
+    """
+
+    def __init__(self, targets: list, routes: list = None, mode: str = ROUTE_SPLIT):
+        if mode not in (ROUTE_SPLIT, ROUTE_ALL):
+            raise ValueError(f'invalid routing mode {mode}')
+        self.mode = mode
+        self.targets = []
+        self.names = {}
+        self.defaults = [self.add_target(nodes) for nodes in targets]
+        self.routes = [(pattern.lower(), [self.add_target(nodes) for nodes in route_targets])
+                       for pattern, route_targets in routes or []]
+        self.hosts = {}
+
+    def add_target(self, nodes: list):
+        '''Add a target, returns its index, the same target is only added once'''
+        name = target_name(nodes)
+        if name not in self.names:
+            self.names[name] = len(self.targets)
+            self.targets.append(nodes)
+        return self.names[name]
+
+    def targets_of(self, hostname: str):
+        '''Get the indexes of the targets of a host'''
+        targets = self.hosts.get(hostname)
+        if targets is None:
+            targets = self.route(hostname)
+            self.hosts[hostname] = targets
+        return targets
+
+    def route(self, hostname: str):
+        '''Find the targets of a host'''
+        name = hostname.lower()
+        for pattern, targets in self.routes:
+            if fnmatch.fnmatchcase(name, pattern):
+                return targets
+        if self.mode == ROUTE_ALL or len(self.defaults) == 1:
+            return self.defaults
+        return [self.defaults[zlib.crc32(hostname.encode("utf-8")) % len(self.defaults)]]
+
+    def routed(self, target: int, hostname: str):
+        '''Tell if the values of a host are sent to a target'''
+        return target in self.targets_of(hostname)
+
+    def hosts_of(self, target: int, hostnames):
+        '''Get the hosts whose values are sent to a target'''
+        return [hostname for hostname in hostnames if self.routed(target, hostname)]
+
+def routes_from_config(config):
+    '''Create the routes from the config
+
+    server_active lists the default targets, like the agent ServerActive,
+    and is server and port when it is not set. The [ROUTES] section maps
+    hostname patterns to their targets.
+    '''
+    port = config.getint('SETTINGS', 'port', fallback=ZABBIX_ACTIVE_PORT)
+    server_active = config.get('SETTINGS', 'server_active', fallback=None)
+    if server_active:
+        targets = parse_server_active(server_active, port)
+    else:
+        targets = [[(config.get('SETTINGS', 'server'), port)]]
+    routes = []
+    if config.has_section('ROUTES'):
+        for pattern, value in config.items('ROUTES', raw=True):
+            routes.append((pattern, parse_server_active(value, port)))
+    server_routes = ServerRoutes(targets, routes,
+                                 config.get('SETTINGS', 'server_routing', fallback=ROUTE_SPLIT))
+    if len(server_routes.targets) > 1:
+        logging.info('sending to %s', ', '.join(map(target_name, server_routes.targets)))
+    return server_routes
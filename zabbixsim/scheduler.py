@@ -0,0 +1,109 @@
+#
+# Schedule item checks on their own delay
+#
+
+"""Item scheduler"""
+import heapq
+import itertools
+import time
+
+NS_PER_SECOND = 1000000000
+
+def wall_clock_offset():
+    '''Get the nanoseconds to add to a time.monotonic() time for its time since the epoch
+
+    Due times are kept on the monotonic clock so the schedule does not move
+    when the wall clock is set, and converted with the offset of the moment
+    to stamp values.
+    '''
+    return time.time_ns() - time.monotonic_ns()
+
+def due_stamp(due: float, offset: int):
+    '''Convert a monotonic due time to nanoseconds since the epoch'''
+    return offset + int(due * NS_PER_SECOND)
+
+class Scheduler():
+    """Heap of items keyed on their next due time
+
+    Each key is scheduled on its own delay, so popping the due keys costs
+    O(due log n) no matter how many keys are scheduled. Times are in
+    seconds on any monotonic clock.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        # Checks missed while the caller was stalled, for it to count
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def schedule(self, key, delay: float, due: float):
+        '''Schedule the key to be due at due, then every delay seconds'''
+        if delay <= 0:
+            self.unschedule(key)
+            return
+        # Heap entries are (due, sequence, key, delay), a replaced entry is
+        # left in the heap and skipped because it is no longer the key's entry
+        entry = (due, next(self.counter), key, delay)
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+
+    def unschedule(self, key):
+        '''Stop scheduling the key'''
+        self.entries.pop(key, None)
+
+    def due(self, key):
+        '''Get the time the key is next due, or None if it is not scheduled'''
+        entry = self.entries.get(key)
+        return entry[0] if entry else None
+
+    def delay(self, key):
+        '''Get the delay the key is scheduled on, or None if it is not scheduled'''
+        entry = self.entries.get(key)
+        return entry[3] if entry else None
+
+    def next_due(self):
+        '''Get the time the next key is due, or None if nothing is scheduled'''
+        heap = self.heap
+        entries = self.entries
+        while heap and entries.get(heap[0][2]) is not heap[0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_due(self, now: float):
+        '''Get the keys due at now, as (key, due) pairs, and schedule their next check
+
+        After a stall the checks missed are skipped, not sent as a burst, and
+        counted in skipped. The due time is then of the last check missed,
+        and the next check stays on the key's schedule, so the schedule never
+        drifts by the time spent processing or stalled.
+        '''
+        heap = self.heap
+        entries = self.entries
+        due_keys = []
+        counter = self.counter
+        while heap and heap[0][0] <= now:
+            entry = heap[0]
+            due, _, key, delay = entry
+            if entries.get(key) is not entry:
+                heapq.heappop(heap)
+                continue
+
+            next_due = due + delay
+            if next_due <= now:
+                missed = (now - next_due) // delay + 1
+                self.skipped += int(missed)
+                due += missed * delay
+                next_due += missed * delay
+
+            entry = (next_due, next(counter), key, delay)
+            entries[key] = entry
+            heapq.heapreplace(heap, entry)
+            due_keys.append((key, due))
+        return due_keys
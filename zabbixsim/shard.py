@@ -0,0 +1,228 @@
+#
+# Run the simulated hosts in several processes
+#
+
+"""Multi-process sharding"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import time
+from zabbixsim.headless import run_hosts, ZABBIX_STATS_INTERVAL
+
+ZABBIX_RING_REPLICAS = 100
+ZABBIX_RESTART_DELAY = 1.0
+ZABBIX_STOP_TIMEOUT = 5.0
+
+def host_hash(name: str):
+    '''Hash a name the same way in every process'''
+    return int.from_bytes(hashlib.md5(name.encode("utf-8")).digest()[:8], 'big')
+
+class HashRing():
+    """Consistent hash ring of shards
+
+    Each shard has replicas points on the ring and a host belongs to the
+    shard of the first point after its hash, so changing the number of
+    shards only moves the hosts of the added or removed shards.
+    """
+
+    def __init__(self, shards: int, replicas: int = ZABBIX_RING_REPLICAS):
+        points = sorted((host_hash(f'shard-{shard}-{replica}'), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_of(self, hostname: str):
+        '''Get the shard of a host'''
+        index = bisect.bisect(self.hashes, host_hash(hostname)) % len(self.hashes)
+        return self.shards[index]
+
+def shard_function(shards: int, mode: str = 'hash'):
+    '''Get the function giving the shard of a host, by hostname hash or on a hash ring'''
+    if mode == 'ring':
+        return HashRing(shards).shard_of
+    def shard_of(hostname):
+        return host_hash(hostname) % shards
+    return shard_of
+
+def split_hosts(hostnames, shards: int, mode: str = 'hash'):
+    '''Split the hosts into shards'''
+    shard_hosts = [[] for _ in range(shards)]
+    shard_of = shard_function(shards, mode)
+    for hostname in hostnames:
+        shard_hosts[shard_of(hostname)].append(hostname)
+    return shard_hosts
+
+def run_shard(shard: int, config, active_data, passive_data, hostnames: list,
+              passive_hostnames: list, duration: float, stats, watcher=None, shard_of=None):
+    '''Worker process, run the hosts of one shard and report the totals'''
+    # pylint: disable=too-many-arguments
+    def report(totals):
+        stats.put((shard,) + totals)
+
+    def owns(hostname):
+        return shard_of(hostname) == shard
+
+    # Each worker serves its own metrics, on the port after the previous worker's
+    metrics_port = config.getint('SETTINGS', 'metrics_port', fallback=0)
+    if metrics_port:
+        config.set('SETTINGS', 'metrics_port', str(metrics_port + shard))
+
+    # and its own control API, for the hosts it runs
+    control_port = config.getint('SETTINGS', 'control_port', fallback=0)
+    if control_port:
+        config.set('SETTINGS', 'control_port', str(control_port + shard))
+    control_socket = config.get('SETTINGS', 'control_socket', fallback=None)
+    if control_socket:
+        config.set('SETTINGS', 'control_socket', f'{control_socket}.{shard}')
+
+    # and keeps its spilled values in its own directory
+    spill_dir = config.get('SETTINGS', 'buffer_spill_dir', fallback=None)
+    if spill_dir:
+        config.set('SETTINGS', 'buffer_spill_dir', os.path.join(spill_dir, f'shard{shard}'))
+
+    try:
+        asyncio.run(run_hosts(config, active_data, passive_data, duration,
+                              hostnames, passive_hostnames, report, watcher, owns))
+    except KeyboardInterrupt:
+        pass
+
+class ShardSupervisor():
+    """Run each shard in a worker process, restarting workers that fail
+
+    Workers are forked from the supervisor, so they share the loaded
+    simulation data copy-on-write and a restarted worker starts from the
+    data as loaded.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, config, active_data, passive_data, shards: int, mode: str = 'hash',
+                 restart_delay: float = ZABBIX_RESTART_DELAY, watcher=None):
+        # pylint: disable=too-many-arguments
+        self.config = config
+        self.active_data = active_data
+        self.passive_data = passive_data
+        self.restart_delay = restart_delay
+        self.watcher = watcher
+        self.shard_of = shard_function(shards, mode)
+        self.context = multiprocessing.get_context('fork')
+        self.stats = self.context.Queue()
+
+        self.shard_hosts = split_hosts(active_data, shards, mode)
+        self.shard_passive_hosts = split_hosts(passive_data, shards, mode)
+        self.workers = [None] * shards
+
+        # Latest totals of each running worker, and of the workers that exited
+        self.worker_totals = [(0, 0, 0, 0)] * shards
+        self.exited_totals = (0, 0, 0, 0)
+        self.restarts = 0
+
+    def start_worker(self, shard: int, duration: float = None):
+        '''Start the worker of a shard'''
+        worker = self.context.Process(
+            target=run_shard, name=f'zabbixsim-shard-{shard}', daemon=True,
+            args=(shard, self.config, self.active_data, self.passive_data,
+                  self.shard_hosts[shard], self.shard_passive_hosts[shard], duration, self.stats,
+                  self.watcher, self.shard_of))
+        worker.start()
+        self.workers[shard] = worker
+        logging.info('shard %d: pid %d, %d hosts', shard, worker.pid,
+                     len(self.shard_hosts[shard]))
+
+    def read_stats(self):
+        '''Collect the totals reported by the workers'''
+        while True:
+            try:
+                shard, *totals = self.stats.get_nowait()
+            except queue.Empty:
+                return
+            self.worker_totals[shard] = tuple(totals)
+
+    def retire(self, shard: int):
+        '''Keep the totals of an exited worker'''
+        self.exited_totals = tuple(map(sum, zip(self.exited_totals, self.worker_totals[shard])))
+        self.worker_totals[shard] = (0, 0, 0, 0)
+        self.workers[shard] = None
+
+    def totals(self):
+        '''Get the packets, values, errors and passive requests of all workers'''
+        return tuple(map(sum, zip(self.exited_totals, *self.worker_totals)))
+
+    def log_stats(self, elapsed: float):
+        '''Log the combined throughput of the workers'''
+        if elapsed <= 0:
+            return
+        packets_sent, values_sent, errors, passive_requests = self.totals()
+        logging.info('shards %d, packets %d (%.1f/s), values %d (%.1f/s), errors %d, '
+                     'passive requests %d, restarts %d',
+                     len(self.workers), packets_sent, packets_sent / elapsed,
+                     values_sent, values_sent / elapsed, errors, passive_requests, self.restarts)
+
+    def run(self, duration: float = None):
+        '''Run the workers for duration seconds or until interrupted'''
+        started = time.monotonic()
+        deadline = None if duration is None else started + duration
+        for shard in range(len(self.workers)):
+            self.start_worker(shard, duration)
+
+        next_stats = started + ZABBIX_STATS_INTERVAL
+        try:
+            while any(self.workers):
+                sentinels = [worker.sentinel for worker in self.workers if worker]
+                multiprocessing.connection.wait(sentinels, timeout=1)
+                self.read_stats()
+
+                for shard, worker in enumerate(self.workers):
+                    if not worker or worker.is_alive():
+                        continue
+                    worker.join()
+                    self.read_stats()
+                    self.retire(shard)
+                    if worker.exitcode == 0:
+                        continue
+
+                    # Restart a failed worker for the rest of the run
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    logging.warning('shard %d: worker exited with %d', shard, worker.exitcode)
+                    if remaining is None or remaining > self.restart_delay:
+                        time.sleep(self.restart_delay)
+                        self.restarts += 1
+                        self.start_worker(shard, None if remaining is None
+                                          else remaining - self.restart_delay)
+
+                now = time.monotonic()
+                if now >= next_stats:
+                    next_stats = now + ZABBIX_STATS_INTERVAL
+                    self.log_stats(now - started)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            self.log_stats(time.monotonic() - started)
+
+    def stop(self, timeout: float = ZABBIX_STOP_TIMEOUT):
+        '''Stop the workers that are still running, waiting for their final totals'''
+        stop_by = time.monotonic() + timeout
+        for shard, worker in enumerate(self.workers):
+            if not worker:
+                continue
+            worker.join(max(0, stop_by - time.monotonic()))
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+            self.read_stats()
+            self.retire(shard)
+
+def run_sharded(config, active_data, passive_data, shards: int, duration: float = None,
+                watcher=None):
+    '''Run the hosts split across shards worker processes, each reloading with watcher'''
+    # pylint: disable=too-many-arguments
+    mode = config.get('SETTINGS', 'shard_mode', fallback='hash')
+    supervisor = ShardSupervisor(config, active_data, passive_data, shards, mode,
+                                 watcher=watcher)
+    supervisor.run(duration)
+    return supervisor
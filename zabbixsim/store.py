@@ -0,0 +1,480 @@
+#
+# Compact storage for the simulated items
+#
+
+"""Columnar item store"""
+import collections.abc
+import math
+import sys
+from array import array
+
+# Zabbix item value types
+VALUE_TYPE_FLOAT = 0
+VALUE_TYPE_CHAR = 1
+VALUE_TYPE_LOG = 2
+VALUE_TYPE_UNSIGNED = 3
+VALUE_TYPE_TEXT = 4
+
+# Value columns
+COLUMN_NONE = -1
+COLUMN_FLOAT = 0
+COLUMN_UNSIGNED = 1
+COLUMN_TEXT = 2
+
+class CloneHost():
+    """A host that shares the item rows of a template host
+
+    Values are the template's, with numeric values moved by offset, a
+    fraction of the value, until a value is set for the clone, which
+    copies only that value.
+    """
+    __slots__ = ('template', 'offset', 'values')
+
+    def __init__(self, template: str, offset: float = 0.0):
+        self.template = template
+        self.offset = offset
+        self.values = None
+
+class ItemView(collections.abc.MutableMapping):
+    """Dictionary view of one item row, of a clone host with clone"""
+    __slots__ = ('store', 'row', 'clone')
+
+    fields = ('name', 'key_', 'value_type', 'lastvalue', 'delay')
+
+    def __init__(self, store, row: int, clone: CloneHost = None):
+        self.store = store
+        self.row = row
+        self.clone = clone
+
+    def __getitem__(self, field: str):
+        store = self.store
+        if field == 'lastvalue':
+            if self.clone is not None:
+                return store.clone_value(self.row, self.clone)
+            return store.get_value(self.row)
+        if field == 'key_':
+            return store.item_keys[self.row]
+        if field == 'name':
+            return store.names[self.row]
+        if field == 'delay':
+            return store.delays[self.row]
+        if field == 'value_type':
+            return store.value_types[self.row]
+        raise KeyError(field)
+
+    def __setitem__(self, field: str, value):
+        if field == 'lastvalue':
+            if self.clone is not None:
+                self.store.set_clone_value(self.row, self.clone, value)
+            else:
+                self.store.set_value(self.row, value)
+        elif field == 'delay':
+            self.store.delays[self.row] = int(value)
+        else:
+            raise KeyError(f'{field} can not be changed')
+
+    def __delitem__(self, field: str):
+        raise KeyError(f'{field} can not be removed')
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __eq__(self, other):
+        if isinstance(other, ItemView):
+            return self.store is other.store and self.row == other.row and \
+                self.clone is other.clone
+        return super().__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.store), self.row, id(self.clone)))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class HostItems(collections.abc.Sequence):
+    """The item rows of one host, the rows of its template for a clone host"""
+    __slots__ = ('store', 'rows', 'clone')
+
+    def __init__(self, store, rows: range, clone: CloneHost = None):
+        self.store = store
+        self.rows = rows
+        self.clone = clone
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ItemView(self.store, row, self.clone) for row in self.rows[index]]
+        return ItemView(self.store, self.rows[index], self.clone)
+
+    def __len__(self):
+        return len(self.rows)
+
+class ItemStore(collections.abc.Mapping):
+    """Items held in columns, one row per item, mapping hostname to its items
+
+    Names, keys and hostnames are interned, so hosts recorded from the
+    same template share their strings. Delays and value types are held in
+    arrays, and each value is held in the typed column for its value type.
+
+    Clone hosts have no rows of their own, they share the rows of a
+    template host and only hold the values that were set for them.
+
+    The rows of a reloaded or removed host are reused by the hosts loaded
+    after it, so reloads do not grow the store.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self):
+        self.host_rows = {}
+        self.lazy_hosts = {}
+        # Loaded and lazy hosts in the order they were added, so iteration does not
+        # depend on which hosts have loaded
+        self.host_order = {}
+        self.hostnames = []
+        self.row_hosts = array('I')
+        self.names = []
+        self.item_keys = []
+        self.delays = array('i')
+        self.value_types = array('b')
+
+        # Ranges of unused rows, in row order, each reused before adding rows
+        self.free_rows = []
+
+        # Each row has a slot in the float, unsigned or text column
+        self.columns = array('b')
+        self.slots = array('I')
+        self.float_values = array('d')
+        self.unsigned_values = array('Q')
+        self.text_values = []
+
+        # Slots left unused by values that moved to another column, by column
+        self.free_slots = ([], [], [])
+
+        # Value generator specs of the rows that have one, see generators.py
+        self.generators = {}
+        self.generators_version = 0
+
+        # Clone hosts, and the clones of each template host
+        self.clones = {}
+        self.template_clones = {}
+
+        # Key to row and name to row of each host, built when first looked up
+        self.host_keys = {}
+        self.host_names = {}
+
+    def __getitem__(self, hostname: str):
+        clone = self.clones.get(hostname)
+        if clone is not None:
+            return HostItems(self, self[clone.template].rows, clone)
+        if hostname in self.lazy_hosts:
+            self.add_host_rows(hostname, self.lazy_hosts.pop(hostname)())
+        return HostItems(self, self.host_rows[hostname])
+
+    def __iter__(self):
+        yield from list(self.host_order)
+        yield from list(self.clones)
+
+    def __len__(self):
+        return len(self.host_order) + len(self.clones)
+
+    def __contains__(self, hostname):
+        return hostname in self.host_order or hostname in self.clones
+
+    @property
+    def item_count(self):
+        '''Number of item rows'''
+        return len(self.item_keys)
+
+    def add_lazy_host(self, hostname: str, load_rows):
+        '''Add a host whose item rows are loaded by load_rows() when first used'''
+        hostname = sys.intern(hostname)
+        self.lazy_hosts[hostname] = load_rows
+        self.host_order.setdefault(hostname, None)
+
+    def add_host(self, hostname: str, items: list):
+        '''Add the items of a host, returns the host items'''
+        return self.add_host_rows(hostname, [
+            (item['name'], item['key_'], item.get('value_type', VALUE_TYPE_TEXT),
+             item.get('lastvalue'), item['delay'], item.get('generator')) for item in items])
+
+    def add_host_rows(self, hostname: str, rows: list, host_index: int = None):
+        '''Add the items of a host as (name, key_, value_type, lastvalue, delay, generator) rows'''
+        hostname = sys.intern(hostname)
+        if host_index is None:
+            host_index = len(self.hostnames)
+            self.hostnames.append(hostname)
+        self.host_order.setdefault(hostname, None)
+
+        start = self.allocate_rows(len(rows))
+        for row, values in enumerate(rows, start):
+            self.set_row(row, host_index, *values)
+        self.host_rows[hostname] = range(start, start + len(rows))
+        self.drop_index(hostname)
+        return HostItems(self, self.host_rows[hostname])
+
+    def replace_host(self, hostname: str, load_rows):
+        '''Replace the items of a host with the rows from load_rows(), returns the old and new rows
+
+        The new rows are added before the host is switched over to them, so
+        the host always has a complete set of items. The old rows keep their
+        keys until the next host is loaded, for rescheduling, and are then
+        reused. Values set for the clones of the host move to the new row
+        with the same key. A host that has not been used yet is left to
+        load lazily, and its old and new rows are empty.
+        '''
+        old_rows = self.host_rows.get(hostname)
+        if old_rows is None:
+            self.drop_index(hostname)
+            self.add_lazy_host(hostname, load_rows)
+            return range(0), range(0)
+
+        if old_rows:
+            host_index = self.row_hosts[old_rows[0]]
+        else:
+            host_index = self.hostnames.index(hostname)
+        new_rows = self.add_host_rows(hostname, load_rows(), host_index).rows
+        self.move_clone_values(hostname, old_rows)
+        self.release_rows(old_rows)
+        return old_rows, new_rows
+
+    def add_clone(self, hostname: str, template: str, offset: float = 0.0):
+        '''Add a clone of a template host, with its numeric values moved by offset of the value'''
+        hostname = sys.intern(hostname)
+        self.clones[hostname] = CloneHost(sys.intern(template), offset)
+        self.template_clones.setdefault(template, []).append(hostname)
+
+    def clones_of(self, template: str):
+        '''Get the clones of a template host'''
+        return self.template_clones.get(template, [])
+
+    def remove_host(self, hostname: str):
+        '''Remove a host, returns its old rows, which are reused by the next host loaded
+
+        Removing a template host removes its clones too.
+        '''
+        clone = self.clones.pop(hostname, None)
+        if clone is not None:
+            self.template_clones[clone.template].remove(hostname)
+            return range(0)
+        for clone_name in self.template_clones.pop(hostname, []):
+            self.clones.pop(clone_name, None)
+        self.drop_index(hostname)
+        self.lazy_hosts.pop(hostname, None)
+        self.host_order.pop(hostname, None)
+        old_rows = self.host_rows.pop(hostname, range(0))
+        self.release_rows(old_rows)
+        return old_rows
+
+    def move_clone_values(self, template: str, old_rows: range):
+        '''Move the values set for the clones of a template host to its new rows, by key'''
+        old_keys = None
+        key_rows = self.key_rows(template)
+        for clone_name in self.clones_of(template):
+            clone = self.clones[clone_name]
+            if not clone.values:
+                continue
+            if old_keys is None:
+                old_keys = {row: self.item_keys[row] for row in old_rows}
+            values = clone.values
+            clone.values = None
+            for old_row, value in values.items():
+                row = key_rows.get(old_keys.get(old_row))
+                if row is not None:
+                    self.set_clone_value(row, clone, value)
+
+    def allocate_rows(self, count: int):
+        '''Get the first of count unused rows, reusing released rows first'''
+        free_rows = self.free_rows
+        for index, rows in enumerate(free_rows):
+            if len(rows) >= count:
+                if len(rows) == count:
+                    del free_rows[index]
+                else:
+                    free_rows[index] = rows[count:]
+                return rows.start
+        return len(self.item_keys)
+
+    def release_rows(self, rows: range):
+        '''Mark the rows of a reloaded or removed host as unused, merging adjacent ranges'''
+        if not rows:
+            return
+        self.remove_generators(rows)
+        free_rows = self.free_rows
+        index = next((index for index, free in enumerate(free_rows)
+                      if free.start > rows.start), len(free_rows))
+        if index < len(free_rows) and free_rows[index].start == rows.stop:
+            rows = range(rows.start, free_rows.pop(index).stop)
+        if index and free_rows[index - 1].stop == rows.start:
+            index -= 1
+            rows = range(free_rows.pop(index).start, rows.stop)
+        free_rows.insert(index, rows)
+
+    def key_rows(self, hostname: str):
+        '''Get the key to row index of a host, clones share the index of their template'''
+        clone = self.clones.get(hostname)
+        if clone is not None:
+            hostname = clone.template
+        keys = self.host_keys.get(hostname)
+        if keys is None:
+            keys = {}
+            if hostname in self:
+                item_keys = self.item_keys
+                keys = {item_keys[row]: row for row in self[hostname].rows}
+            self.host_keys[hostname] = keys
+        return keys
+
+    def name_rows(self, hostname: str):
+        '''Get the name to row index of a host, a name used twice is the first item with it'''
+        clone = self.clones.get(hostname)
+        if clone is not None:
+            hostname = clone.template
+        names = self.host_names.get(hostname)
+        if names is None:
+            names = {}
+            if hostname in self:
+                item_names = self.names
+                for row in self[hostname].rows:
+                    names.setdefault(item_names[row], row)
+            self.host_names[hostname] = names
+        return names
+
+    def item_by_key(self, hostname: str, key: str):
+        '''Get the item of a host with a key, or None'''
+        row = self.key_rows(hostname).get(key)
+        return None if row is None else ItemView(self, row, self.clones.get(hostname))
+
+    def item_by_name(self, hostname: str, name: str):
+        '''Get the first item of a host with a name, or None'''
+        row = self.name_rows(hostname).get(name)
+        return None if row is None else ItemView(self, row, self.clones.get(hostname))
+
+    def drop_index(self, hostname: str):
+        '''Forget the key and name indexes of a host whose rows changed'''
+        self.host_keys.pop(hostname, None)
+        self.host_names.pop(hostname, None)
+
+    def remove_generators(self, rows: range):
+        '''Remove the value generators of unused rows'''
+        if self.generators:
+            for row in rows:
+                if self.generators.pop(row, None) is not None:
+                    self.generators_version += 1
+
+    def set_row(self, row: int, host_index: int, name: str, key: str, value_type, lastvalue,
+                delay, generator: dict = None):
+        '''Set an unused item row, adding it after the last row, returns the row'''
+        # pylint: disable=too-many-arguments
+        if row == len(self.item_keys):
+            self.row_hosts.append(host_index)
+            self.names.append(None)
+            self.item_keys.append(None)
+            self.delays.append(0)
+            self.value_types.append(0)
+            self.columns.append(COLUMN_NONE)
+            self.slots.append(0)
+        self.row_hosts[row] = host_index
+        self.names[row] = sys.intern(str(name))
+        self.item_keys[row] = sys.intern(str(key))
+        self.delays[row] = int(delay)
+        self.value_types[row] = int(value_type)
+        self.set_value(row, lastvalue)
+        if generator:
+            self.generators[row] = generator
+            self.generators_version += 1
+        return row
+
+    def item(self, row: int, clone: CloneHost = None):
+        '''Get the item of a row, as the item of a clone host with clone'''
+        return ItemView(self, row, clone)
+
+    def host_of(self, row: int):
+        '''Get the hostname of a row'''
+        return self.hostnames[self.row_hosts[row]]
+
+    def get_value(self, row: int):
+        '''Get the value of a row'''
+        column = self.columns[row]
+        if column == COLUMN_FLOAT:
+            return self.float_values[self.slots[row]]
+        if column == COLUMN_UNSIGNED:
+            return self.unsigned_values[self.slots[row]]
+        return self.text_values[self.slots[row]]
+
+    def host_value(self, hostname: str, row: int):
+        '''Get the value of a row for a host, which may be a clone of the row's host'''
+        clone = self.clones.get(hostname)
+        if clone is None:
+            return self.get_value(row)
+        return self.clone_value(row, clone)
+
+    def clone_value(self, row: int, clone: CloneHost):
+        '''Get the value of a row for a clone host'''
+        if clone.values and row in clone.values:
+            return clone.values[row]
+        value = self.get_value(row)
+        if clone.offset:
+            column = self.columns[row]
+            if column == COLUMN_FLOAT:
+                return value * (1 + clone.offset)
+            if column == COLUMN_UNSIGNED:
+                return min(round(value * (1 + clone.offset)), (1 << 64) - 1)
+        return value
+
+    def set_clone_value(self, row: int, clone: CloneHost, value):
+        '''Set the value of a row for a clone host only, held as set_value would hold it'''
+        if clone.values is None:
+            clone.values = {}
+        clone.values[row] = self.column_value(row, value)[1]
+
+    def column_value(self, row: int, value):
+        '''Get the column for a value of a row, and the value as it is held in that column'''
+        value_type = self.value_types[row]
+        column = COLUMN_TEXT
+        try:
+            if value_type == VALUE_TYPE_FLOAT:
+                # Non-finite values such as inf and nan cannot be sent as JSON numbers
+                number = float(value)
+                if math.isfinite(number):
+                    value = number
+                    column = COLUMN_FLOAT
+            elif value_type == VALUE_TYPE_UNSIGNED:
+                value = int(value)
+                if 0 <= value < 1 << 64:
+                    column = COLUMN_UNSIGNED
+        except (TypeError, ValueError, OverflowError):
+            pass
+
+        # Values that do not parse as their value type, or are not finite, are kept as text
+        if column == COLUMN_TEXT:
+            value = '' if value is None else str(value)
+        return column, value
+
+    def set_value(self, row: int, value):
+        '''Set the value of a row, in the column for its value type'''
+        column, value = self.column_value(row, value)
+        if column == COLUMN_FLOAT:
+            values = self.float_values
+        elif column == COLUMN_UNSIGNED:
+            values = self.unsigned_values
+        else:
+            values = self.text_values
+
+        # A value moving to another column frees its old slot for the next value moving in
+        old_column = self.columns[row]
+        if old_column == column:
+            values[self.slots[row]] = value
+            return
+        if old_column != COLUMN_NONE:
+            if old_column == COLUMN_TEXT:
+                self.text_values[self.slots[row]] = ''
+            self.free_slots[old_column].append(self.slots[row])
+        self.columns[row] = column
+        free_slots = self.free_slots[column]
+        if free_slots:
+            self.slots[row] = free_slots.pop()
+            values[self.slots[row]] = value
+        else:
+            self.slots[row] = len(values)
+            values.append(value)
@@ -1,12 +1,57 @@
 #!/usr/bin/env python3
 """Query a Zabbix Server to generated a ZabbixSim datafile"""
+import argparse
+import concurrent.futures
 import configparser
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
 import yaml
 import zabbix_api
+from zabbixsim.history import HistoryWriter, parse_value, HISTORY_FILE, NS_PER_SECOND
 
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+# Hosts per item.get request, and concurrent requests
+ZABBIX_RECORD_PAGE_SIZE = 200
+ZABBIX_RECORD_WORKERS = 4
+ZABBIX_RECORD_PROGRESS = 5
+
+# Recorded hosts, see read_index
+RECORD_INDEX_FILE = '.zabbixrec.index'
+RECORD_INDEX_VERSION = 1
+
+# Changes up to this many seconds before the last run are fetched again,
+# to allow for clock differences with the Zabbix server
+ZABBIX_RECORD_CLOCK_MARGIN = 300
+
+# Audit log resource types
+AUDIT_RESOURCE_HOST = 4
+AUDIT_RESOURCE_ITEM = 15
+
+# Zabbix item types
+ITEM_TYPE_ZABBIX = '0'
+ITEM_TYPE_ZABBIX_ACTIVE = '7'
+
+# Recorded item fields, and those compared between runs, all but the last value
+ITEM_FIELDS = ["hostid", "key_", "name", "type", "value_type", "lastvalue", "delay"]
+ITEM_DIGEST_FIELDS = ["itemid", "hostid", "key_", "name", "type", "value_type", "delay"]
+
+# Seconds of history per chunk, items and values per history.get request
+ZABBIX_HISTORY_WINDOW = 3600
+ZABBIX_HISTORY_ITEMS = 1000
+ZABBIX_HISTORY_LIMIT = 100000
+
+# Value types with trends, float and unsigned
+TREND_VALUE_TYPES = (0, 3)
 
 def convert_to_seconds(time):
     """Convert a time string to seconds"""
+    # pylint: disable=redefined-outer-name
     seconds_per_unit = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
     if time.isnumeric():
         return int(time)
@@ -24,73 +69,471 @@ class Config():
         self.website = config_file.get('SETTINGS', 'website')
         self.username = config_file.get('SETTINGS', 'username')
         self.password = config_file.get('SETTINGS', 'password')
+        self.record_workers = config_file.getint('SETTINGS', 'record_workers',
+                                                 fallback=ZABBIX_RECORD_WORKERS)
+        self.record_page_size = config_file.getint('SETTINGS', 'record_page_size',
+                                                   fallback=ZABBIX_RECORD_PAGE_SIZE)
 
 DEFAULTS = 'zabbixsim.cfg'
 
+def yaml_dumper():
+    '''Get the fastest YAML dumper, the libyaml emitter when it is available'''
+    return getattr(yaml, 'CDumper', yaml.Dumper)
+
+def fetch_hosts(zapi):
+    '''Get the hostid and name of every host'''
+    return zapi.host.get({"output": ["hostid", "host"]})
+
+def fetch_items(zapi, hostids: list, output: list = None):
+    '''Get the agent and active agent items of many hosts in one request'''
+    return zapi.item.get({
+        "hostids": hostids,
+        "sortfield": "name",
+        "filter": {
+            "type": [ITEM_TYPE_ZABBIX, ITEM_TYPE_ZABBIX_ACTIVE]
+        },
+        "output": output or ITEM_FIELDS
+    })
+
+def item_digests(items: list):
+    '''Digest the fields of the items of each host other than the last values, keyed on hostid'''
+    rows = {}
+    for item in items:
+        rows.setdefault(item['hostid'], []).append(
+            tuple(str(item.get(field, '')) for field in ITEM_DIGEST_FIELDS))
+    return {hostid: hashlib.sha1(repr(sorted(host_rows)).encode("utf-8")).hexdigest()
+            for hostid, host_rows in rows.items()}
+
+def fetch_history(zapi, trends: bool, value_type: int, itemids: list, time_from: int,
+                  time_till: int, limit: int = ZABBIX_HISTORY_LIMIT):
+    '''Get the history or trends of items between time_from and time_till'''
+    if trends:
+        return zapi.trend.get({
+            "itemids": itemids,
+            "time_from": time_from,
+            "time_till": time_till,
+            "output": ["itemid", "clock", "value_avg"],
+            "limit": limit
+        })
+    return zapi.history.get({
+        "history": value_type,
+        "itemids": itemids,
+        "time_from": time_from,
+        "time_till": time_till,
+        "sortfield": "clock",
+        "sortorder": "ASC",
+        "output": ["itemid", "clock", "ns", "value"],
+        "limit": limit
+    })
+
+def fetch_changes(zapi, time_from: int):
+    '''Get the host and item ids changed since time_from from the audit log'''
+    records = zapi.auditlog.get({
+        "time_from": time_from,
+        "filter": {
+            "resourcetype": [AUDIT_RESOURCE_HOST, AUDIT_RESOURCE_ITEM]
+        },
+        "output": ["resourcetype", "resourceid"]
+    })
+    hostids = {record['resourceid'] for record in records
+               if int(record['resourcetype']) == AUDIT_RESOURCE_HOST}
+    itemids = {record['resourceid'] for record in records
+               if int(record['resourcetype']) == AUDIT_RESOURCE_ITEM}
+    return hostids, itemids
+
+def fetch_item_hosts(zapi, itemids: list):
+    '''Get the hostids of items'''
+    if not itemids:
+        return set()
+    return {item['hostid'] for item in zapi.item.get({"itemids": itemids,
+                                                      "output": ["hostid"]})}
+
+def host_sections(items: list):
+    '''Split the items of many hosts into active and passive sections
+
+    Returns the sections and the item ids of each host, keyed on hostid.
+    '''
+    sections = {}
+    itemids = {}
+    for item in items:
+        hostid = item.pop('hostid')
+        itemids.setdefault(hostid, []).append(item.pop('itemid', None))
+        item['delay'] = convert_to_seconds(item['delay'])
+
+        # 7 - Zabbix agent (active); 0 - Zabbix agent;
+        if item['type'] == ITEM_TYPE_ZABBIX_ACTIVE:
+            section = 'active'
+        else:
+            section = 'passive'
+            item.pop('type')
+        sections.setdefault(hostid, {}).setdefault(section, []).append(item)
+    return sections, itemids
+
+def read_index(directory: str):
+    '''Read the index of recorded hosts
+
+    The index has the time of the last run and, for each hostid, the
+    hostname, item ids and digest of the recorded file.
+    '''
+    try:
+        with open(os.path.join(directory, RECORD_INDEX_FILE), encoding="utf8") as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != RECORD_INDEX_VERSION:
+        return None
+    return index
+
+def write_index(directory: str, index: dict):
+    '''Write the index of recorded hosts'''
+    index_path = os.path.join(directory, RECORD_INDEX_FILE)
+    with open(index_path + '.tmp', 'w', encoding="utf8") as file:
+        json.dump(index, file)
+    os.replace(index_path + '.tmp', index_path)
+
+class RecordWriter(threading.Thread):
+    """Write the recorded hosts in the background, with the libyaml emitter
+
+    A file is only written when its content has changed since it was
+    recorded, and is replaced in one step so readers never see part of it.
+    """
+
+    def __init__(self, directory: str = '.', hosts_index: dict = None):
+        super().__init__(name='RecordWriter', daemon=True)
+        self.directory = directory
+        self.hosts_index = {} if hosts_index is None else hosts_index
+        self.hosts = queue.Queue(maxsize=1000)
+        self.dumper = yaml_dumper()
+        self.files_written = 0
+        self.files_unchanged = 0
+        self.error = None
+
+    def write(self, hostid: str, hostname: str, host_items: dict, itemids: list,
+              fields: str = None):
+        '''Queue the items of a host to be written, fields is the digest of their fields'''
+        # pylint: disable=too-many-arguments
+        if self.error:
+            raise self.error
+        self.hosts.put((hostid, hostname, host_items, itemids, fields))
+
+    def write_host(self, hostid: str, hostname: str, host_items: dict, itemids: list,
+                   fields: str = None):
+        '''Write the file of a host if its content has changed'''
+        # pylint: disable=too-many-arguments
+        output = yaml.dump({hostname: host_items}, Dumper=self.dumper)
+        digest = hashlib.sha1(output.encode("utf-8")).hexdigest()
+        filename = os.path.join(self.directory, hostname + '.yaml')
+        entry = self.hosts_index.get(hostid)
+        self.hosts_index[hostid] = dict(host=hostname, items=itemids, digest=digest,
+                                        fields=fields)
+        if entry and entry['digest'] == digest and entry['host'] == hostname and \
+                os.path.exists(filename):
+            self.files_unchanged += 1
+            return
+
+        with open(filename + '.tmp', 'w', encoding="utf8") as writer:
+            writer.write(output)
+        os.replace(filename + '.tmp', filename)
+        self.files_written += 1
+
+    def run(self):
+        while True:
+            host = self.hosts.get()
+            if host is None:
+                return
+            if self.error:
+                continue
+            try:
+                self.write_host(*host)
+            except OSError as err:
+                # Keep taking hosts so the recording threads are not blocked
+                self.error = err
+
+    def close(self):
+        '''Wait for the queued hosts to be written'''
+        self.hosts.put(None)
+        self.join()
+        if self.error:
+            raise self.error
+
+class Progress():
+    """Report the hosts and items recorded and the recording rate"""
+
+    def __init__(self, hosts: int, interval: float = ZABBIX_RECORD_PROGRESS):
+        self.hosts = hosts
+        self.interval = interval
+        self.hosts_done = 0
+        self.items_done = 0
+        self.requests = 0
+        self.started = time.monotonic()
+        self.next_report = self.started + interval
+
+    def update(self, hosts: int, items: int):
+        '''Count a finished request, logging the progress every interval'''
+        self.hosts_done += hosts
+        self.items_done += items
+        self.requests += 1
+        now = time.monotonic()
+        if now >= self.next_report:
+            self.next_report = now + self.interval
+            self.log(now - self.started)
+
+    def log(self, elapsed: float = None):
+        '''Log the progress'''
+        elapsed = elapsed or time.monotonic() - self.started
+        rate = self.hosts_done / elapsed if elapsed > 0 else 0
+        remaining = (self.hosts - self.hosts_done) / rate if rate else 0
+        logging.info('recorded %d/%d hosts, %d items, %.1f hosts/s, %.1f items/s, %.0fs left',
+                     self.hosts_done, self.hosts, self.items_done, rate,
+                     self.items_done / elapsed if elapsed > 0 else 0, remaining)
+
+def changed_hosts(zapi, hosts_index: dict, hostnames: dict, time_from: int,
+                  digests: dict = None):
+    '''Get the hostids to fetch again, new, renamed or changed since time_from
+
+    With digests, the item_digests of every host, hosts whose item fields
+    differ from the last run are fetched too, which finds the changes the
+    audit log has under other ids: items changed through their template,
+    and items created or updated by low level discovery.
+    '''
+    changed_hostids, changed_itemids = fetch_changes(zapi, time_from)
+    item_hosts = {itemid: hostid for hostid, entry in hosts_index.items()
+                  for itemid in entry['items']}
+    new_itemids = [itemid for itemid in changed_itemids if itemid not in item_hosts]
+    changed_hostids.update(item_hosts[itemid] for itemid in changed_itemids
+                           if itemid in item_hosts)
+    changed_hostids.update(fetch_item_hosts(zapi, new_itemids))
+    return [hostid for hostid, hostname in hostnames.items()
+            if hostid in changed_hostids or hostid not in hosts_index or
+            hosts_index[hostid]['host'] != hostname or
+            (digests is not None and hosts_index[hostid].get('fields') != digests.get(hostid))]
+
+def remove_host(directory: str, hosts_index: dict, hostid: str):
+    '''Remove a host that is gone or no longer has agent items'''
+    entry = hosts_index.pop(hostid, None)
+    if entry:
+        logging.info('removing %s', entry['host'])
+        try:
+            os.remove(os.path.join(directory, entry['host'] + '.yaml'))
+        except FileNotFoundError:
+            pass
+
+def thread_api(connect):
+    '''Get a function returning the API object of the calling thread, made by connect()'''
+    local = threading.local()
+    def api():
+        if not hasattr(local, 'zapi'):
+            local.zapi = connect()
+        return local.zapi
+    return api
+
+def record(connect, directory: str = '.', workers: int = ZABBIX_RECORD_WORKERS,
+           page_size: int = ZABBIX_RECORD_PAGE_SIZE, incremental: bool = False):
+    '''Record every host with agent items, returns the progress
+
+    connect() returns a logged in API object, one is made for each worker
+    thread. The items of page_size hosts are fetched in each item.get
+    request, with up to workers requests in flight. With incremental
+    only the hosts that are new, renamed, changed in the audit log since
+    the last run or whose item fields changed are fetched, the last values
+    of the other hosts are kept.
+    '''
+    # pylint: disable=too-many-locals
+    api = thread_api(connect)
+
+    def fetch_page(page):
+        return fetch_items(api(), page)
+
+    started = int(time.time())
+    index = read_index(directory)
+    hosts_index = index['hosts'] if index else {}
+
+    hosts = fetch_hosts(api())
+    hostnames = {host['hostid']: host['host'] for host in hosts}
+    hostids = list(hostnames)
+    if incremental and index:
+        # Every host's item fields, without the last values that are costly to get
+        pages = [hostids[start:start + page_size] for start in range(0, len(hostids), page_size)]
+        digests = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for page_digests in executor.map(
+                    lambda page: item_digests(fetch_items(api(), page, ITEM_DIGEST_FIELDS)),
+                    pages):
+                digests.update(page_digests)
+        hostids = changed_hosts(api(), hosts_index, hostnames,
+                                index['clock'] - ZABBIX_RECORD_CLOCK_MARGIN, digests)
+
+    # Renamed hosts are written under their new name
+    for hostid in list(hosts_index):
+        if hostid not in hostnames or hosts_index[hostid]['host'] != hostnames[hostid]:
+            remove_host(directory, hosts_index, hostid)
+
+    pages = [hostids[start:start + page_size] for start in range(0, len(hostids), page_size)]
+    logging.info('recording %d of %d hosts in %d requests', len(hostids), len(hostnames),
+                 len(pages))
+
+    progress = Progress(len(hostids))
+    writer = RecordWriter(directory, hosts_index)
+    writer.start()
+    emptied = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch_page, page): page for page in pages}
+            for future in concurrent.futures.as_completed(futures):
+                items = future.result()
+                digests = item_digests(items)
+                sections, itemids = host_sections(items)
+                for hostid in futures[future]:
+                    if hostid in sections:
+                        writer.write(hostid, hostnames[hostid], sections[hostid],
+                                     itemids[hostid], digests[hostid])
+                    else:
+                        emptied.append(hostid)
+                progress.update(len(futures[future]), len(items))
+    finally:
+        writer.close()
+
+    # The index is only changed by the writer thread until it is closed
+    for hostid in emptied:
+        remove_host(directory, hosts_index, hostid)
+    write_index(directory, dict(version=RECORD_INDEX_VERSION, clock=started,
+                                hosts=hosts_index))
+    progress.log()
+    logging.info('%d files written, %d unchanged', writer.files_written, writer.files_unchanged)
+    return progress
+
+def history_items(items: list, hostnames: dict, trends: bool = False):
+    '''Get the (hostname, key, value_type, section) of each item and the item numbers by itemid'''
+    history_index = []
+    item_numbers = {}
+    for item in items:
+        value_type = int(item['value_type'])
+        if trends and value_type not in TREND_VALUE_TYPES:
+            continue
+        section = 'active' if item['type'] == ITEM_TYPE_ZABBIX_ACTIVE else 'passive'
+        item_numbers[item['itemid']] = len(history_index)
+        history_index.append((hostnames[item['hostid']], item['key_'], value_type, section))
+    return history_index, item_numbers
+
+def record_history(connect, period: int, directory: str = '.', trends: bool = False,
+                   workers: int = ZABBIX_RECORD_WORKERS, page_size: int = ZABBIX_RECORD_PAGE_SIZE,
+                   window: int = ZABBIX_HISTORY_WINDOW, limit: int = ZABBIX_HISTORY_LIMIT):
+    '''Record the history of the last period seconds of every agent item, returns the values
+
+    The history is fetched a window of window seconds at a time, with the
+    requests of the next windows in flight while a window is written as
+    one chunk of the history file. A request that reaches limit values
+    is split in two halves of its time range, and a request of one second
+    in two halves of its items. Values of one item past limit in one
+    second are not recorded, with a warning.
+    '''
+    # pylint: disable=too-many-arguments,too-many-locals
+    api = thread_api(connect)
+
+    def fetch_range(value_type, itemids, time_from, time_till):
+        values = fetch_history(api(), trends, value_type, itemids, time_from, time_till, limit)
+        if len(values) < limit:
+            return values
+        if time_from < time_till:
+            middle = (time_from + time_till) // 2
+            return fetch_range(value_type, itemids, time_from, middle) + \
+                fetch_range(value_type, itemids, middle + 1, time_till)
+        if len(itemids) > 1:
+            middle = len(itemids) // 2
+            return fetch_range(value_type, itemids[:middle], time_from, time_till) + \
+                fetch_range(value_type, itemids[middle:], time_from, time_till)
+        logging.warning('item %s has %d values or more at %s, any more are not recorded',
+                        itemids[0], limit, time.ctime(time_from))
+        return values
+
+    time_till = int(time.time())
+    time_from = time_till - period
+    hostnames = {host['hostid']: host['host'] for host in fetch_hosts(api())}
+    hostids = list(hostnames)
+    pages = [hostids[start:start + page_size] for start in range(0, len(hostids), page_size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        items = [item for page in executor.map(lambda page: fetch_items(api(), page), pages)
+                 for item in page]
+    history_index, item_numbers = history_items(items, hostnames, trends)
+
+    # One request per value type and batch of items, in each window
+    batches = []
+    for value_type in sorted({value_type for _, _, value_type, _ in history_index}):
+        itemids = [itemid for itemid, item in item_numbers.items()
+                   if history_index[item][2] == value_type]
+        batches += [(value_type, itemids[start:start + ZABBIX_HISTORY_ITEMS])
+                    for start in range(0, len(itemids), ZABBIX_HISTORY_ITEMS)]
+    windows = [(start, min(start + window - 1, time_till))
+               for start in range(time_from, time_till + 1, window)]
+    logging.info('recording %s of %d items, %d windows of %d requests',
+                 'trends' if trends else 'history', len(history_index), len(windows),
+                 len(batches))
+
+    writer = HistoryWriter(os.path.join(directory, HISTORY_FILE), history_index,
+                           'trends' if trends else 'history')
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            submitted = [[executor.submit(fetch_range, value_type, itemids, start, end)
+                          for value_type, itemids in batches] for start, end in windows[:workers]]
+            for window_number, (start, end) in enumerate(windows):
+                if window_number + workers < len(windows):
+                    ahead_start, ahead_end = windows[window_number + workers]
+                    submitted.append([executor.submit(fetch_range, value_type, itemids,
+                                                      ahead_start, ahead_end)
+                                      for value_type, itemids in batches])
+                chunk = []
+                for future in submitted[window_number]:
+                    for record in future.result():
+                        item = item_numbers.get(record['itemid'])
+                        if item is None:
+                            continue
+                        value_type = history_index[item][2]
+                        try:
+                            value = parse_value(value_type, record['value_avg'] if trends
+                                                else record['value'])
+                        except ValueError:
+                            continue
+                        stamp = int(record['clock']) * NS_PER_SECOND + int(record.get('ns', 0))
+                        chunk.append((stamp, item, value))
+                submitted[window_number] = None
+                chunk.sort(key=lambda value: value[0])
+                writer.write_chunk(chunk)
+                logging.info('recorded %s to %s, %d values', time.ctime(start),
+                             time.ctime(end), len(chunk))
+    except BaseException:
+        writer.discard()
+        raise
+    writer.close(time_from, time_till)
+    logging.info('%d values written to %s', writer.values_written, HISTORY_FILE)
+    return writer.values_written
+
 def main():
     """Main for Zabbix Recorder"""
+    parser = argparse.ArgumentParser(description='Zabbix Agent simulator recorder')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fetch the hosts changed since the last run')
+    parser.add_argument('--history', metavar='PERIOD',
+                        help='also record the item history of the last PERIOD, such as 1d')
+    parser.add_argument('--trends', action='store_true',
+                        help='record trends, the hourly averages, instead of the history')
+    args = parser.parse_args()
 
     config = Config()
 
     zapi = zabbix_api.ZabbixAPI(server=config.website)
     zapi.login(config.username, config.password)
 
-    # Get all the hosts
-    hosts = zapi.host.get({"output": "extend"})
-
-    for host in hosts:
-        hostid = host['hostid']
-        hostname = host['host']
-
-        # Get the host items
-        # 7 - Zabbix agent (active);
-        active_items = zapi.item.get({
-            "hostids": hostid,
-            "sortfield": "name",
-            "filter": {
-                "type": "7"
-            },
-            "output": [ "key_", "name", "type", "value_type", "lastvalue", "delay" ]
-        })
-
-        # 0 - Zabbix agent;
-        passive_items = zapi.item.get({
-            "hostids": hostid,
-            "sortfield": "name",
-            "filter": {
-                "type": "0"
-            },
-            "output": [ "key_", "name", "value_type", "lastvalue", "delay" ]
-        })
+    # Each worker thread has its own API object, sharing the session
+    def connect():
+        worker_zapi = zabbix_api.ZabbixAPI(server=config.website)
+        worker_zapi.auth = zapi.auth
+        return worker_zapi
 
-        # Convert all deplays to seconds
-        for item in active_items:
-            item['delay'] = convert_to_seconds(item['delay'])
-            item.pop('itemid')
-
-        for item in passive_items:
-            item['delay'] = convert_to_seconds(item['delay'])
-            item.pop('itemid')
-
-        # Add the hostname and Zabbix monitoring type to dict.
-        host_items = {}
-        host_items_type = {}
-        if len(active_items) and len(passive_items):
-            host_items_type['passive'] = passive_items
-            host_items_type['active'] = active_items
-            host_items[hostname] = host_items_type
-        elif len(passive_items):
-            host_items_type['passive'] = passive_items
-            host_items[hostname] = host_items_type
-        elif len(active_items):
-            host_items_type['active'] = active_items
-            host_items[hostname] = host_items_type
-
-        # Dump the recorded items as yaml
-        if len(active_items) > 0 or len(passive_items) > 0:
-            output = yaml.dump(host_items, Dumper=yaml.Dumper)
-            with open(hostname + '.yaml', 'w', encoding="utf8") as writer:
-                writer.write(output)
+    record(connect, workers=config.record_workers, page_size=config.record_page_size,
+           incremental=args.incremental)
+    if args.history:
+        record_history(connect, convert_to_seconds(args.history), trends=args.trends,
+                       workers=config.record_workers, page_size=config.record_page_size)
 
     zapi.logout()
 
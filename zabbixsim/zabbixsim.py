@@ -4,110 +4,39 @@
 #
 
 """System modules"""
-import configparser
-import json
+import argparse
+import collections
+import concurrent.futures
 import logging
+import math
 import os
-import glob
-import random
-import socket
-import struct
+import queue
 import sys
+import threading
 import time
 import tkinter as tk
 from tkinter import ttk
 import yaml
+from zabbixsim.active import ZabbixActive
+from zabbixsim.active import ZABBIX_REFRESH_ACTIVE_CHECKS, ZABBIX_SEND_ACTIVE
+from zabbixsim.batch import ZABBIX_BATCH_VALUES
+from zabbixsim.buffer import BlockingBufferSender, buffer_from_config
+from zabbixsim.buffer import ZABBIX_RETRY_MAX, ZABBIX_RETRY_MIN
+from zabbixsim.checks import ActiveChecks, apply_checks, first_refresh_slot, jittered
+from zabbixsim.control import ControlServer, ItemControl, control_from_config
+from zabbixsim.control import start_control_thread, ZABBIX_CONTROL_POLL
+from zabbixsim.generators import ValueGenerators, ZABBIX_GENERATOR_INTERVAL
+from zabbixsim.loader import build_stores, clones_from_config, load_config, load_index
+from zabbixsim.loader import clone_hostnames
+from zabbixsim.metrics import METRICS, metrics_from_config, start_metrics_thread
+from zabbixsim.passive import passive_from_config, start_passive_thread
+from zabbixsim.pool import ConnectionPool, ZABBIX_POOL_IDLE, ZABBIX_POOL_SIZE
+from zabbixsim.reload import SimWatcher, reload_host, reload_store, reschedule_host
+from zabbixsim.reload import ZABBIX_RELOAD_INTERVAL
+from zabbixsim.routing import routes_from_config, target_directory
+from zabbixsim.scheduler import Scheduler, due_stamp, wall_clock_offset
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
-ZABBIX_ACTIVE_PORT = 10051
-#ZABBIX_ACTIVE_PORT = 10050
-ZABBIX_REFRESH_ACTIVE_CHECKS = 120
-ZABBIX_SEND_ACTIVE = 5
-
-class ZabbixActive():
-    """ZabbixActive"""
-    # Generate a random 32 character number for the session id
-    session_num= random.randrange(1, 10**32)
-
-    server = ""
-    active_data = {}
-
-    def __init__(self, server: str, active_data: dict):
-        logging.debug("ZabbixActive")
-        self.server = server
-        self.active_data = active_data
-
-    def send_message(self, data: dict):
-        '''Send the message to the Zabbix server'''
-        active_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        active_socket.connect((self.server, ZABBIX_ACTIVE_PORT))
-        logging.debug('packet %s', data)
-
-        # Generate the zabbix formatted message
-        json_data = json.dumps(data, sort_keys=False)
-        logging.debug("data %s", json_data)
-        packet_send = b'ZBXD\1' + struct.pack('<Q', len(json_data)) + json_data.encode("utf-8")
-        logging.debug("packet %s", packet_send)
-
-        # send the message and receive the response
-        active_socket.sendall(packet_send)
-        packet_receive = active_socket.recv(10000)
-        active_socket.close()
-
-        # Print the received message
-        receive_message = packet_receive[13:]
-        parsed = json.loads(receive_message)
-        logging.debug(parsed["response"])
-        return parsed
-
-    def refresh_checks(self, host_check: str):
-        '''Query the Zabbix server for an active check'''
-        active_check_msg = dict(request="active checks", host=host_check)
-        received_data = self.send_message(active_check_msg)
-
-        for value in received_data["data"]:
-            logging.debug( "%s %s", str(value["key"]), str(value["delay"]))
-        return received_data["data"]
-
-
-    def agent_data(self, hostname :str, host_data :dict):
-        '''Process the active agent data'''
-        logging.debug("agent_data")
-        epoch_time = int(time.time())
-
-        # Send active data for each host
-        if host_data:
-            item_id = 1
-            item_data_list = []
-            for item in host_data:
-                # Send the data when the current delay has been reset
-                if item['current_delay'] == item['delay']:
-                    item_data = dict(host=hostname,
-                                key=item['key_'],
-                                value=item['lastvalue'],
-                                id=item_id,
-                                clock=epoch_time,
-                                ns=0)
-                    item_data_list.append(item_data)
-                    item_id += 1
-
-        # Check if any data to send
-        if len(item_data_list) > 0:
-            agent_data_msg = dict(request="agent data",
-                        session=f'{self.session_num:032}',
-                        clock=epoch_time,
-                        ns=0,
-                        data=item_data_list)
-            logging.debug(agent_data_msg)
-            received_data = self.send_message(agent_data_msg)
-
-            logging.debug(received_data["info"])
-            self.session_num += 1
-
-# TODO
-#class ZabbixPassive():
-#    def __init__(self):
-#        logging.info("ZabbixPassive")
 
 class ZabbixSim(tk.Tk):
     """ZabbixSim"""
@@ -128,7 +57,19 @@ class ZabbixSim(tk.Tk):
     current_item = {}
     current_type = ""
 
-    zabbix_active = None
+    routes = None
+    zabbix_actives = []
+    senders = []
+    zabbix_passive = None
+    passive_lock = None
+    scheduler = None
+    send_timer = None
+    watcher = None
+    generators = []
+    checks = None
+    refresh_scheduler = None
+    refresh_slots = {}
+    control_requests = None
 
     def __init__(self):
         """ZabbixSim init"""
@@ -138,7 +79,6 @@ class ZabbixSim(tk.Tk):
 
         self.check_service()
         self.init_sim_data()
-        self.zabbix_active = ZabbixActive(self.server, self.active_data)
 
         # set up option menu variables
         self.option_var = tk.StringVar(self)
@@ -167,35 +107,76 @@ class ZabbixSim(tk.Tk):
     def init_sim_data(self):
         """Load the sim data and populate variables"""
 
-        # Get Python Config parser
-        config = configparser.ConfigParser()
-        default_config = "zabbixsim.cfg"
-        logging.debug('ConfigPath = %s', default_config)
-
-        config.read(default_config)
-
-        self.server = config.get('SETTINGS', 'server')
+        config = load_config()
+        snapshot = config.getboolean('SETTINGS', 'snapshot', fallback=False)
+        load_workers = config.getint('SETTINGS', 'load_workers', fallback=None)
 
         # Load the recorded items as yaml
-        for filename in sorted(glob.glob("*.yaml")):
-            with open(os.path.join(os.getcwd(), filename), encoding="utf8") as file:
-                loaded_data = yaml.load(file, Loader=yaml.Loader)
-
-                # Add current_delay key to dictionary
-                for hostname in loaded_data:
-                    if 'active' in loaded_data[hostname]:
-                        self.active_data[hostname] = []
-                        for item in loaded_data[hostname]['active']:
-                            item['current_delay'] = item['delay']
-                            self.active_data[hostname].append(item)
-
-                    if 'passive' in loaded_data[hostname]:
-                        self.passive_data[hostname] = []
-                        for item in loaded_data[hostname]['passive']:
-                            self.passive_data[hostname].append(item)
-
-                    # Load the hostnames
-                    self.hostnames.append(hostname)
+        index = load_index(snapshot=snapshot, workers=load_workers)
+        self.active_data, self.passive_data, self.hostnames = build_stores(index)
+        self.hostnames = clones_from_config(config, self.active_data, self.passive_data,
+                                            self.hostnames)
+        self.generators = [ValueGenerators(self.active_data), ValueGenerators(self.passive_data)]
+        self.generator_interval = config.getfloat('SETTINGS', 'generator_interval',
+                                                  fallback=ZABBIX_GENERATOR_INTERVAL)
+        if config.getboolean('SETTINGS', 'reload', fallback=False):
+            self.watcher = SimWatcher(index, workers=load_workers)
+            self.reload_interval = config.getfloat('SETTINGS', 'reload_interval',
+                                                   fallback=ZABBIX_RELOAD_INTERVAL)
+
+        # Answer passive checks in a background thread, with every host unpacked first,
+        # the passive items are only used or changed here while holding passive_lock
+        self.passive_lock = threading.RLock()
+        self.zabbix_passive = passive_from_config(config, self.passive_data,
+                                                  lock=self.passive_lock)
+        if self.zabbix_passive:
+            for hostname in self.passive_data:
+                self.zabbix_passive.keys_for(hostname)
+            start_passive_thread(self.zabbix_passive)
+
+        # Send the items the server asks for, on their delays
+        if config.getboolean('SETTINGS', 'server_checks', fallback=True):
+            self.checks = ActiveChecks()
+
+        # Send to each server or proxy target, failing over between its nodes
+        self.routes = routes_from_config(config)
+        pool = ConnectionPool(
+            max_size=config.getint('SETTINGS', 'pool_size', fallback=ZABBIX_POOL_SIZE),
+            idle_timeout=config.getfloat('SETTINGS', 'pool_idle_timeout',
+                                         fallback=ZABBIX_POOL_IDLE))
+        compress = config.getboolean('SETTINGS', 'compression', fallback=False)
+        self.zabbix_actives = [ZabbixActive(nodes[0][0], self.active_data, port=nodes[0][1],
+                                            pool=pool, compress=compress, nodes=nodes)
+                               for nodes in self.routes.targets]
+
+        # Buffer the values of each target while it is down, retrying with backoff
+        self.senders = []
+        several = len(self.routes.targets) > 1
+        for zabbix_active, nodes in zip(self.zabbix_actives, self.routes.targets):
+            buffer = buffer_from_config(config, target_directory(nodes) if several else None)
+            if buffer is None:
+                break
+            self.senders.append(BlockingBufferSender(
+                zabbix_active, buffer,
+                packet_values=config.getint('SETTINGS', 'batch_max_values',
+                                            fallback=ZABBIX_BATCH_VALUES),
+                retry_min=config.getfloat('SETTINGS', 'buffer_retry_min',
+                                          fallback=ZABBIX_RETRY_MIN),
+                retry_max=config.getfloat('SETTINGS', 'buffer_retry_max',
+                                          fallback=ZABBIX_RETRY_MAX)))
+
+        metrics_port, metrics_listen = metrics_from_config(config)
+        if metrics_port:
+            start_metrics_thread(metrics_port, metrics_listen)
+
+        # Control requests are served from a thread and run in the Tk thread
+        control_port, control_listen, control_path = control_from_config(config)
+        if control_port or control_path:
+            self.control_requests = queue.Queue()
+            start_control_thread(
+                ControlServer(ItemControl(self.active_data, self.passive_data, self.send_items),
+                              self.submit_control),
+                control_port, control_listen, control_path)
 
         # Load the agent types
         self.current_hostname = self.hostnames[0]
@@ -207,18 +188,36 @@ class ZabbixSim(tk.Tk):
 
         self.current_type = self.agent_types[0]
 
-        self.item_names = []
-        self.item_keys = []
-        if self.current_type == 'active':
-            for item in self.active_data[self.current_hostname]:
-                self.item_names.append(item['name'])
-                self.item_keys.append(item['key_'])
-            self.current_item = self.active_data[self.current_hostname][0]
-        elif self.current_type == 'passive':
-            for item in loaded_data[self.current_hostname][self.current_type]:
-                self.item_names.append(item['name'])
-                self.item_keys.append(item['key_'])
-            self.current_item = self.passive_data[self.current_hostname][0]
+        self.load_items(self.current_hostname)
+
+    def refresh_host(self, hostname: str):
+        """Refresh the active checks of a host, logging any failure"""
+        # Checks come from the first target of the host
+        zabbix_active = self.zabbix_actives[self.routes.targets_of(hostname)[0]]
+        try:
+            checks = zabbix_active.refresh_checks(hostname)
+        except (OSError, ValueError) as err:
+            logging.warning('%s: refresh failed: %s', hostname, err)
+            return
+        if checks is not None and self.checks is not None and \
+                hostname not in self.active_data.clones:
+            delta = self.checks.update(hostname, checks)
+            apply_checks(self.scheduler, self.active_data, hostname, self.checks, delta,
+                         time.monotonic())
+
+    def send_host(self, hostname: str, item_data: list, stamps: list):
+        """Send or buffer the due items of a host for its targets, stamped with their due times"""
+        if stamps:
+            METRICS.observe_sent(stamps, time.time_ns())
+        for target in self.routes.targets_of(hostname):
+            if self.senders:
+                self.senders[target].put(hostname, item_data, stamps)
+                continue
+            try:
+                self.zabbix_actives[target].agent_data(hostname, item_data, stamps)
+            except (OSError, ValueError) as err:
+                METRICS.host_errors[hostname] += 1
+                logging.warning('%s: send failed: %s', hostname, err)
 
     def create_wigets(self):
         # pylint: disable=too-many-locals
@@ -309,35 +308,56 @@ class ZabbixSim(tk.Tk):
         btn_apply = ttk.Button(self, text='Apply', command=self.apply)
         btn_apply.grid(column=0, row=6, sticky=tk.W, **paddings)
 
-        # refresh checks and send active data
-        for hostname, data_items in self.active_data.items():
-            self.zabbix_active.refresh_checks(hostname)
-            self.zabbix_active.agent_data(hostname, data_items)
+        # send all active data now and each item after its delay, then refresh checks
+        self.scheduler = Scheduler()
+        now = time.monotonic()
+        # Clones are sent with their template host, on its schedule
+        for hostname in self.active_data:
+            if hostname in self.active_data.clones:
+                continue
+            for row in self.active_data[hostname].rows:
+                self.scheduler.schedule(row, self.active_data.delays[row], now)
+
+        # Each host refreshes in its own slot of the refresh interval
+        self.refresh_scheduler = Scheduler()
+        for hostname in self.active_data:
+            self.refresh_host(hostname)
+            self.schedule_refresh(hostname, first_refresh_slot(
+                hostname, now, ZABBIX_REFRESH_ACTIVE_CHECKS))
 
         # Start timers
-        self.after(ZABBIX_REFRESH_ACTIVE_CHECKS * 1000, self.refresh_active_checks)
-        self.after(ZABBIX_SEND_ACTIVE * 1000, self.send_active_data)
+        self.refresh_active_checks()
+        self.update_values()
+        self.send_active_data()
+        if self.control_requests:
+            self.run_control_requests()
+        if self.watcher:
+            self.after(int(self.reload_interval * 1000), self.reload_sim_data)
 
     def changed_hostname(self, event):
         """hostname changed"""
-        hostname= event.widget.get()
+        self.set_hostname(event.widget.get())
+
+    def set_hostname(self, hostname):
+        """set hostname"""
         logging.debug(hostname)
         self.var_hostname.set(hostname)
 
-        # Load the agent types
-        self.current_hostname = hostname
-        self.agent_types = []
-        if self.current_hostname in self.active_data:
-            agent_type = 'active'
-            self.agent_types.append(agent_type)
-        if self.current_hostname in self.passive_data:
-            agent_type = 'passive'
-            self.agent_types.append(agent_type)
+        with self.passive_lock:
+            # Load the agent types
+            self.current_hostname = hostname
+            self.agent_types = []
+            if self.current_hostname in self.active_data:
+                agent_type = 'active'
+                self.agent_types.append(agent_type)
+            if self.current_hostname in self.passive_data:
+                agent_type = 'passive'
+                self.agent_types.append(agent_type)
 
-        self.mnu_agent_type['values'] = tuple(self.agent_types)
-        self.current_type = self.agent_types[0]
+            self.mnu_agent_type['values'] = tuple(self.agent_types)
+            self.current_type = self.agent_types[0]
 
-        self.set_agent_type(self.current_type)
+            self.set_agent_type(self.current_type)
 
 
     def changed_agent_type(self, event):
@@ -347,25 +367,27 @@ class ZabbixSim(tk.Tk):
     def set_agent_type(self, agent_type):
         """set agent type"""
         logging.debug('changed_agent_type %s', agent_type)
+        self.current_type = agent_type
 
-        # Load the items
-        hostname = self.var_hostname.get()
-        self.item_names = []
-        self.item_keys = []
-        if self.current_type == 'active':
-            for item in self.active_data[hostname]:
-                self.item_names.append(item['name'])
-                self.item_keys.append(item['key_'])
-            self.current_item = self.active_data[hostname][0]
-        elif self.current_type == 'passive':
-            for item in self.passive_data[hostname]:
-                self.item_names.append(item['name'])
-                self.item_keys.append(item['key_'])
-            self.current_item = self.passive_data[hostname][0]
+        with self.passive_lock:
+            # Load the items
+            self.load_items(self.var_hostname.get())
 
-        self.mnu_item_name['values'] = tuple(self.item_names)
-        self.mnu_item_key['values'] = tuple(self.item_keys)
-        self.set_item_name(self.current_item['name'])
+            self.mnu_item_name['values'] = tuple(self.item_names)
+            self.mnu_item_key['values'] = tuple(self.item_keys)
+            self.set_item_name(self.current_item['name'])
+
+    def current_store(self):
+        """Get the item store of the current agent type"""
+        return self.active_data if self.current_type == 'active' else self.passive_data
+
+    def load_items(self, hostname: str):
+        """Load the item names and keys of a host for the menus, and select its first item"""
+        store = self.current_store()
+        host_items = store[hostname]
+        self.item_names = [store.names[row] for row in host_items.rows]
+        self.item_keys = [store.item_keys[row] for row in host_items.rows]
+        self.current_item = host_items[0]
 
     def update_item_detail(self, item):
         """Update the item details when new item selected"""
@@ -386,16 +408,11 @@ class ZabbixSim(tk.Tk):
         """item name set"""
         logging.debug('set_item_name %s', item_name)
 
-        # Load the item details
-        hostname = self.var_hostname.get()
-        if self.current_type == 'active':
-            for item in self.active_data[hostname]:
-                if item_name == item['name']:
-                    self.update_item_detail(item)
-        elif self.current_type == 'passive':
-            for item in self.passive_data[hostname]:
-                if item_name == item['name']:
-                    self.update_item_detail(item)
+        with self.passive_lock:
+            # Load the item details, the first item with the name
+            item = self.current_store().item_by_name(self.var_hostname.get(), item_name)
+            if item is not None:
+                self.update_item_detail(item)
 
     def changed_item_key(self, event):
         """item key changed"""
@@ -404,50 +421,189 @@ class ZabbixSim(tk.Tk):
     def set_item_key(self, item_key):
         """item key set"""
         logging.debug('changed_item_key %s', item_key)
-        # Load the item details
-        hostname = self.var_hostname.get()
-        if self.current_type == 'active':
-            for item in self.active_data[hostname]:
-                if item_key == item['key_']:
-                    self.update_item_detail(item)
-        elif self.current_type == 'passive':
-            for item in self.passive_data[hostname]:
-                if item_key == item['key_']:
-                    self.update_item_detail(item)
+        with self.passive_lock:
+            # Load the item details
+            item = self.current_store().item_by_key(self.var_hostname.get(), item_key)
+            if item is not None:
+                self.update_item_detail(item)
 
     def apply(self):
         """Apply the change in value and send update"""
-        self.current_item['lastvalue'] = self.entry_item_value.get()
-        self.current_item['current_delay'] = self.current_item['delay']
-        for hostname, item_data in self.active_data.items():
-            self.zabbix_active.agent_data(hostname, item_data)
+        with self.passive_lock:
+            self.current_item['lastvalue'] = self.entry_item_value.get()
+        if self.current_type == 'active':
+            self.send_items(self.current_hostname, [self.current_item])
+
+    def send_items(self, hostname: str, items: list):
+        """Send edited items of a host now, outside their schedule"""
+        self.send_host(hostname, items, None)
+        for sender in self.senders:
+            sender.flush(time.monotonic())
+
+    def submit_control(self, function, *args):
+        """Run a control request in the Tk thread, returns the future of its result"""
+        future = concurrent.futures.Future()
+        self.control_requests.put((future, function, args))
+        return future
+
+    def run_control_requests(self):
+        """Run the waiting control requests, showing the current item if it was changed"""
+        shown = self.current_item['lastvalue']
+        while True:
+            try:
+                future, function, args = self.control_requests.get_nowait()
+            except queue.Empty:
+                break
+            with self.passive_lock:
+                try:
+                    future.set_result(function(*args))
+                except Exception as err:  # pylint: disable=broad-except
+                    future.set_exception(err)
+        if self.current_item['lastvalue'] != shown:
+            self.update_item_detail(self.current_item)
+        self.after(int(ZABBIX_CONTROL_POLL * 1000), self.run_control_requests)
+
+    def reload_sim_data(self):
+        """Reload the changed simulation files, keeping the schedule of unchanged items"""
+        try:
+            changed, removed = self.watcher.poll()
+        except (OSError, ValueError, yaml.YAMLError) as err:
+            logging.warning('reload failed: %s', err)
+            changed, removed = [], []
+
+        now = time.monotonic()
+        for hostname, sections, blob in changed:
+            old_rows, _ = reload_host(self.active_data, hostname, sections, blob, 'active')
+            new_rows = range(0)
+            if hostname in self.active_data:
+                new_rows = self.active_data[hostname].rows
+            reschedule_host(self.scheduler, self.active_data, old_rows, new_rows, now)
+            if not new_rows:
+                continue
+            if not old_rows:
+                self.refresh_host(hostname)
+                self.schedule_refresh(hostname, first_refresh_slot(
+                    hostname, now, ZABBIX_REFRESH_ACTIVE_CHECKS))
+            elif self.checks is not None:
+                apply_checks(self.scheduler, self.active_data, hostname, self.checks, None, now)
+        for hostname in removed:
+            reschedule_host(self.scheduler, self.active_data,
+                            self.active_data.remove_host(hostname), range(0), now)
+            if self.checks is not None:
+                self.checks.remove(hostname)
+
+        with self.passive_lock:
+            if self.zabbix_passive:
+                self.zabbix_passive.reload(changed, removed)
+            else:
+                reload_store(self.passive_data, 'passive', changed, removed)
+
+            # Show the reloaded hosts and items
+            if changed or removed:
+                self.hostnames = clone_hostnames(self.watcher.hostnames(), self.active_data,
+                                                 self.passive_data)
+                self.mnu_hostname['values'] = tuple(self.hostnames)
+                if self.current_hostname not in self.hostnames:
+                    self.mnu_hostname.current(0)
+                    self.set_hostname(self.hostnames[0])
+                elif self.current_hostname in [hostname for hostname, _, _ in changed]:
+                    self.set_hostname(self.current_hostname)
+
+        if changed or removed:
+            self.after_cancel(self.send_timer)
+            self.send_active_data()
+        self.after(int(self.reload_interval * 1000), self.reload_sim_data)
+
+    def update_values(self):
+        """Update the items with value generators"""
+        with self.passive_lock:
+            for value_generators in self.generators:
+                value_generators.update()
+        self.after(int(self.generator_interval * 1000), self.update_values)
+
+    def schedule_refresh(self, hostname: str, slot: float):
+        """Schedule the next refresh of a host's active checks, near its slot"""
+        self.refresh_slots[hostname] = slot
+        self.refresh_scheduler.schedule(hostname, ZABBIX_REFRESH_ACTIVE_CHECKS,
+                                        jittered(slot, ZABBIX_REFRESH_ACTIVE_CHECKS))
 
     def refresh_active_checks(self):
-        """Refresh active checks"""
-        logging.debug('refresh active checks')
-        for hostname in self.active_data:
-            self.zabbix_active.refresh_checks(hostname)
-        self.after(ZABBIX_REFRESH_ACTIVE_CHECKS * 1000, self.refresh_active_checks)
+        """Refresh the active checks of the hosts that are due"""
+        for hostname, _ in self.refresh_scheduler.pop_due(time.monotonic()):
+            if hostname not in self.active_data:
+                self.refresh_scheduler.unschedule(hostname)
+                self.refresh_slots.pop(hostname, None)
+                continue
+            logging.debug('%s: refresh active checks', hostname)
+            self.refresh_host(hostname)
+            self.schedule_refresh(hostname,
+                                  self.refresh_slots[hostname] + ZABBIX_REFRESH_ACTIVE_CHECKS)
+
+        next_due = self.refresh_scheduler.next_due()
+        if next_due is None:
+            delay_ms = ZABBIX_REFRESH_ACTIVE_CHECKS * 1000
+        else:
+            delay_ms = max(0, math.ceil((next_due - time.monotonic()) * 1000))
+        self.after(delay_ms, self.refresh_active_checks)
 
     def send_active_data(self):
         """Send active data"""
         logging.debug('send active data')
-        for hostname, item_data in self.active_data.items():
-            for item in item_data:
-                # Update the current delay, so data is sent after the proper delay
-                if item['current_delay'] <= 0:
-                    item['current_delay'] = \
-                        item['delay']
-                else:
-                    item['current_delay'] = \
-                        item['current_delay'] - int(ZABBIX_SEND_ACTIVE)
-            self.zabbix_active.agent_data(hostname, item_data)
-        self.after(ZABBIX_SEND_ACTIVE * 1000, self.send_active_data)
+        due_items = collections.defaultdict(list)
+        due_stamps = collections.defaultdict(list)
+        now = time.monotonic()
+        offset = wall_clock_offset()
+        lag = METRICS.histograms['scheduler_lag_seconds']
+        for row, due in self.scheduler.pop_due(now):
+            lag.observe(now - due)
+            hostname = self.active_data.host_of(row)
+            due_items[hostname].append(self.active_data.item(row))
+            due_stamps[hostname].append(due_stamp(due, offset))
+        if self.scheduler.skipped:
+            METRICS.counters['checks_skipped_total'] += self.scheduler.skipped
+            self.scheduler.skipped = 0
+        for hostname, item_data in due_items.items():
+            stamps = due_stamps[hostname]
+            self.send_host(hostname, item_data, stamps)
+            for clone_name in self.active_data.clones_of(hostname):
+                clone = self.active_data.clones[clone_name]
+                self.send_host(clone_name, [self.active_data.item(item.row, clone)
+                                            for item in item_data], stamps)
+        for sender in self.senders:
+            sender.flush(time.monotonic())
+
+        # Wake up when the next item is due, or to retry the buffered values, rounding
+        # up so the timer does not fire just before the item is due
+        next_due = self.scheduler.next_due()
+        if next_due is None:
+            next_due = time.monotonic() + ZABBIX_SEND_ACTIVE
+        for sender in self.senders:
+            next_due = min(next_due, max(sender.retry_at, time.monotonic() + ZABBIX_SEND_ACTIVE))
+        delay_ms = max(0, math.ceil((next_due - time.monotonic()) * 1000))
+        self.send_timer = self.after(delay_ms, self.send_active_data)
 
 def main():
     """Main for Zabbix Simulator"""
+    parser = argparse.ArgumentParser(description='Zabbix Agent simulator')
+    parser.add_argument('--headless', action='store_true',
+                        help='run the active agents without the Tk interface')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='stop the headless simulator after this many seconds')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='split the hosts across this many headless worker processes')
+    args = parser.parse_args()
+
+    if args.headless:
+        # pylint: disable=import-outside-toplevel
+        from zabbixsim.headless import run_headless
+        run_headless(duration=args.duration, shards=args.shards)
+        return
+
     zabbixsim = ZabbixSim()
     zabbixsim.mainloop()
+    deviation = METRICS.deviation_report()
+    if deviation:
+        logging.info('send deviation %s', deviation)
 
 if __name__ == "__main__":
     main()